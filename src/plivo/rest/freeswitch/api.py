@@ -19,9 +19,13 @@ from werkzeug.exceptions import Unauthorized
 import gevent.queue
 
 from plivo.rest.freeswitch.helpers import is_valid_url, get_conf_value, \
-                                            get_post_param, get_resource, \
+                                            get_post_param, get_http_param, \
+                                            get_resource, \
                                             normalize_url_space, \
                                             HTTPRequest
+from plivo.rest.freeswitch.speakcache import get_speak_file
+from plivo.rest.freeswitch.bulkcall import CallBatch, spool_batch, \
+                                            purge_batches
 import plivo.rest.freeswitch.elements as elements
 
 MAX_LOOPS = elements.MAX_LOOPS
@@ -69,6 +73,7 @@ class CallRequest(object):
                  '_from',
                  '_accountsid',
                  '_qe',
+                 'batch',
                 )
 
     def __init__(self, request_uuid, gateways,
@@ -86,6 +91,8 @@ class CallRequest(object):
         self._accountsid = accountsid
         self.extra_dial_string = extra_dial_string
         self._qe = gevent.queue.Queue()
+        # streamed BulkCall batch
+        self.batch = None
 
     def notify_call_try(self):
         self._qe.put(False)
@@ -157,16 +164,22 @@ class PlivoRestApi(object):
                 self._rest_inbound_socket.log.warn('No Response Tag Present')
                 return sound_files
 
-            # build play string from remote restxml
+            # resolve all Play urls with one cache lookup
+            plays = {}
             for element in doc:
-                # Play element
                 if element.tag == 'Play':
                     child_instance = elements.Play()
                     child_instance.parse_element(element)
-                    child_instance.prepare(self._rest_inbound_socket)
+                    plays[element] = child_instance
+            elements.prepare_plays(self._rest_inbound_socket, plays.values())
+
+            # build play string from remote restxml
+            for element in doc:
+                # Play element
+                if element.tag == 'Play':
+                    child_instance = plays[element]
                     sound_file = child_instance.sound_file_path
                     if sound_file:
-                        sound_file = get_resource(self._rest_inbound_socket, sound_file)
                         loop = child_instance.loop_times
                         if loop == 0:
                             loop = MAX_LOOPS  # Add a high number to Play infinitely
@@ -195,7 +208,10 @@ class PlivoRestApi(object):
                     else:
                         engine = child_instance.engine
                         voice = child_instance.voice
-                        say_str = "say:%s:%s:'%s'" % (engine, voice, text)
+                        # play the phrase rendered by the speak cache if any
+                        say_str = get_speak_file(self._rest_inbound_socket, engine, voice,
+                                    child_instance.language, child_instance.text) \
+                                    or "say:%s:%s:'%s'" % (engine, voice, text)
                     if not say_str:
                         continue
                     for i in range(loop):
@@ -327,6 +343,48 @@ class PlivoRestApi(object):
                                extra_dial_string=args_str)
         return call_req
 
+    def _prepare_call_request_from_params(self, params):
+        """Build a CallRequest from a dict of /Call/ parameters,
+        raises ValueError if parameters are not valid
+        """
+        for key, value in params.items():
+            if value is None:
+                params[key] = ''
+            elif not isinstance(value, basestring):
+                params[key] = str(value)
+        caller_id = params.get('From', '')
+        to = params.get('To', '')
+        gw = params.get('Gateways', '')
+        answer_url = params.get('AnswerUrl', '')
+        if not caller_id or not to or not gw or not answer_url:
+            raise ValueError("Mandatory Parameters Missing")
+        if not is_valid_url(answer_url):
+            raise ValueError("AnswerUrl is not Valid")
+        hangup_url = params.get('HangupUrl', '') or answer_url
+        ring_url = params.get('RingUrl', '')
+        if not is_valid_url(hangup_url):
+            raise ValueError("HangupUrl is not Valid")
+        if ring_url and not is_valid_url(ring_url):
+            raise ValueError("RingUrl is not Valid")
+        return self._prepare_call_request(
+                    caller_id, params.get('CallerName', ''), to,
+                    params.get('ExtraDialString', ''), gw,
+                    params.get('GatewayCodecs', ''), params.get('GatewayTimeouts', ''),
+                    params.get('GatewayRetries', ''), params.get('SendDigits', ''),
+                    params.get('SendOnPreanswer', '') == 'true',
+                    params.get('TimeLimit', ''), params.get('HangupOnRing', ''),
+                    answer_url, ring_url, hangup_url, params.get('AccountSID', ''))
+
+    def _get_conference_cache(self):
+        """Returns the conference cache if lists can be served from it,
+        else None
+        """
+        socket = self._rest_inbound_socket
+        if socket.get_server().conference_sync_interval > 0 \
+            and socket.conferences.synced:
+            return socket.conferences
+        return None
+
     @staticmethod
     def _parse_conference_xml_list(xmlstr, member_filter=None, uuid_filter=None, mute_filter=False, deaf_filter=False):
         res = {}
@@ -378,6 +436,7 @@ class PlivoRestApi(object):
                 m["MemberID"] = member_id
                 m["Deaf"] = is_deaf
                 m["Muted"] = is_muted
+                m["Floor"] = member.findtext("flags/has_floor") == "true"
                 m["CallUUID"] = call_uuid
                 m["CallName"] = member.find("caller_id_name").text
                 m["CallNumber"] = member.find("caller_id_number").text
@@ -443,7 +502,7 @@ class PlivoRestApi(object):
         result = False
 
         try:
-            cache_api_url = self.cache['url']
+            cache_api_urls = self.cache['ring'].urls
         except KeyError:
             msg = "ReloadCacheConfig Failed -- CACHE_URL not found"
             result = False
@@ -451,20 +510,21 @@ class PlivoRestApi(object):
 
         try:
             req = HTTPRequest(auth_id=self.key, auth_token=self.secret)
-            data = req.fetch_response(cache_api_url + '/ReloadConfig/', params={}, method='POST')
-            res = json.loads(data)
-            try:
-                success = res['Success']
-                msg = res['Message']
-            except:
-                success = False
-                msg = "unknown"
-            if success:
-                msg = "Plivo Cache Server config reloaded"
-                result = True
-                self._rest_inbound_socket.log.info("ReloadCacheConfig Done")
-            else:
-                raise Exception(msg)
+            # reload all cache servers
+            for cache_api_url in cache_api_urls:
+                data = req.fetch_response(cache_api_url + '/ReloadConfig/', params={}, method='POST')
+                res = json.loads(data)
+                try:
+                    success = res['Success']
+                    msg = res['Message']
+                except:
+                    success = False
+                    msg = "unknown"
+                if not success:
+                    raise Exception("%s: %s" % (cache_api_url, msg))
+            msg = "Plivo Cache Server config reloaded"
+            result = True
+            self._rest_inbound_socket.log.info("ReloadCacheConfig Done")
 
         except Exception, e:
             msg = "Plivo Cache Server config reload failed"
@@ -473,6 +533,36 @@ class PlivoRestApi(object):
 
         return self.send_response(Success=result, Message=msg)
 
+    @auth_protect
+    def invalidate_cache(self):
+        """Drop memoized cache lookups
+
+        Called by plivo cache server when a cached file changes.
+
+        POST Parameters
+        ---------------
+        Url: Url of changed file, drop all memoized lookups if empty.
+        Can be repeated to drop several urls.
+        """
+        self._rest_inbound_socket.log.debug("RESTAPI InvalidateCache with %s" \
+                                        % str(request.form.items()))
+        try:
+            memo = self.cache['memo']
+        except KeyError:
+            msg = "InvalidateCache Failed -- CACHE_URL not found"
+            return self.send_response(Success=False, Message=msg)
+
+        urls = [ url for url in request.form.getlist('Url') if url ]
+        if urls:
+            for url in urls:
+                memo.invalidate(url)
+            msg = "Cache lookup for %s invalidated" % ', '.join(urls)
+        else:
+            memo.invalidate(None)
+            msg = "All cache lookups invalidated"
+        self._rest_inbound_socket.log.debug(msg)
+        return self.send_response(Success=True, Message=msg)
+
 
     @auth_protect
     def call(self):
@@ -581,9 +671,11 @@ class PlivoRestApi(object):
 
                 request_uuid = call_req.request_uuid
                 self._rest_inbound_socket.call_requests[request_uuid] = call_req
-                self._rest_inbound_socket.spawn_originate(request_uuid)
-                msg = "Call Request Executed"
-                result = True
+                if self._rest_inbound_socket.spawn_originate(request_uuid):
+                    msg = "Call Request Executed"
+                    result = True
+                else:
+                    msg = "Call Request Failed -- Originate Queue Full"
 
         return self.send_response(Success=result,
                              Message=msg,
@@ -770,6 +862,58 @@ class PlivoRestApi(object):
         return self.send_response(Success=result, Message=msg,
                              RequestUUID=request_uuid_list)
 
+    @auth_protect
+    def bulk_call_stream(self):
+        """Streamed BulkCall of any number of calls
+
+        POST body is one json object by line (NDJSON), with the
+        parameters of /Call/ for each call, e.g.
+        {"To": "1000", "Gateways": "user/", "From": "1001", "AnswerUrl": "http://..."}
+
+        Parameters of the url query string are used as default
+        parameters of every call.
+
+        The body is spooled to disk and calls are created and queued
+        as the batch progresses. Returns a BatchID to query
+        /BulkCallStatus/, once the whole body is spooled: the body
+        cannot be read after the response is sent, so clients
+        sending big batches must allow for the upload time.
+        """
+        socket = self._rest_inbound_socket
+        defaults = dict(request.args.items())
+        socket.log.debug("RESTAPI BulkCallStream with %s" % str(defaults))
+        server = socket.get_server()
+        try:
+            path, total = spool_batch(request.stream, server.bulk_spool_path)
+        except Exception, e:
+            msg = "BulkCallStream Failed -- Cannot spool request (%s)" % str(e)
+            return self.send_response(Success=False, Message=msg)
+        purge_batches(socket.batches)
+        batch = CallBatch(path, total, defaults, server.bulk_call_window, socket.log)
+        socket.batches[batch.batch_id] = batch
+        gevent.spawn_raw(batch.run, socket, self._prepare_call_request_from_params)
+        msg = "BulkCallStream Batch Executed"
+        return self.send_response(Success=True, Message=msg,
+                                  BatchID=batch.batch_id, Total=total)
+
+    @auth_protect
+    def bulk_call_status(self):
+        """Status of a streamed BulkCall
+
+        BatchID: Unique batch ID given by /BulkCallStream/
+        """
+        batch_id = get_post_param(request, 'BatchID') \
+                    or get_http_param(request, 'BatchID')
+        try:
+            batch = self._rest_inbound_socket.batches[batch_id]
+        except KeyError:
+            msg = "BulkCallStatus Failed -- BatchID %s not found" % batch_id
+            return self.send_response(Success=False, Message=msg)
+        status = batch.get_status()
+        msg = "BulkCallStatus: %d/%d requested, %d ended" \
+                % (status['Requested'], status['Total'], status['Ended'])
+        return self.send_response(Success=True, Message=msg, **status)
+
     @auth_protect
     def hangup_call(self):
         """Hangup Call
@@ -861,6 +1005,93 @@ class PlivoRestApi(object):
         self._rest_inbound_socket.hangup_all_calls()
         return self.send_response(Success=True, Message=msg)
 
+    @auth_protect
+    def call_queue(self):
+        """Status of the originate queue
+
+        Queued: call requests waiting to be dispatched
+        Waiting: call attempts waiting for a gateway slot
+        Dialing: call attempts in progress
+        Ringing: calls ringing or in early media, then answered until hangup
+        Gateways: active calls and limits by gateway
+        Accounts: queued and active calls, wait times and limits by AccountSID
+        """
+        socket = self._rest_inbound_socket
+        status = socket.scheduler.get_status(socket.call_requests)
+        msg = "CallQueue: %d queued, %d dialing, %d ringing" \
+                % (status['Queued'], status['Dialing'], status['Ringing'])
+        return self.send_response(Success=True, Message=msg, **status)
+
+    @auth_protect
+    def gateway_health(self):
+        """Health of gateways from call attempts
+
+        Ordering: gateway ordering mode (off, health or latency)
+        Attempts: call attempts waiting for a result
+        Gateways: by gateway, attempts, successes, failures and
+        their hangup causes, score, average post dial delay,
+        circuit breaker state (closed, open, half-open) and trips
+        """
+        status = self._rest_inbound_socket.gateway_monitor.get_status()
+        opened = [ gw for gw, health in status['Gateways'].iteritems() \
+                        if health['Breaker'] != 'closed' ]
+        msg = "GatewayHealth: %d gateways, %d with open circuit" \
+                % (len(status['Gateways']), len(opened))
+        return self.send_response(Success=True, Message=msg, **status)
+
+    @auth_protect
+    def active_calls(self):
+        """Active calls, answered from memory without querying FreeSWITCH
+
+        Optional Parameters
+        -------------------
+        RequestUUID: only calls of this request
+        AccountSID: only calls of this account
+        Direction: only inbound or outbound calls
+        CountOnly: 'true' to only get the number of calls
+        """
+        params = {}
+        for key in ('RequestUUID', 'AccountSID', 'Direction', 'CountOnly'):
+            params[key] = get_post_param(request, key) \
+                            or get_http_param(request, key) or ''
+        calls = self._rest_inbound_socket.active_calls.find(
+                            request_uuid=params['RequestUUID'],
+                            accountsid=params['AccountSID'],
+                            direction=params['Direction'])
+        msg = "ActiveCalls: %d calls" % len(calls)
+        if params['CountOnly'] == 'true':
+            return self.send_response(Success=True, Message=msg, Count=len(calls))
+        return self.send_response(Success=True, Message=msg, Count=len(calls),
+                                  Calls=[ call.to_dict() for call in calls ])
+
+    @auth_protect
+    def call_info(self):
+        """Info of an active call, answered from memory
+
+        CallUUID: Unique Call ID of the call
+        or
+        RequestUUID: Unique Request ID of an outbound call
+        """
+        call_uuid = get_post_param(request, 'CallUUID') \
+                        or get_http_param(request, 'CallUUID')
+        request_uuid = get_post_param(request, 'RequestUUID') \
+                        or get_http_param(request, 'RequestUUID')
+        registry = self._rest_inbound_socket.active_calls
+        if call_uuid:
+            call = registry.get(call_uuid)
+            calls = call and [call] or []
+        elif request_uuid:
+            calls = registry.find(request_uuid=request_uuid)
+        else:
+            msg = "CallUUID or RequestUUID Parameter must be present"
+            return self.send_response(Success=False, Message=msg)
+        if not calls:
+            msg = "CallInfo Failed -- Call not found"
+            return self.send_response(Success=False, Message=msg)
+        msg = "CallInfo Executed"
+        return self.send_response(Success=True, Message=msg,
+                                  **calls[0].to_dict())
+
     @auth_protect
     def schedule_hangup(self):
         """Schedule Call Hangup
@@ -1489,6 +1720,15 @@ class PlivoRestApi(object):
             return self.send_response(Success=result, Message=msg)
         if not members:
             members = None
+        conferences = self._get_conference_cache()
+        if conferences:
+            if not conferences.has_room(room):
+                msg = "Conference ListMembers Conference %s not found" % str(room)
+                return self.send_response(Success=result, Message=msg)
+            member_list = conferences.get_list(room, member_filter=members,
+                                uuid_filter=calluuids, mute_filter=onlymuted, deaf_filter=onlydeaf)
+            msg = "Conference ListMembers Executed"
+            return self.send_response(Success=True, Message=msg, List=member_list)
         res = self._rest_inbound_socket.conference_api(room, "xml_list", async=False)
         if not res:
             msg = "Conference ListMembers Failed"
@@ -1538,6 +1778,12 @@ class PlivoRestApi(object):
         onlymuted = get_post_param(request, 'MutedFilter') == 'true'
         onlydeaf = get_post_param(request, 'DeafFilter') == 'true'
 
+        conferences = self._get_conference_cache()
+        if conferences:
+            confs = conferences.get_list(member_filter=members,
+                                uuid_filter=calluuids, mute_filter=onlymuted, deaf_filter=onlydeaf)
+            msg = "Conference List Executed"
+            return self.send_response(Success=True, Message=msg, List=confs)
         res = self._rest_inbound_socket.conference_api(room='', command="xml_list", async=False)
         if res:
             try:
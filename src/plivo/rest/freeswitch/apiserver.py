@@ -20,6 +20,9 @@ from plivo.core.errors import ConnectError
 from plivo.rest.freeswitch.api import PlivoRestApi
 from plivo.rest.freeswitch.inboundsocket import RESTInboundSocket
 from plivo.rest.freeswitch import urls, helpers
+from plivo.rest.freeswitch.speakcache import create_speak_cache
+from plivo.rest.freeswitch.originate import parse_gateway_limits, \
+                                            parse_account_limits
 import plivo.utils.daemonize
 from plivo.utils.logger import StdoutLogger, FileLogger, SysLogger, DummyLogger, HTTPLogger
 
@@ -58,6 +61,7 @@ class PlivoRestServer(PlivoRestApi):
         # load config
         self._config = None
         self.cache = {}
+        self.speak_cache = None
         self.load_config()
 
         # create inbound socket instance
@@ -212,12 +216,50 @@ class PlivoRestServer(PlivoRestApi):
             # get record url
             self.record_url = config.get('rest_server', 'RECORD_URL', default='')
 
+            # originate pacing, 0 for no limit
+            self.originate_cps = float(config.get('rest_server', 'ORIGINATE_CPS', default='0'))
+            self.originate_max_queue = int(config.get('rest_server', 'ORIGINATE_MAX_QUEUE', default='0'))
+            self.gateway_limits = parse_gateway_limits(
+                    config.get('rest_server', 'GATEWAY_LIMITS', default=''))
+            self.gateway_max_calls = int(config.get('rest_server', 'GATEWAY_MAX_CALLS', default='0'))
+            self.gateway_cps = float(config.get('rest_server', 'GATEWAY_CPS', default='0'))
+            # fair share of originates between accounts
+            self.account_limits = parse_account_limits(
+                    config.get('rest_server', 'ACCOUNT_LIMITS', default=''))
+            self.account_weight = float(config.get('rest_server', 'ACCOUNT_WEIGHT', default='1'))
+            self.account_max_calls = int(config.get('rest_server', 'ACCOUNT_MAX_CALLS', default='0'))
+            # gateway circuit breakers and ordering by health
+            self.gateway_ordering = config.get('rest_server', 'GATEWAY_ORDERING', default='off')
+            self.gateway_breaker_failures = int(config.get('rest_server', 'GATEWAY_BREAKER_FAILURES', default='5'))
+            self.gateway_breaker_cooldown = float(config.get('rest_server', 'GATEWAY_BREAKER_COOLDOWN', default='30'))
+            self.gateway_min_score = float(config.get('rest_server', 'GATEWAY_MIN_SCORE', default='0.5'))
+            # seconds between conference cache reconciles, 0 to query
+            # FreeSWITCH on every conference list
+            self.conference_sync_interval = int(config.get('rest_server',
+                                                'CONFERENCE_SYNC_INTERVAL', default='60'))
+            # streamed bulk calls spool directory and max calls requested at once
+            self.bulk_spool_path = config.get('rest_server', 'BULK_SPOOL_PATH', default='')
+            self.bulk_call_window = int(config.get('rest_server', 'BULK_CALL_WINDOW', default='1000'))
+
             # load cache params
             # load cache params
             self.cache['url'] = config.get('common', 'CACHE_URL', default='')
             self.cache['script'] = config.get('common', 'CACHE_SCRIPT', default='')
+            self.cache['variant'] = config.get('common', 'CACHE_VARIANT', default='')
+            self.cache['shared_path'] = config.get('common', 'CACHE_SHARED_PATH', default='')
+            # memo of cache server lookups
+            self.cache['memo'] = helpers.ResourceMemo(
+                    int(config.get('common', 'CACHE_MEMO_SIZE', default='1000')),
+                    int(config.get('common', 'CACHE_MEMO_TTL', default='60')))
             if not self.cache['url'] or not self.cache['script']:
                 self.cache = {}
+            else:
+                # comma separated cache servers, sharded by resource
+                self.cache['ring'] = helpers.CacheRing(self.cache['url'].split(','),
+                        retry=int(config.get('common', 'CACHE_RETRY', default='30')),
+                        timeout=int(config.get('common', 'CACHE_TIMEOUT', default='5')))
+            self.cache_health_interval = int(config.get('common',
+                                        'CACHE_HEALTH_INTERVAL', default='10'))
 
             # get pid file for reloading outbound server (ugly hack ...)
             try:
@@ -230,6 +272,9 @@ class PlivoRestServer(PlivoRestApi):
                 self.create_logger(config=config)
                 self.log.warn("New logger %s" % str(self.log))
 
+            # cache of speak phrases rendered to files
+            self.speak_cache = create_speak_cache(config, self.log)
+
             # set new config
             self._config = config
             self.log.info("Config : %s" % str(self._config.dumps()))
@@ -311,6 +356,13 @@ class PlivoRestServer(PlivoRestApi):
         retries = 1
         # start http server
         self.http_proc = gevent.spawn(self.http_server.serve_forever)
+        # check cache servers health
+        if self.cache_health_interval > 0:
+            gevent.spawn_raw(helpers.check_cache_health, self,
+                             self.cache_health_interval)
+        # reconcile conference cache with FreeSWITCH,
+        # also started when disabled as config reload can enable it
+        gevent.spawn_raw(self._rest_inbound_socket.sync_conferences)
         if self._ssl:
             self.log.info("RESTServer started at: 'https://%s'" % self.http_address)
         else:
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+import os
+import tempfile
+import time
+import traceback
+import uuid
+
+import ujson as json
+from gevent.event import Event
+
+
+# seconds a finished batch status is kept
+BATCH_TTL = 3600
+
+# max number of invalid or failed lines reported in batch status
+MAX_ERRORS = 20
+
+CHUNK_SIZE = 64 * 1024
+
+# max seconds between checks of originate queue room
+QUEUE_FULL_WAIT = 1
+
+
+def spool_batch(stream, spool_path=''):
+    """Copy a NDJSON request body to a file,
+    returns (file path, number of lines)
+    """
+    fd, path = tempfile.mkstemp(prefix='plivo_batch_', suffix='.ndjson',
+                                dir=spool_path or None)
+    fd = os.fdopen(fd, 'wb')
+    lines = 0
+    last = '\n'
+    try:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            fd.write(chunk)
+            lines += chunk.count('\n')
+            last = chunk[-1]
+    except:
+        fd.close()
+        os.remove(path)
+        raise
+    fd.close()
+    # last line without trailing newline
+    if last != '\n':
+        lines += 1
+    return path, lines
+
+
+class CallBatch(object):
+    """Calls of a streamed BulkCall, one json object by line
+    in a spooled file
+
+    Lines are turned into call requests only when the batch has less
+    than window calls queued or in progress, so a big batch
+    never holds more than window call requests. When the originate
+    queue is full, the batch waits for room instead of rejecting lines.
+    """
+    def __init__(self, path, total, defaults, window, log):
+        self.batch_id = str(uuid.uuid1())
+        self.path = path
+        self.total = total
+        self.defaults = defaults
+        self.window = window
+        self.log = log
+        self.read = 0
+        self.invalid = 0
+        # lines failed with an unexpected error
+        self.failed = 0
+        self.rejected = 0
+        self.created = 0
+        self.ended = 0
+        # hangup cause: count
+        self.causes = {}
+        # (line number, error)
+        self.errors = []
+        self.started = time.time()
+        self.finished = None
+        self.last_ended = 0
+        self._slot = Event()
+
+    def get_outstanding(self):
+        return self.created - self.rejected - self.ended
+
+    def is_done(self):
+        return self.finished is not None and not self.get_outstanding()
+
+    def add_error(self, line, error):
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((line, error))
+
+    def fail_line(self, error):
+        self.failed += 1
+        self.add_error(self.read, str(error))
+        self.log.error("BulkCall Batch %s Failed at line %d: %s" \
+                                % (self.batch_id, self.read, str(error)))
+        [ self.log.error(line) for line in \
+                    traceback.format_exc().splitlines() ]
+
+    def run(self, socket, prepare):
+        """Create and queue call requests from batch lines,
+        prepare(params) returns a CallRequest or raises ValueError
+
+        A line failing with any other error is counted as failed
+        and the batch goes on.
+        """
+        fd = open(self.path, 'r')
+        try:
+            try:
+                for line in fd:
+                    self.read += 1
+                    line = line.strip()
+                    if not line:
+                        self.total -= 1
+                        continue
+                    while self.get_outstanding() >= self.window:
+                        self._slot.clear()
+                        self._slot.wait()
+                    try:
+                        params = json.loads(line)
+                        if not isinstance(params, dict):
+                            raise ValueError("Not a json object")
+                        call_params = dict(self.defaults)
+                        call_params.update(params)
+                        call_req = prepare(call_params)
+                    except ValueError, e:
+                        self.invalid += 1
+                        self.add_error(self.read, str(e))
+                        continue
+                    except Exception, e:
+                        self.fail_line(e)
+                        continue
+                    self.wait_queue_room(socket.scheduler)
+                    call_req.batch = self
+                    request_uuid = call_req.request_uuid
+                    socket.call_requests[request_uuid] = call_req
+                    try:
+                        spawned = socket.spawn_originate(request_uuid)
+                    except Exception, e:
+                        socket.call_requests.pop(request_uuid, None)
+                        self.fail_line(e)
+                        continue
+                    self.created += 1
+                    if not spawned:
+                        self.rejected += 1
+            except Exception, e:
+                self.log.error("BulkCall Batch %s Failed at line %d: %s" \
+                                        % (self.batch_id, self.read, str(e)))
+                [ self.log.error(line) for line in \
+                            traceback.format_exc().splitlines() ]
+        finally:
+            fd.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.finished = time.time()
+            self.log.info("BulkCall Batch %s: %d calls requested, %d invalid, %d failed, %d rejected" \
+                            % (self.batch_id, self.created, self.invalid,
+                               self.failed, self.rejected))
+
+    def wait_queue_room(self, scheduler):
+        """Wait until the originate queue has room for a call,
+        woken up early when a call of the batch ends
+        """
+        if scheduler.has_room():
+            return
+        self.log.debug("BulkCall Batch %s waiting for originate queue room at line %d" \
+                                % (self.batch_id, self.read))
+        while not scheduler.has_room():
+            self._slot.clear()
+            self._slot.wait(QUEUE_FULL_WAIT)
+
+    def notify_end(self, cause):
+        self.ended += 1
+        self.last_ended = time.time()
+        self.causes[cause] = self.causes.get(cause, 0) + 1
+        self._slot.set()
+
+    def get_status(self):
+        return {'BatchID': self.batch_id,
+                'Total': self.total,
+                'Invalid': self.invalid,
+                'Failed': self.failed,
+                'Rejected': self.rejected,
+                'Requested': self.created,
+                'InProgress': self.get_outstanding(),
+                'Ended': self.ended,
+                'HangupCauses': self.causes,
+                'Errors': [ {'Line': line, 'Error': error}
+                            for line, error in self.errors ],
+                'Done': self.is_done(),
+                'Elapsed': round(time.time() - self.started, 3)}
+
+
+def purge_batches(batches):
+    """Drop batches done for more than BATCH_TTL seconds
+    """
+    expired = time.time() - BATCH_TTL
+    for batch_id, batch in batches.items():
+        if batch.is_done() and max(batch.finished, batch.last_ended) < expired:
+            del batches[batch_id]
@@ -2,7 +2,12 @@
 # Copyright (c) 2011 Plivo Team. See LICENSE for details
 
 import base64
+from collections import OrderedDict
+from hashlib import sha1
+from email.utils import parsedate_tz, mktime_tz
 import re
+import shutil
+import time
 import uuid
 import os
 import os.path
@@ -12,6 +17,10 @@ import urllib2
 import urlparse
 import traceback
 
+import gevent
+from gevent.coros import Semaphore
+from gevent.event import AsyncResult, Event
+from gevent.pool import Pool
 import redis
 import redis.exceptions
 import flask
@@ -27,7 +36,9 @@ except ImportError:
     _md5 = md5.new
 
 from plivo.rest.freeswitch.helpers import is_valid_url, get_conf_value, \
-                                            get_post_param, get_http_param
+                                            get_post_param, get_http_param, \
+                                            get_shared_file_name, run_command
+from plivo.rest.freeswitch.cachestats import CacheStats
 
 MIME_TYPES = {'audio/mpeg': 'mp3',
               'audio/x-wav': 'wav',
@@ -35,12 +46,27 @@ MIME_TYPES = {'audio/mpeg': 'mp3',
               'application/x-jsgf': 'jsgf',
              }
 
+# pre-transcoded variants of cached audio files, name: sample rate
+VARIANTS = {'8k': 8000,
+            '16k': 16000,
+           }
+
+VARIANT_FILE_RE = re.compile(r'^([\w\-=]+)\.(\w+)\.wav$')
+
+# redis sorted sets of resource keys scored by access, by eviction policy
+EVICTION_POLICIES = {'lru': 'resource_atime',
+                     'lfu': 'resource_hits',
+                    }
+
+# number of entries evicted at once
+EVICTION_BATCH = 100
+
 
 
 def ip_protect(decorated_func):
-    def wrapper(obj):
+    def wrapper(obj, *args, **kwargs):
         if obj._validate_ip_auth():
-            return decorated_func(obj)
+            return decorated_func(obj, *args, **kwargs)
     wrapper.__name__ = decorated_func.__name__
     wrapper.__doc__ = decorated_func.__doc__
     return wrapper
@@ -51,54 +77,507 @@ class UnsupportedResourceFormat(Exception):
     pass
 
 
+# size of chunks read from origin and sent to clients
+CHUNK_SIZE = 64 * 1024
+
+
+class Download(object):
+    """Download of a resource in progress, written to tmp_path.
+
+    Readers can follow the file while it is being written.
+    headers is set to the resource type once origin answered,
+    done is set to (stream, resource_type) once the file is cached.
+    Both are set to the exception if download failed.
+    published is set once variants and shared files are created.
+    file_path is the blob path once the file is cached.
+    """
+    def __init__(self, resource_key, tmp_path):
+        self.resource_key = resource_key
+        self.tmp_path = tmp_path
+        self.file_path = None
+        self.headers = AsyncResult()
+        self.done = AsyncResult()
+        self.published = Event()
+
+    def set_exception(self, e):
+        if not self.headers.ready():
+            self.headers.set_exception(e)
+        self.done.set_exception(e)
+
+    def follow(self):
+        """Generator of the file chunks while it is being downloaded
+        """
+        try:
+            fd = open(self.tmp_path, 'rb')
+        except IOError:
+            # download just finished and file was moved to its blob
+            self.done.get()
+            fd = open(self.file_path, 'rb')
+        try:
+            while True:
+                chunk = fd.read(CHUNK_SIZE)
+                if chunk:
+                    yield chunk
+                elif self.done.ready():
+                    # raise if download failed
+                    self.done.get()
+                    while True:
+                        chunk = fd.read(CHUNK_SIZE)
+                        if not chunk:
+                            return
+                        yield chunk
+                else:
+                    gevent.sleep(0.02)
+        finally:
+            fd.close()
+
+
+def read_manifest(manifest):
+    """Returns the list of urls in manifest file,
+    one url per line, lines starting with # are ignored
+    """
+    fd = open(manifest, 'r')
+    try:
+        urls = [ line.strip() for line in fd ]
+    finally:
+        fd.close()
+    return [ url for url in urls if url and not url.startswith('#') ]
+
+
+class WarmUp(object):
+    """Preload of urls in cache, downloaded and transcoded
+    at most concurrency at a time, and optionally pinned
+    """
+    def __init__(self, warm_id, cache, urls, concurrency, log, pin=False):
+        self.warm_id = warm_id
+        self.cache = cache
+        self.urls = list(OrderedDict.fromkeys(urls))
+        self.concurrency = max(1, concurrency)
+        self.log = log
+        # pinned resources are never evicted
+        self.pin = pin
+        self.cached = 0
+        self.downloaded = 0
+        self.failed = []
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def done(self):
+        return self.cached + self.downloaded + len(self.failed)
+
+    def start(self):
+        gevent.spawn_raw(self.run)
+
+    def run(self):
+        self.log.info("Cache WarmUp %s -- Started for %d urls" \
+                                % (self.warm_id, len(self.urls)))
+        pool = Pool(self.concurrency)
+        for url in self.urls:
+            pool.spawn(self._warm, url)
+        pool.join()
+        self.finished = time.time()
+        self.log.info("Cache WarmUp %s -- Finished in %.1f s: %d cached, %d downloaded, %d failed" \
+                            % (self.warm_id, self.finished - self.started,
+                               self.cached, self.downloaded, len(self.failed)))
+
+    def _warm(self, url):
+        try:
+            if not is_valid_url(url):
+                raise UnsupportedResourceFormat("Invalid url")
+            resource_key = self.cache.get_resource_key(url)
+            infos = self.cache.get_resource_infos(resource_key)
+            if infos and not self.cache.is_stored(infos):
+                self.cache.delete_resource(resource_key)
+                infos = None
+            if not infos:
+                download = self.cache.start_download(url)
+                download.done.get()
+                download.published.wait()
+                self.downloaded += 1
+            elif self.cache.is_fresh(infos) or self.cache.update_resource(url,
+                            infos.get('etag'), infos.get('last_modified')) is None:
+                self.cached += 1
+            else:
+                self.downloaded += 1
+            if self.pin:
+                self.cache.pin(resource_key)
+        except Exception, e:
+            self.failed.append(url)
+            self.log.warn("Cache WarmUp %s -- %s failed: %s" \
+                                % (self.warm_id, url, str(e)))
+        # report progress every 10%
+        step = max(1, len(self.urls) / 10)
+        if self.done % step == 0 and self.done < len(self.urls):
+            self.log.info("Cache WarmUp %s -- %d/%d urls done" \
+                                % (self.warm_id, self.done, len(self.urls)))
+
+    def get_status(self):
+        if self.finished:
+            elapsed = self.finished - self.started
+        else:
+            elapsed = time.time() - self.started
+        return {'WarmID': self.warm_id,
+                'Total': len(self.urls),
+                'Done': self.done,
+                'Cached': self.cached,
+                'Downloaded': self.downloaded,
+                'Failed': self.failed,
+                'Finished': self.finished is not None,
+                'Elapsed': round(elapsed, 3)}
+
+
+def iter_file(file_path, start=0, length=None):
+    """Generator of chunks of file_path from start for length bytes
+    """
+    fd = open(file_path, 'rb')
+    try:
+        fd.seek(start)
+        while length is None or length > 0:
+            size = CHUNK_SIZE
+            if length is not None:
+                size = min(size, length)
+                length -= size
+            chunk = fd.read(size)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        fd.close()
+
+
+def parse_range(value, size):
+    """Parse a single range Range header 'bytes=start-end'
+
+    Returns (start, end) with end included, None if no valid range
+    or False if range is not satisfiable.
+    """
+    if not value or not value.startswith('bytes='):
+        return None
+    start, sep, end = value[6:].split(',')[0].strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not start:
+            # suffix range, last bytes of file
+            length = int(end)
+            if length <= 0:
+                return False
+            return max(0, size - length), size - 1
+        start = int(start)
+        if end:
+            end = min(int(end), size - 1)
+        else:
+            end = size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, end
+
+
+class MemoryCache(object):
+    """Size bounded LRU of cached files datas kept in process memory.
+
+    Files bigger than max_item_size are never kept in memory.
+    """
+    def __init__(self, max_size=64*1024*1024, max_item_size=None):
+        self.max_size = max_size
+        if max_item_size is None:
+            max_item_size = max_size / 4
+        self.max_item_size = max_item_size
+        self.size = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        try:
+            data = self._items.pop(key)
+        except KeyError:
+            return None
+        # move to most recently used
+        self._items[key] = data
+        return data
+
+    def set(self, key, data):
+        self.delete(key)
+        if not data or len(data) > self.max_item_size:
+            return
+        self._items[key] = data
+        self.size += len(data)
+        # evict least recently used
+        while self.size > self.max_size:
+            _, old = self._items.popitem(last=False)
+            self.size -= len(old)
+
+    def delete(self, key):
+        try:
+            data = self._items.pop(key)
+            self.size -= len(data)
+        except KeyError:
+            pass
+
+    def clear(self):
+        self._items.clear()
+        self.size = 0
+
+
 class ResourceCache(object):
-    """Uses redis cache as a backend for storing cached files infos and datas.
+    """Uses redis cache as a backend for storing cached files infos,
+    file datas are stored on local disk under cache_path
+    and hot files are kept in a memory LRU.
     """
     def __init__(self, redis_host='localhost', redis_port=6379, redis_db=0, redis_pw=None, 
-                 proxy_url=None, http_timeout=60):
+                 proxy_url=None, http_timeout=60,
+                 cache_path='/tmp/plivocache/', memory_size=64*1024*1024,
+                 default_ttl=300, max_downloads=20,
+                 variants=(), transcode_mp3=False, sox='sox', log=None,
+                 shared_path=None, invalidate_urls=(), auth_id='', auth_token='',
+                 max_size=0, max_entries=0, eviction_policy='lru'):
         self.host = redis_host
         self.port = redis_port
         self.db = redis_db
         self.pw = redis_pw
         self.proxy_url = proxy_url
         self.http_timeout = http_timeout
+        self.cache_path = cache_path
+        if not os.path.isdir(self.cache_path):
+            os.makedirs(self.cache_path)
+        self.memory = MemoryCache(memory_size)
+        # ttl used when origin doesn't set Cache-Control or Expires
+        self.default_ttl = default_ttl
+        # resource keys being revalidated in background
+        self._revalidating = set()
+        # downloads in progress by resource key, shared by concurrent requests
+        self._active_downloads = {}
+        # revalidations in progress by flight key
+        self._downloads = {}
+        # max concurrent downloads from origins
+        self._download_slots = Semaphore(max_downloads)
+        # audio variants created with sox when a file is cached
+        self.variants = [ v for v in variants if v in VARIANTS ]
+        self.transcode_mp3 = transcode_mp3
+        self.sox = sox
+        self.log = log
+        # content addressed directory where audio files are published
+        # for FreeSWITCH native file access
+        self.shared_path = shared_path
+        if self.shared_path and not os.path.isdir(self.shared_path):
+            os.makedirs(self.shared_path)
+        # plivo rest servers notified when a cached file changes
+        self.invalidate_urls = list(invalidate_urls or [])
+        self.auth_id = auth_id
+        self.auth_token = auth_token
+        # capacity in bytes and entries, 0 for no limit
+        self.max_size = max_size
+        self.max_entries = max_entries
+        if not eviction_policy in EVICTION_POLICIES:
+            eviction_policy = 'lru'
+        self.eviction_policy = eviction_policy
+        # accesses by resource key, flushed to redis by eviction
+        self._accesses = {}
+        self._evicting = False
+        self.evicted = 0
+        self.evicted_size = 0
+        self.stats = CacheStats()
+        # all redis clients share the same connection pool
+        self.pool = redis.ConnectionPool(host=self.host, port=self.port,
+                                         db=self.db, password=self.pw,
+                                         socket_timeout=5.0)
 
     def get_cx(self):
-        return redis.Redis(host=self.host, port=self.port, db=self.db,
-                            socket_timeout=5.0, password=self.pw)
+        return redis.Redis(connection_pool=self.pool)
+
+    def get_resource_infos(self, resource_key):
+        """Returns the resource infos dict, empty if not cached
+        """
+        start = time.time()
+        infos = self.get_cx().hgetall("resource_key:%s" % resource_key)
+        self.stats.observe('redis', time.time() - start)
+        return infos
+
+    def get_resources_infos(self, resource_keys):
+        """Returns a list of resource infos dicts for resource_keys,
+        fetched in one round trip
+        """
+        start = time.time()
+        pipe = self.get_cx().pipeline(transaction=False)
+        for resource_key in resource_keys:
+            pipe.hgetall("resource_key:%s" % resource_key)
+        infos = pipe.execute()
+        self.stats.observe('redis', time.time() - start)
+        return infos
 
     def get_resource_params(self, url):
         resource_key = self.get_resource_key(url)
-        cx = self.get_cx()
-        if cx.sismember("resource_key", resource_key):
-            resource_type = cx.hget("resource_key:%s" % resource_key, "resource_type")
-            etag = cx.hget("resource_key:%s" % resource_key, "etag")
-            last_modified = cx.hget("resource_key:%s" % resource_key, "last_modified")
-            return resource_key, resource_type, etag, last_modified
-        else:
+        infos = self.get_resource_infos(resource_key)
+        return self._get_params(resource_key, infos)
+
+    def get_resources_params(self, urls):
+        """Batch version of get_resource_params
+        """
+        resource_keys = [ self.get_resource_key(url) for url in urls ]
+        return [ self._get_params(resource_key, infos) for resource_key, infos \
+                in zip(resource_keys, self.get_resources_infos(resource_keys)) ]
+
+    def _get_params(self, resource_key, infos):
+        if not infos:
             return None, None, None, None
+        return resource_key, infos.get("resource_type"), infos.get("etag"), \
+                infos.get("last_modified")
 
-    def update_resource_params(self, resource_key, resource_type, etag, last_modified, buffer):
+    def update_resource_params(self, resource_key, resource_type, etag, last_modified, size,
+                               expires=0, digest='', url=''):
         if etag is None:
             etag = ""
         if last_modified is None:
             last_modified = ""
         cx = self.get_cx()
-        if not cx.sismember("resource_key", resource_key):
-            cx.sadd("resource_key", resource_key)
-        cx.hset("resource_key:%s" % resource_key, "resource_type", resource_type)
-        cx.hset("resource_key:%s" % resource_key, "etag", etag)
-        cx.hset("resource_key:%s" % resource_key, "last_modified", last_modified)
-        cx.hset("resource_key:%s" % resource_key, "file", buffer)
-        cx.hset("resource_key:%s" % resource_key, "last_update_time", str(datetime.now().strftime('%s')))
+        old_digest = cx.hget("resource_key:%s" % resource_key, "digest")
+        pipe = cx.pipeline(transaction=False)
+        pipe.sadd("resource_key", resource_key)
+        pipe.hmset("resource_key:%s" % resource_key, {
+                        "resource_type": resource_type,
+                        "etag": etag,
+                        "last_modified": last_modified,
+                        "size": size,
+                        "expires": expires,
+                        "digest": digest,
+                        # to invalidate lookups of url once deleted
+                        "url": url,
+                        # set once file is transcoded and published
+                        "variants": "",
+                        "shared": "",
+                        "last_update_time": str(datetime.now().strftime('%s'))
+                   })
+        # file datas are not stored in redis anymore
+        pipe.hdel("resource_key:%s" % resource_key, "file")
+        # blob reference is added by store_resource
+        if digest:
+            # variants size is added once transcoded
+            pipe.hsetnx("blob_sizes", digest, size)
+        if old_digest and old_digest != digest:
+            pipe.srem("blob_refs:%s" % old_digest, resource_key)
+        pipe.execute_command('ZADD', 'resource_atime', time.time(), resource_key)
+        pipe.execute_command('ZINCRBY', 'resource_hits', 0, resource_key)
+        pipe.execute()
+        if old_digest and old_digest != digest:
+            self.release_blob(old_digest)
+
+    def touch_resource(self, resource_key, expires):
+        self.get_cx().hset("resource_key:%s" % resource_key, "expires", expires)
 
     def delete_resource(self, resource_key):
+        self.delete_resources([resource_key])
+
+    def delete_resources(self, resource_keys):
         cx = self.get_cx()
-        if cx.sismember("resource_key", resource_key):
-            cx.srem("resource_key", resource_key)
-            cx.delete("resource_key:%s" % resource_key)
+        pipe = cx.pipeline(transaction=False)
+        for resource_key in resource_keys:
+            pipe.hget("resource_key:%s" % resource_key, "digest")
+            pipe.hget("resource_key:%s" % resource_key, "url")
+        results = pipe.execute()
+        digests, urls = results[0::2], results[1::2]
+        for resource_key, digest in zip(resource_keys, digests):
+            pipe.srem("resource_key", resource_key)
+            pipe.delete("resource_key:%s" % resource_key)
+            pipe.zrem("resource_atime", resource_key)
+            pipe.zrem("resource_hits", resource_key)
+            if digest:
+                pipe.srem("blob_refs:%s" % digest, resource_key)
+        pipe.execute()
+        for digest in set(digests):
+            if digest:
+                self.release_blob(digest)
+        for resource_key in resource_keys:
+            self.delete_legacy_file(resource_key)
+        # resources cached without their url are dropped
+        # from lookups memos once expired
+        urls = [ url for url in urls if url ]
+        if urls:
+            self.invalidate_many(urls)
 
-    def cache_resource(self, url):
+    def release_blob(self, digest):
+        """Delete blob files, variants and shared files
+        if no resource references the blob anymore
+
+        The blob keys are deleted in a transaction watching blob_refs,
+        aborted if store_resource adds a reference meanwhile. The blob
+        file is moved away before, so a reference added after the
+        transaction never finds the blob being deleted.
+
+        Returns True if blob was deleted
+        """
+        refs_key = "blob_refs:%s" % digest
+        blob_path = self.get_blob_path(digest)
+        trash_path = '%s.%s.del' % (blob_path, uuid.uuid1())
+        pipe = self.get_cx().pipeline()
+        try:
+            pipe.watch(refs_key)
+            if pipe.scard(refs_key):
+                return False
+            resource_type = pipe.hget("blob:%s" % digest, "resource_type")
+            try:
+                os.rename(blob_path, trash_path)
+            except OSError:
+                trash_path = None
+            pipe.multi()
+            pipe.delete("blob:%s" % digest)
+            pipe.delete(refs_key)
+            pipe.hdel("blob_sizes", digest)
+            try:
+                pipe.execute()
+            except redis.exceptions.WatchError:
+                # referenced again, restore the blob
+                if trash_path:
+                    os.rename(trash_path, blob_path)
+                return False
+        finally:
+            pipe.reset()
+        self.memory.delete(digest)
+        file_paths = [ self.get_variant_path(digest, variant) \
+                        for variant in VARIANTS ]
+        if trash_path:
+            file_paths.append(trash_path)
+        if self.shared_path:
+            file_paths += [ self.get_shared_file_path(digest, '.%s.wav' % variant) \
+                            for variant in VARIANTS ]
+            if resource_type:
+                file_paths.append(self.get_shared_file_path(digest, '.%s' % resource_type))
+        for file_path in file_paths:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+        return True
+
+    def delete_legacy_file(self, resource_key):
+        """Delete file cached by url before content addressed storage
+        """
+        file_path = os.path.join(self.cache_path, resource_key)
+        file_paths = [ '%s.%s.wav' % (file_path, variant) for variant in VARIANTS ]
+        file_paths.append(file_path)
+        for file_path in file_paths:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+    def get_blob_path(self, digest):
+        return os.path.join(self.cache_path, 'blobs', get_shared_file_name(digest, ''))
+
+    def is_stored(self, infos):
+        """Check the blob of resource infos is on disk
+        """
+        digest = infos.get('digest')
+        return bool(digest) and os.path.isfile(self.get_blob_path(digest))
+
+    def get_variant_path(self, digest, variant):
+        return '%s.%s.wav' % (self.get_blob_path(digest), variant)
+
+    def get_tmp_path(self, resource_key):
+        return '%s.%s.tmp' % (os.path.join(self.cache_path, resource_key), uuid.uuid1())
+
+    def open_url(self, url, headers={}):
         if self.proxy_url is not None:
             proxy = urllib2.ProxyHandler({'http': self.proxy_url})
             opener = urllib2.build_opener(proxy)
@@ -106,7 +585,186 @@ class ResourceCache(object):
         request = urllib2.Request(url)
         user_agent = 'Mozilla/5.0 (X11; Linux i686) AppleWebKit/535.1 (KHTML, like Gecko) Chrome/14.0.835.35 Safari/535.1'
         request.add_header('User-Agent', user_agent)
-        handler = urllib2.urlopen(request, timeout=self.http_timeout)
+        for k, v in headers.iteritems():
+            request.add_header(k, v)
+        return urllib2.urlopen(request, timeout=self.http_timeout)
+
+    def cache_resource(self, url):
+        return self.start_download(url).done.get()
+
+    def start_download(self, url):
+        """Start downloading url in background and return the Download,
+        or return the Download of url already in progress
+        """
+        resource_key = self.get_resource_key(url)
+        try:
+            download = self._active_downloads[resource_key]
+            self.stats.incr('coalesced_downloads')
+            return download
+        except KeyError:
+            pass
+        download = Download(resource_key, self.get_tmp_path(resource_key))
+        self._active_downloads[resource_key] = download
+        gevent.spawn_raw(self._download, url, download)
+        return download
+
+    def _download(self, url, download):
+        self._download_slots.acquire()
+        try:
+            start = time.time()
+            try:
+                handler = self.open_url(url)
+                stream, resource_type, digest = self.store_resource(url, handler, download)
+            except Exception, e:
+                self.stats.incr('download_errors')
+                self.stats.observe_origin(url, time.time() - start, error=True)
+                download.set_exception(e)
+                return
+            elapsed = time.time() - start
+            size = os.path.getsize(download.file_path)
+            self.stats.incr('downloads')
+            self.stats.incr('download_bytes', size)
+            self.stats.observe('download', elapsed)
+            self.stats.observe_origin(url, elapsed, size)
+            download.done.set((stream, resource_type))
+            try:
+                start = time.time()
+                self.publish(download.resource_key, resource_type, digest)
+                self.stats.observe('publish', time.time() - start)
+            except Exception, e:
+                self.stats.incr('publish_errors')
+                if self.log:
+                    self.log.error("Cache -- Publishing %s failed: %s" % (url, str(e)))
+            self.invalidate(url)
+        finally:
+            download.published.set()
+            self._download_slots.release()
+            del self._active_downloads[download.resource_key]
+
+    def publish(self, resource_key, resource_type, digest):
+        """Create the variants of the blob of a cached file
+        and publish them to the shared path, once by blob
+        """
+        cx = self.get_cx()
+        blob = cx.hgetall("blob:%s" % digest)
+        if blob.get('published'):
+            variants = [ v for v in blob.get('variants', '').split(',') if v ]
+            shared = blob.get('shared', '')
+        else:
+            variants = self.transcode(digest, resource_type)
+            shared = ''
+            if self.shared_path and resource_type in ('wav', 'mp3'):
+                self.materialize(digest, resource_type, variants)
+                shared = '1'
+            cx.hmset("blob:%s" % digest, {'resource_type': resource_type,
+                                          'variants': ','.join(variants),
+                                          'shared': shared,
+                                          'published': '1'})
+        cx.hmset("resource_key:%s" % resource_key, {'variants': ','.join(variants),
+                                                    'shared': shared})
+
+    def get_shared_file_path(self, digest, suffix):
+        return os.path.join(self.shared_path, get_shared_file_name(digest, suffix))
+
+    def materialize(self, digest, resource_type, variants):
+        """Publish the blob and its variants to the shared path
+        as <digest>.<type> and <digest>.<variant>.wav
+
+        Files are linked if possible, else copied.
+        Files are never modified once published as they are named by content.
+        """
+        files = [ (self.get_blob_path(digest), '.%s' % resource_type) ]
+        for variant in variants:
+            files.append((self.get_variant_path(digest, variant),
+                          '.%s.wav' % variant))
+        for file_path, suffix in files:
+            shared_file_path = self.get_shared_file_path(digest, suffix)
+            if os.path.isfile(shared_file_path):
+                continue
+            shared_dir = os.path.dirname(shared_file_path)
+            if not os.path.isdir(shared_dir):
+                try:
+                    os.makedirs(shared_dir)
+                except OSError:
+                    # created by another greenlet
+                    pass
+            tmp_path = '%s.%s.tmp' % (shared_file_path, uuid.uuid1())
+            try:
+                os.link(file_path, tmp_path)
+            except OSError:
+                # not on the same filesystem
+                shutil.copyfile(file_path, tmp_path)
+            os.rename(tmp_path, shared_file_path)
+
+    def transcode(self, digest, resource_type):
+        """Create the variants of a blob as mono 16 bits wav
+        so FreeSWITCH can play them without any transcoding process.
+
+        Returns the list of created variants
+        """
+        if resource_type != 'wav' and \
+            not (resource_type == 'mp3' and self.transcode_mp3):
+            return []
+        file_path = self.get_blob_path(digest)
+        variants = []
+        for variant in self.variants:
+            variant_path = self.get_variant_path(digest, variant)
+            tmp_path = '%s.%s.tmp' % (variant_path, uuid.uuid1())
+            args = [self.sox, '-q', '-t', resource_type, file_path,
+                    '-t', 'wav', '-r', str(VARIANTS[variant]), '-c', '1',
+                    '-b', '16', '-e', 'signed-integer', tmp_path]
+            try:
+                code = run_command(args)
+            except Exception, e:
+                code = str(e)
+            if code == 0:
+                os.rename(tmp_path, variant_path)
+                variants.append(variant)
+                continue
+            if self.log:
+                self.log.warn("Cache -- Cannot create %s variant for %s: %s" \
+                                            % (variant, digest, code))
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        size = 0
+        for variant in variants:
+            size += os.path.getsize(self.get_variant_path(digest, variant))
+        if size:
+            self.get_cx().hincrby("blob_sizes", digest, size)
+        return variants
+
+    def single_flight(self, flight_key, func, *args):
+        """Run func(*args) unless a download with the same flight_key
+        is in progress: then wait and share its result or error.
+        """
+        try:
+            return self._downloads[flight_key].get()
+        except KeyError:
+            pass
+        result = AsyncResult()
+        self._downloads[flight_key] = result
+        try:
+            self._download_slots.acquire()
+            try:
+                value = func(*args)
+            finally:
+                self._download_slots.release()
+            result.set(value)
+            return value
+        except Exception, e:
+            result.set_exception(e)
+            raise
+        finally:
+            del self._downloads[flight_key]
+
+    def store_resource(self, url, handler, download=None):
+        """Write origin response to cache by chunks
+
+        Returns (stream, resource_type), stream is None
+        if file is too big to be kept in memory.
+        """
         try:
             resource_type = MIME_TYPES[handler.headers.get('Content-Type')]
             if not resource_type:
@@ -115,52 +773,445 @@ class ResourceCache(object):
             raise UnsupportedResourceFormat("Resource format not supported")
         etag = handler.headers.get('ETag')
         last_modified = handler.headers.get('Last-Modified')
+        expires = self.get_expires(handler.headers)
         resource_key = self.get_resource_key(url)
-        stream = handler.read()
-        self.update_resource_params(resource_key, resource_type, etag, last_modified, stream)
-        return stream, resource_type
+        # write to a temp file first so readers never see a partial file
+        if download:
+            tmp_path = download.tmp_path
+        else:
+            tmp_path = self.get_tmp_path(resource_key)
+        fd = open(tmp_path, 'wb')
+        if download:
+            download.headers.set(resource_type)
+        size = 0
+        digest = sha1()
+        added_ref = False
+        chunks = []
+        try:
+            try:
+                while True:
+                    chunk = handler.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    fd.write(chunk)
+                    fd.flush()
+                    size += len(chunk)
+                    digest.update(chunk)
+                    # only keep datas small enough for memory cache
+                    if chunks is not None:
+                        if size > self.memory.max_item_size:
+                            chunks = None
+                        else:
+                            chunks.append(chunk)
+            finally:
+                fd.close()
+            digest = digest.hexdigest()
+            # reference the blob before checking it is on disk,
+            # so release_blob cannot delete it after the check
+            added_ref = self.get_cx().sadd("blob_refs:%s" % digest, resource_key)
+            file_path = self.get_blob_path(digest)
+            if os.path.isfile(file_path):
+                # same content already cached from another url
+                os.remove(tmp_path)
+                self.stats.incr('dedup_hits')
+            else:
+                blob_dir = os.path.dirname(file_path)
+                if not os.path.isdir(blob_dir):
+                    try:
+                        os.makedirs(blob_dir)
+                    except OSError:
+                        # created by another greenlet
+                        pass
+                os.rename(tmp_path, file_path)
+        except:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            if added_ref:
+                self.get_cx().srem("blob_refs:%s" % digest, resource_key)
+                self.release_blob(digest)
+            raise
+        if download:
+            download.file_path = file_path
+        stream = None
+        if chunks is not None:
+            stream = ''.join(chunks)
+            self.memory.set(digest, stream)
+        self.update_resource_params(resource_key, resource_type, etag, last_modified, size,
+                                    expires, digest, url)
+        return stream, resource_type, digest
 
-    def get_stream(self, resource_key):
-        stream = self.get_cx().hget("resource_key:%s" % resource_key, "file")
-        resource_type = self.get_cx().hget("resource_key:%s" % resource_key, "resource_type")
-        return stream, resource_type
+    def get_stream(self, digest):
+        """Returns (stream, file_path) for the blob of a cached resource
+
+        stream is the file datas if the file is in memory, else None
+        and the file must be served from file_path.
+        file_path is None if the file is not on disk anymore.
+        """
+        if not digest:
+            return None, None
+        stream = self.memory.get(digest)
+        file_path = self.get_blob_path(digest)
+        if stream is not None:
+            self.stats.incr('memory_hits')
+            return stream, file_path
+        if not os.path.isfile(file_path):
+            return None, None
+        # promote file to memory if small enough
+        if os.path.getsize(file_path) <= self.memory.max_item_size:
+            fd = open(file_path, 'rb')
+            try:
+                stream = fd.read()
+            finally:
+                fd.close()
+            self.memory.set(digest, stream)
+        return stream, file_path
 
     def get_resource_key(self, url):
         return base64.urlsafe_b64encode(_md5(url).digest())
 
-    def is_resource_updated(self, url, etag, last_modified):
-        no_change = (False, None, None)
+    def get_expires(self, headers):
+        """Returns the timestamp until a resource is fresh
+        from Cache-Control max-age or Expires headers
+        else from default ttl
+        """
+        now = int(time.time())
+        cache_control = headers.get('Cache-Control') or ''
+        for directive in cache_control.lower().split(','):
+            directive = directive.strip()
+            if directive in ('no-cache', 'no-store'):
+                return now
+            if directive.startswith('max-age='):
+                try:
+                    return now + int(directive[8:])
+                except ValueError:
+                    pass
+        expires = headers.get('Expires')
+        if expires:
+            expires = parsedate_tz(expires)
+            if expires:
+                return mktime_tz(expires)
+            return now
+        return now + self.default_ttl
+
+    def is_fresh(self, infos):
+        try:
+            return int(infos.get('expires') or 0) > time.time()
+        except ValueError:
+            return False
+
+    def update_resource(self, url, etag, last_modified):
+        """Conditional download of a cached resource
+
+        Returns (stream, resource_type) if resource was downloaded again,
+        None if resource has not changed.
+        """
+        return self.single_flight('update:%s' % self.get_resource_key(url),
+                                  self._update_resource, url, etag, last_modified)
+
+    def _update_resource(self, url, etag, last_modified):
+        headers = {}
         # if no ETag, then check for 'Last-Modified' header
-        if etag is not None and etag != "":
-            request = urllib2.Request(url)
-            request.add_header('If-None-Match', etag)
-        elif last_modified is not None and last_modified != "":
-            request = urllib2.Request(url)
-            request.add_header('If-Modified-Since', last_modified)
-        else:
-            return no_change
+        if etag:
+            headers['If-None-Match'] = etag
+        elif last_modified:
+            headers['If-Modified-Since'] = last_modified
+        start = time.time()
         try:
-            second_try = urllib2.urlopen(request)
+            handler = self.open_url(url, headers)
         except urllib2.HTTPError, e:
             # if http code is 304, no change
             if e.code == 304:
-                return no_change
-        return True, etag, last_modified
+                self.stats.incr('revalidations_not_modified')
+                self.stats.observe('revalidate', time.time() - start)
+                self.touch_resource(self.get_resource_key(url),
+                                    self.get_expires(e.hdrs))
+                return None
+            raise
+        stream, resource_type, digest = self.store_resource(url, handler)
+        self.stats.incr('revalidations_updated')
+        self.stats.observe('revalidate', time.time() - start)
+        self.publish(self.get_resource_key(url), resource_type, digest)
+        self.invalidate(url)
+        return stream, resource_type
+
+    def invalidate(self, url):
+        """Notify plivo rest servers in background that url changed,
+        all urls if url is None
+        """
+        self.invalidate_many([url] if url else [])
+
+    def invalidate_many(self, urls):
+        """Notify plivo rest servers in background that urls changed,
+        in one request by server, all urls if urls is empty
+        """
+        for invalidate_url in self.invalidate_urls:
+            gevent.spawn_raw(self._invalidate, invalidate_url, urls)
+
+    def _invalidate(self, invalidate_url, urls):
+        try:
+            params = [ ('Url', url) for url in urls ] or [('Url', '')]
+            request = urllib2.Request(invalidate_url, urllib.urlencode(params))
+            if self.auth_id and self.auth_token:
+                auth = base64.encodestring('%s:%s' % (self.auth_id,
+                                           self.auth_token)).replace('\n', '')
+                request.add_header('Authorization', 'Basic %s' % auth)
+            urllib2.urlopen(request, timeout=self.http_timeout).read()
+        except Exception, e:
+            if self.log:
+                self.log.warn("Cache -- Invalidating %s on %s failed: %s" \
+                                        % (', '.join(urls) or 'all urls',
+                                           invalidate_url, str(e)))
+
+    def record_access(self, resource_key):
+        """Count an access to resource, kept in memory
+        until next eviction run
+        """
+        self._accesses[resource_key] = self._accesses.get(resource_key, 0) + 1
+
+    def flush_accesses(self):
+        accesses, self._accesses = self._accesses, {}
+        if not accesses:
+            return
+        now = time.time()
+        pipe = self.get_cx().pipeline(transaction=False)
+        for resource_key, count in accesses.iteritems():
+            pipe.execute_command('ZADD', 'resource_atime', now, resource_key)
+            pipe.execute_command('ZINCRBY', 'resource_hits', count, resource_key)
+        pipe.execute()
+
+    def pin(self, resource_key):
+        """Never evict resource
+        """
+        self.get_cx().sadd("resource_pinned", resource_key)
+
+    def clear_pinned(self):
+        self.get_cx().delete("resource_pinned")
+
+    def get_usage(self):
+        """Returns (entries, size in bytes, pinned entries)
+
+        size is the size of blobs and their variants,
+        shared by all resources with the same content
+        """
+        pipe = self.get_cx().pipeline(transaction=False)
+        pipe.scard("resource_key")
+        pipe.hvals("blob_sizes")
+        pipe.scard("resource_pinned")
+        entries, sizes, pinned = pipe.execute()
+        return entries, sum([ int(size) for size in sizes ]), pinned
+
+    def index_resources(self):
+        """Add accounting of resources cached before eviction was set,
+        drop resources cached before content addressed storage
+        """
+        cx = self.get_cx()
+        resource_keys = list(cx.smembers("resource_key"))
+        pipe = cx.pipeline(transaction=False)
+        for resource_key in resource_keys:
+            pipe.zscore("resource_hits", resource_key)
+            pipe.hget("resource_key:%s" % resource_key, "digest")
+        results = pipe.execute()
+        legacy = []
+        for i, resource_key in enumerate(resource_keys):
+            indexed, digest = results[2*i], results[2*i+1]
+            if not digest or not os.path.isfile(self.get_blob_path(digest)):
+                legacy.append(resource_key)
+                continue
+            if indexed is not None:
+                continue
+            pipe.sadd("blob_refs:%s" % digest, resource_key)
+            # oldest and least used
+            pipe.execute_command('ZADD', 'resource_atime', 0, resource_key)
+            pipe.execute_command('ZINCRBY', 'resource_hits', 0, resource_key)
+        pipe.execute()
+        if legacy:
+            self.delete_resources(legacy)
+
+    def is_full(self, entries, size):
+        return (self.max_entries and entries > self.max_entries) \
+                or (self.max_size and size > self.max_size)
+
+    def evict(self):
+        """Evict least recently (lru) or least frequently (lfu) used
+        resources until cache is under max_size and max_entries.
+        Pinned resources and downloads in progress are never evicted.
+
+        Evicts EVICTION_BATCH resources at a time and lets
+        other greenlets run between batches.
+        Returns the number of evicted resources
+        """
+        self.flush_accesses()
+        entries, size, pinned = self.get_usage()
+        if not self.is_full(entries, size):
+            return 0
+        cx = self.get_cx()
+        pinned = cx.smembers("resource_pinned")
+        zset = EVICTION_POLICIES[self.eviction_policy]
+        evicted = 0
+        skipped = 0
+        while self.is_full(entries, size):
+            candidates = cx.zrange(zset, skipped, skipped + EVICTION_BATCH - 1)
+            if not candidates:
+                break
+            pipe = cx.pipeline(transaction=False)
+            for resource_key in candidates:
+                pipe.hget("resource_key:%s" % resource_key, "digest")
+            digests = pipe.execute()
+            # blob size is freed once its last resource is evicted
+            blobs = [ digest for digest in set(digests) if digest ]
+            for digest in blobs:
+                pipe.scard("blob_refs:%s" % digest)
+                pipe.hget("blob_sizes", digest)
+            results = pipe.execute()
+            refs = dict(zip(blobs, results[0::2]))
+            blob_sizes = dict(zip(blobs, [ int(r or 0) for r in results[1::2] ]))
+            victims = []
+            for resource_key, digest in zip(candidates, digests):
+                if not digest:
+                    # resource was already deleted
+                    victims.append(resource_key)
+                    continue
+                if resource_key in pinned or resource_key in self._active_downloads:
+                    skipped += 1
+                    continue
+                if not self.is_full(entries, size):
+                    break
+                victims.append(resource_key)
+                entries -= 1
+                evicted += 1
+                refs[digest] -= 1
+                if refs[digest] <= 0:
+                    size -= blob_sizes[digest]
+                    self.evicted_size += blob_sizes[digest]
+            if victims:
+                self.delete_resources(victims)
+            gevent.sleep(0)
+        self.evicted += evicted
+        if evicted and self.log:
+            self.log.info("Cache -- Evicted %d resources (%s), %d resources, %d bytes left" \
+                            % (evicted, self.eviction_policy, entries, size))
+        return evicted
+
+    def start_eviction(self, interval):
+        if self._evicting:
+            return
+        self._evicting = True
+        gevent.spawn_raw(self._evict_loop, interval)
+
+    def stop_eviction(self):
+        self._evicting = False
+
+    def _evict_loop(self, interval):
+        try:
+            self.index_resources()
+        except Exception, e:
+            if self.log:
+                self.log.error("Cache -- Indexing resources failed: %s" % str(e))
+        while self._evicting:
+            gevent.sleep(interval)
+            if not self._evicting:
+                break
+            try:
+                self.evict()
+            except Exception, e:
+                if self.log:
+                    self.log.error("Cache -- Eviction failed: %s" % str(e))
+
+    def revalidate(self, url, etag, last_modified, log):
+        """Revalidate a stale resource in background
+        """
+        resource_key = self.get_resource_key(url)
+        if resource_key in self._revalidating:
+            return
+        self._revalidating.add(resource_key)
+        gevent.spawn_raw(self._revalidate, resource_key, url, etag,
+                         last_modified, log)
+
+    def _revalidate(self, resource_key, url, etag, last_modified, log):
+        try:
+            if self.update_resource(url, etag, last_modified) is None:
+                log.debug("Cache -- %s not modified" % url)
+            else:
+                log.debug("Cache -- Updated Cached %s" % url)
+        except Exception, e:
+            self.stats.incr('revalidation_errors')
+            log.error("Cache -- Revalidating %s failed: %s" % (url, str(e)))
+        finally:
+            self._revalidating.discard(resource_key)
 
 
 def get_resource_type(server, url):
-    resource_type = None
-    resource_key, resource_type, etag, last_modified = server.cache.get_resource_params(url)
-    if resource_type:
-        return resource_type
+    """Returns (resource_type, variants, digest)
+
+    digest is only set if resource is published in shared path
+    """
+    resource_key = server.cache.get_resource_key(url)
+    infos = server.cache.get_resource_infos(resource_key)
+    if infos.get('resource_type'):
+        server.cache.record_access(resource_key)
+        server.cache.stats.incr('hits')
+        return _get_type_infos(infos)
     full_file_name, stream, resource_type = get_resource(server, url)
-    return resource_type
+    return resource_type, [], ''
+
+def _get_type_infos(infos):
+    variants = [ v for v in infos.get('variants', '').split(',') if v ]
+    digest = ''
+    if infos.get('shared'):
+        digest = infos.get('digest', '')
+    return infos['resource_type'], variants, digest
+
+def get_resources_types(server, urls):
+    """Batch version of get_resource_type, returns a dict
+    url: (resource_type, variants, digest)
+
+    Cached infos are fetched in one redis round trip and
+    uncached urls are downloaded concurrently,
+    up to MAX_DOWNLOADS at a time.
+    """
+    results = {}
+    urls = [ url for url in set(urls) if is_valid_url(url) ]
+    resource_keys = [ server.cache.get_resource_key(url) for url in urls ]
+    downloads = []
+    for url, resource_key, infos in zip(urls, resource_keys,
+                            server.cache.get_resources_infos(resource_keys)):
+        if infos.get('resource_type'):
+            server.cache.record_access(resource_key)
+            server.cache.stats.incr('hits')
+            results[url] = _get_type_infos(infos)
+        else:
+            server.cache.stats.incr('misses')
+            server.log.info("Cache -- %s not found. Downloading" % url)
+            downloads.append((url, server.cache.start_download(url)))
+    # all downloads are started, wait for their types
+    for url, download in downloads:
+        try:
+            resource_type = download.headers.get()
+        except UnsupportedResourceFormat:
+            server.cache.stats.incr('unsupported')
+            server.log.error("Cache -- Ignoring Unsupported File at - %s" % url)
+            resource_type = None
+        except Exception, e:
+            server.cache.stats.incr('errors')
+            server.log.error("Cache -- Downloading %s failed: %s" % (url, str(e)))
+            resource_type = None
+        results[url] = (resource_type, [], '')
+    return results
 
 def get_resource(server, url):
+    """Returns (file_path, stream, resource_type)
+
+    For a cached resource, file_path is the local cached file
+    and stream the file datas if the file is in memory (else None).
+    If resource is being downloaded, stream is the Download.
+    If resource can't be cached, resource_type is None.
+    """
     if not url:
         return url
     full_file_name = url
-    stream = ''
+    stream = None
     resource_type = None
 
     if server.cache is not None:
@@ -171,34 +1222,50 @@ def get_resource(server, url):
 
         rk = server.cache.get_resource_key(url)
         server.log.debug("Cache -- Resource key %s for %s" % (rk, url))
+        stats = server.cache.stats
+        start = time.time()
         try:
-            resource_key, resource_type, etag, last_modified = server.cache.get_resource_params(url)
-            if resource_key is None:
+            infos = server.cache.get_resource_infos(rk)
+            file_path = None
+            if infos:
+                stream, file_path = server.cache.get_stream(infos.get('digest'))
+                if file_path is None:
+                    server.log.warn("Cache -- %s file is missing" % url)
+                    server.cache.delete_resource(rk)
+                    infos = None
+            if not infos:
                 server.log.info("Cache -- %s not found. Downloading" % url)
+                stats.incr('misses')
                 try:
-                    stream, resource_type = server.cache.cache_resource(url)
+                    # stream is the download in progress
+                    stream = server.cache.start_download(url)
+                    resource_type = stream.headers.get()
                 except UnsupportedResourceFormat:
+                    stats.incr('unsupported')
+                    resource_type = None
                     server.log.error("Cache -- Ignoring Unsupported File at - %s" % url)
             else:
-                server.log.debug("Cache -- Checking if %s source is newer" % url)
-                updated, new_etag, new_last_modified = server.cache.is_resource_updated(url, etag, last_modified)
-                if not updated:
+                resource_type = infos.get('resource_type')
+                server.cache.record_access(rk)
+                if server.cache.is_fresh(infos):
+                    stats.incr('hits')
                     server.log.debug("Cache -- Using Cached %s" % url)
-                    stream, resource_type = server.cache.get_stream(resource_key)
                 else:
-                    server.log.debug("Cache -- Updating Cached %s" % url)
-                    try:
-                        stream, resource_type = server.cache.cache_resource(url)
-                    except UnsupportedResourceFormat:
-                        server.log.error("Cache -- Ignoring Unsupported File at - %s" % url)
+                    # serve stale file now and revalidate in background
+                    stats.incr('stale_hits')
+                    server.log.debug("Cache -- Using Stale Cached %s, revalidating" % url)
+                    server.cache.revalidate(url, infos.get('etag'),
+                                            infos.get('last_modified'), server.log)
+            stats.observe('lookup', time.time() - start)
+            if resource_type:
+                return (file_path, stream, resource_type)
         except Exception, e:
+            stats.incr('errors')
+            resource_type = None
             server.log.error("Cache -- Failure !")
             [ server.log.debug('Cache -- Error: %s' % line) for line in \
                             traceback.format_exc().splitlines() ]
 
-    if stream:
-        return (full_file_name, stream, resource_type)
-
     if full_file_name[:7].lower() == "http://":
         audio_path = full_file_name[7:]
         full_file_name = "shout://%s" % audio_path
@@ -206,14 +1273,20 @@ def get_resource(server, url):
         audio_path = full_file_name[8:]
         full_file_name = "shout://%s" % audio_path
 
-    return (full_file_name, stream, resource_type)
+    return (full_file_name, None, None)
+
 
 
+# max number of warm ups kept for status queries
+MAX_WARMUPS = 20
+
 
 class PlivoCacheApi(object):
     _config = None
     log = None
     allowed_ips = []
+    warm_concurrency = 5
+    warmups = None
 
     def _validate_ip_auth(self):
         """Verify request is from allowed ips
@@ -237,9 +1310,11 @@ class PlivoCacheApi(object):
             self.log.debug("No Url")
             return "NO URL", 404
         self.log.debug("Url is %s" % str(url))
+        self.cache.stats.incr('requests')
+        start = time.time()
         try:
             file_path, stream, resource_type = get_resource(self, url)
-            if not stream:
+            if not resource_type:
                 self.log.debug("Url %s: no stream" % str(url))
                 return "NO STREAM", 404
             if resource_type == 'mp3':
@@ -253,16 +1328,97 @@ class PlivoCacheApi(object):
             else:
                 self.log.debug("Url %s: not supported format" % str(url))
                 return "NOT SUPPORTED FORMAT", 404
-            self.log.debug("Url %s: stream found" % str(url))
-            return flask.Response(response=stream, status=200,
-                                  headers=None, mimetype=_type,
-                                  content_type=_type,
-                                  direct_passthrough=False)
+            if isinstance(stream, Download):
+                # tee the download in progress
+                self.log.debug("Url %s: download in progress" % str(url))
+                return flask.Response(response=self._count_bytes(stream.follow()),
+                                      status=200, mimetype=_type,
+                                      content_type=_type,
+                                      direct_passthrough=True)
+            return self._send_cached(str(url), file_path, stream, _type)
         except Exception, e:
             self.log.error("/Cache/ Error: %s" % str(e))
             [ self.log.error('/Cache/ Error: %s' % line) for line in \
                             traceback.format_exc().splitlines() ]
             raise e
+        finally:
+            # time to response headers, body may still be streaming
+            self.cache.stats.observe('request', time.time() - start)
+
+    def _count_bytes(self, chunks):
+        for chunk in chunks:
+            self.cache.stats.incr('bytes_served', len(chunk))
+            yield chunk
+
+    def _send_cached(self, name, file_path, stream, _type):
+        """Send cached file from stream if in memory else from file_path,
+        handles Range requests
+        """
+        if stream is None:
+            size = os.path.getsize(file_path)
+        else:
+            size = len(stream)
+        byte_range = parse_range(request.headers.get('Range'), size)
+        if byte_range is False:
+            return flask.Response(status=416,
+                        headers={'Content-Range': 'bytes */%d' % size})
+        if byte_range:
+            start, end = byte_range
+            self.cache.stats.incr('range_requests')
+            self.cache.stats.incr('bytes_served', end - start + 1)
+            self.log.debug("Url %s: range %d-%d" % (name, start, end))
+            if stream is None:
+                body = iter_file(file_path, start, end - start + 1)
+            else:
+                body = [stream[start:end+1]]
+            response = flask.Response(response=body, status=206,
+                                      mimetype=_type, content_type=_type,
+                                      direct_passthrough=True)
+            response.headers['Content-Range'] = 'bytes %d-%d/%d' \
+                                                    % (start, end, size)
+            response.headers['Content-Length'] = str(end - start + 1)
+        elif stream is None:
+            # serve from disk, the gevent wsgi server reads the file by
+            # blocks, only X-Sendfile (USE_X_SENDFILE) avoids the copy
+            self.cache.stats.incr('bytes_served', size)
+            self.log.debug("Url %s: file found" % name)
+            response = flask.send_file(file_path, mimetype=_type,
+                                       add_etags=False)
+        else:
+            self.cache.stats.incr('bytes_served', size)
+            self.log.debug("Url %s: stream found" % name)
+            response = flask.Response(response=stream, status=200,
+                                      headers=None, mimetype=_type,
+                                      content_type=_type,
+                                      direct_passthrough=False)
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response
+
+    @ip_protect
+    def do_cache_file(self, filename):
+        """Serve a pre-transcoded variant of a cached file
+        named <resource_key>.<variant>.wav
+        """
+        match = VARIANT_FILE_RE.match(filename)
+        if not match or not match.group(2) in VARIANTS:
+            self.log.debug("Invalid cache file %s" % str(filename))
+            return "NO FILE", 404
+        digest = self.cache.get_resource_infos(match.group(1)).get('digest')
+        if not digest:
+            self.log.debug("Cache file %s not found" % str(filename))
+            return "NO FILE", 404
+        file_path = self.cache.get_variant_path(digest, match.group(2))
+        if not os.path.isfile(file_path):
+            self.log.debug("Cache file %s not found" % str(filename))
+            return "NO FILE", 404
+        self.cache.record_access(match.group(1))
+        try:
+            return self._send_cached(filename, file_path, None, 'audio/wav')
+        except Exception, e:
+            self.log.error("/CacheFile/ Error: %s" % str(e))
+            [ self.log.error('/CacheFile/ Error: %s' % line) for line in \
+                            traceback.format_exc().splitlines() ]
+            raise e
 
     @ip_protect
     def do_cache_type(self):
@@ -272,18 +1428,126 @@ class PlivoCacheApi(object):
             return "NO URL", 404
         self.log.debug("Url is %s" % str(url))
         try:
-            resource_type = get_resource_type(self, url)
+            resource_type, variants, digest = get_resource_type(self, url)
             if not resource_type:
                 self.log.debug("Url %s: no type" % str(url))
                 return "NO TYPE", 404
             self.log.debug("Url %s: type is %s" % (str(url), str(resource_type)))
-            return flask.jsonify(CacheType=resource_type)
+            return flask.jsonify(CacheType=resource_type, Variants=variants,
+                                 ResourceKey=self.cache.get_resource_key(url),
+                                 Digest=digest)
         except Exception, e:
             self.log.error("/CacheType/ Error: %s" % str(e))
             [ self.log.error('/CacheType/ Error: %s' % line) for line in \
                             traceback.format_exc().splitlines() ]
             raise e
 
+    @ip_protect
+    def do_cache_batch(self):
+        """Resolve several urls in one request, urls are set
+        with multiple url params
+        """
+        urls = request.values.getlist('url')
+        if not urls:
+            self.log.debug("No Url")
+            return "NO URL", 404
+        self.log.debug("Urls are %s" % str(urls))
+        try:
+            types = get_resources_types(self, urls)
+            resources = []
+            for url in urls:
+                resource_type, variants, digest = types.get(url, (None, [], ''))
+                resources.append({'Url': url, 'CacheType': resource_type,
+                                  'Variants': variants,
+                                  'ResourceKey': self.cache.get_resource_key(url),
+                                  'Digest': digest})
+            return flask.jsonify(Resources=resources)
+        except Exception, e:
+            self.log.error("/CacheBatch/ Error: %s" % str(e))
+            [ self.log.error('/CacheBatch/ Error: %s' % line) for line in \
+                            traceback.format_exc().splitlines() ]
+            raise e
+
+    def start_warmup(self, urls, pin=False):
+        warm_id = str(uuid.uuid1())
+        warmup = WarmUp(warm_id, self.cache, urls, self.warm_concurrency,
+                        self.log, pin)
+        if self.warmups is None:
+            self.warmups = OrderedDict()
+        self.warmups[warm_id] = warmup
+        while len(self.warmups) > MAX_WARMUPS:
+            self.warmups.popitem(last=False)
+        warmup.start()
+        return warmup
+
+    @ip_protect
+    def do_cache_warm(self):
+        """POST: preload urls set with multiple url params,
+        pinned in cache if Pin is true, returns the WarmID
+        GET: progress of warm up WarmID, or all warm ups
+        """
+        try:
+            if request.method == 'POST':
+                urls = request.values.getlist('url')
+                if not urls:
+                    self.log.debug("No Url")
+                    return "NO URL", 404
+                pin = get_post_param(request, 'Pin') == 'true'
+                warmup = self.start_warmup(urls, pin)
+                return flask.jsonify(Success=True, WarmID=warmup.warm_id,
+                                     Total=len(warmup.urls))
+            warmups = self.warmups or {}
+            warm_id = get_http_param(request, 'WarmID')
+            if warm_id:
+                try:
+                    return flask.jsonify(**warmups[warm_id].get_status())
+                except KeyError:
+                    self.log.debug("WarmUp %s not found" % str(warm_id))
+                    return "NO WARMUP", 404
+            return flask.jsonify(WarmUps=[ w.get_status() for w in warmups.values() ])
+        except Exception, e:
+            self.log.error("/CacheWarm/ Error: %s" % str(e))
+            [ self.log.error('/CacheWarm/ Error: %s' % line) for line in \
+                            traceback.format_exc().splitlines() ]
+            raise e
+
+    @ip_protect
+    def do_cache_usage(self):
+        try:
+            entries, size, pinned = self.cache.get_usage()
+            return flask.jsonify(Entries=entries, Size=size, Pinned=pinned,
+                                 MaxEntries=self.cache.max_entries,
+                                 MaxSize=self.cache.max_size,
+                                 EvictionPolicy=self.cache.eviction_policy,
+                                 Evicted=self.cache.evicted,
+                                 EvictedSize=self.cache.evicted_size)
+        except Exception, e:
+            self.log.error("/CacheUsage/ Error: %s" % str(e))
+            [ self.log.error('/CacheUsage/ Error: %s' % line) for line in \
+                            traceback.format_exc().splitlines() ]
+            raise e
+
+    @ip_protect
+    def do_stats(self):
+        """Cache server stats, as json or as text if format is text
+        """
+        try:
+            entries, size, pinned = self.cache.get_usage()
+            extra = {'entries': entries, 'size': size, 'pinned': pinned,
+                     'evicted': self.cache.evicted,
+                     'evicted_size': self.cache.evicted_size,
+                     'memory_size': self.cache.memory.size,
+                     'active_downloads': len(self.cache._active_downloads)}
+            if get_http_param(request, 'format') == 'text':
+                return flask.Response(self.cache.stats.to_text(extra),
+                                      mimetype='text/plain')
+            return flask.jsonify(**self.cache.stats.to_dict(extra))
+        except Exception, e:
+            self.log.error("/Stats/ Error: %s" % str(e))
+            [ self.log.error('/Stats/ Error: %s' % line) for line in \
+                            traceback.format_exc().splitlines() ]
+            raise e
+
     @ip_protect
     def do_reload_config(self):
         try:
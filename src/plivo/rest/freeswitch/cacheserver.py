@@ -60,13 +60,57 @@ class PlivoCacheServer(PlivoCacheApi):
         self.redis_pw = config.get('cache_server', 'REDIS_PASSWORD', default=None)
         self.proxy_url = config.get('cache_server', 'PROXY_URL', default=None)
         self.http_timeout = int(config.get('cache_server', 'HTTP_TIMEOUT', default=60))
+        self.cache_path = config.get('cache_server', 'CACHE_PATH', default='/tmp/plivocache/')
+        self.memory_cache_size = int(config.get('cache_server', 'MEMORY_CACHE_SIZE', default=64*1024*1024))
+        self.default_ttl = int(config.get('cache_server', 'DEFAULT_TTL', default=300))
+        self.max_downloads = int(config.get('cache_server', 'MAX_DOWNLOADS', default=20))
+        variants = config.get('cache_server', 'TRANSCODE_VARIANTS', default='')
+        self.variants = [ v.strip() for v in variants.split(',') if v.strip() ]
+        self.transcode_mp3 = config.get('cache_server', 'TRANSCODE_MP3', default='false') == 'true'
+        self.sox = config.get('cache_server', 'SOX_PATH', default='sox')
+        self.shared_path = config.get('cache_server', 'SHARED_PATH', default='')
+        invalidate_urls = config.get('cache_server', 'INVALIDATE_URLS', default='')
+        self.invalidate_urls = [ u.strip() for u in invalidate_urls.split(',') if u.strip() ]
+        self.auth_id = config.get('common', 'AUTH_ID', default='')
+        self.auth_token = config.get('common', 'AUTH_TOKEN', default='')
+        self.max_cache_size = int(config.get('cache_server', 'MAX_CACHE_SIZE', default=0))
+        self.max_cache_entries = int(config.get('cache_server', 'MAX_CACHE_ENTRIES', default=0))
+        self.eviction_policy = config.get('cache_server', 'EVICTION_POLICY', default='lru').lower()
+        self.eviction_interval = int(config.get('cache_server', 'EVICTION_INTERVAL', default=60))
+        # let frontend http server send files with X-Sendfile header
+        self.app.use_x_sendfile = config.get('cache_server', 'USE_X_SENDFILE', default='false') == 'true'
         if self.redis_host and self.redis_port and self.redis_db:
+            # stop eviction of the former cache when reloading
+            stats = None
+            if self.cache:
+                self.cache.stop_eviction()
+                stats = self.cache.stats
             self.cache = cacheapi.ResourceCache(self.redis_host,
                                         int(self.redis_port),
                                         int(self.redis_db),
                                         self.redis_pw,
                                         self.proxy_url,
-                                        self.http_timeout)
+                                        self.http_timeout,
+                                        self.cache_path,
+                                        self.memory_cache_size,
+                                        self.default_ttl,
+                                        self.max_downloads,
+                                        self.variants,
+                                        self.transcode_mp3,
+                                        self.sox,
+                                        self.log,
+                                        self.shared_path,
+                                        self.invalidate_urls,
+                                        self.auth_id,
+                                        self.auth_token,
+                                        self.max_cache_size,
+                                        self.max_cache_entries,
+                                        self.eviction_policy)
+            # keep stats when reloading
+            if stats:
+                self.cache.stats = stats
+            if self.max_cache_size or self.max_cache_entries:
+                self.cache.start_eviction(self.eviction_interval)
             return True
 
         self.log.error("Cannot run cache server, cache not set !")
@@ -179,6 +223,10 @@ class PlivoCacheServer(PlivoCacheApi):
                 self.log.warn("New cache %s" % str(self.cache))
 
 
+            # manifest of urls preloaded at startup
+            self.warm_manifest = config.get('cache_server', 'WARM_MANIFEST', default='')
+            self.warm_concurrency = int(config.get('cache_server', 'WARM_CONCURRENCY', default=5))
+
             # allowed ips to access cache server
             allowed_ips = config.get('common', 'ALLOWED_IPS', default='')
             if not allowed_ips.strip():
@@ -259,6 +307,16 @@ class PlivoCacheServer(PlivoCacheApi):
         self._run = True
         if self._daemon:
             self.do_daemon()
+        # preload manifest urls while serving
+        if self.warm_manifest:
+            try:
+                urls = cacheapi.read_manifest(self.warm_manifest)
+                # only current manifest urls are pinned
+                self.cache.clear_pinned()
+                self.start_warmup(urls, pin=True)
+            except Exception, e:
+                self.log.error("Cannot preload warm manifest %s: %s" \
+                                        % (self.warm_manifest, str(e)))
         # start http server
         self.log.info("CacheServer started at: 'http://%s'" % self.http_address)
         # Start cache server
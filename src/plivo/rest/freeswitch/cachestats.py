@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details
+
+from bisect import bisect_left
+import time
+import urlparse
+
+
+# upper bounds in seconds of latency histograms buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# max number of origin hosts tracked
+MAX_ORIGINS = 1000
+
+
+class Histogram(object):
+    """Latency histogram with fixed buckets
+    """
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        # last bucket is +Inf
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding quantile q
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return self.max
+
+    def get_buckets(self):
+        """Returns cumulative counts as [(upper bound, count), ...]
+        """
+        buckets = []
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+    def to_dict(self):
+        return {'count': self.count,
+                'sum': round(self.sum, 6),
+                'max': round(self.max, 6),
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+                'buckets': self.get_buckets()}
+
+
+class CacheStats(object):
+    """In process counters and latency histograms of the cache server
+
+    Updates are plain dict operations, cheap enough for every request.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        # host: [downloads, errors, bytes, Histogram]
+        self.origins = {}
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        try:
+            self.histograms[name].observe(seconds)
+        except KeyError:
+            histogram = Histogram()
+            histogram.observe(seconds)
+            self.histograms[name] = histogram
+
+    def observe_origin(self, url, seconds, size=0, error=False):
+        """Track download time of url by origin host
+        """
+        host = urlparse.urlsplit(url)[1]
+        try:
+            origin = self.origins[host]
+        except KeyError:
+            if len(self.origins) >= MAX_ORIGINS:
+                return
+            origin = [0, 0, 0, Histogram()]
+            self.origins[host] = origin
+        if error:
+            origin[1] += 1
+        else:
+            origin[0] += 1
+            origin[2] += size
+            origin[3].observe(seconds)
+
+    def to_dict(self, extra=None):
+        stats = {'uptime': round(time.time() - self.started, 3)}
+        stats['counters'] = dict(self.counters)
+        if extra:
+            stats['counters'].update(extra)
+        stats['latency'] = dict([ (name, histogram.to_dict()) for name, histogram \
+                                    in self.histograms.iteritems() ])
+        origins = {}
+        for host, (downloads, errors, size, histogram) in self.origins.iteritems():
+            origins[host] = {'downloads': downloads, 'errors': errors,
+                             'bytes': size, 'latency': histogram.to_dict()}
+        stats['origins'] = origins
+        return stats
+
+    def to_text(self, extra=None):
+        """Returns stats as lines of 'name value'
+        """
+        counters = dict(self.counters)
+        if extra:
+            counters.update(extra)
+        lines = ['uptime %.3f' % (time.time() - self.started)]
+        for name in sorted(counters):
+            lines.append('%s %s' % (name, counters[name]))
+        for name in sorted(self.histograms):
+            lines += self._histogram_lines(name, self.histograms[name])
+        for host in sorted(self.origins):
+            downloads, errors, size, histogram = self.origins[host]
+            lines.append('origin_downloads{host="%s"} %d' % (host, downloads))
+            lines.append('origin_errors{host="%s"} %d' % (host, errors))
+            lines.append('origin_bytes{host="%s"} %d' % (host, size))
+            lines += self._histogram_lines('origin_latency', histogram,
+                                           'host="%s",' % host)
+        return '\n'.join(lines) + '\n'
+
+    def _histogram_lines(self, name, histogram, labels=''):
+        lines = []
+        for bound, count in histogram.get_buckets():
+            lines.append('%s_seconds_bucket{%sle="%s"} %d' % (name, labels, bound, count))
+        labels = labels.rstrip(',')
+        if labels:
+            labels = '{%s}' % labels
+        lines.append('%s_seconds_sum%s %.6f' % (name, labels, histogram.sum))
+        lines.append('%s_seconds_count%s %d' % (name, labels, histogram.count))
+        return lines
@@ -9,8 +9,18 @@ URLS = {
         '/': (PlivoCacheApi.index, ['GET']),
         # API to get cache url content
         '/Cache/': (PlivoCacheApi.do_cache, ['GET']),
+        # API to get pre-transcoded variant of a cached file
+        '/CacheFile/<filename>': (PlivoCacheApi.do_cache_file, ['GET']),
         # API to get cache url type
         '/CacheType/': (PlivoCacheApi.do_cache_type, ['GET']),
+        # API to get types of several cache urls at once
+        '/CacheBatch/': (PlivoCacheApi.do_cache_batch, ['GET', 'POST']),
+        # API to preload urls in cache and get preload progress
+        '/CacheWarm/': (PlivoCacheApi.do_cache_warm, ['GET', 'POST']),
+        # API to get cache size and evictions
+        '/CacheUsage/': (PlivoCacheApi.do_cache_usage, ['GET']),
+        # API to get cache server stats
+        '/Stats/': (PlivoCacheApi.do_stats, ['GET']),
         # API to reload cache server config
         '/ReloadConfig/': (PlivoCacheApi.do_reload_config, ['GET', 'POST']),
        }
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+import time
+
+import ujson as json
+
+
+def get_event_time(event, header):
+    """Returns time in seconds of an event header in microseconds,
+    None if not set
+    """
+    try:
+        value = float(event[header] or 0) / 1000000
+    except (TypeError, ValueError):
+        return None
+    return value or None
+
+
+def parse_channel_uuids(jsonstr):
+    """Returns uuids of channels listed by 'show channels as json'
+    """
+    rows = json.loads(jsonstr).get('rows') or []
+    return [ row['uuid'] for row in rows if row.get('uuid') ]
+
+
+class ChannelDump(dict):
+    """Channel headers of 'uuid_dump <uuid> json', read as an event
+    """
+    def __getitem__(self, header):
+        return self.get(header)
+
+
+class ActiveCall(object):
+    """A live channel of FreeSWITCH
+    """
+    __slots__ = ('call_uuid', 'direction', 'state', 'request_uuid',
+                 'accountsid', 'bridged_to', 'caller_num', 'called_num',
+                 'start_time', 'answer_time')
+
+    def __init__(self, call_uuid):
+        self.call_uuid = call_uuid
+        self.direction = ''
+        self.state = ''
+        self.request_uuid = ''
+        self.accountsid = ''
+        self.bridged_to = ''
+        self.caller_num = ''
+        self.called_num = ''
+        self.start_time = None
+        self.answer_time = None
+
+    def to_dict(self):
+        return {'CallUUID': self.call_uuid,
+                'Direction': self.direction,
+                'CallState': self.state,
+                'RequestUUID': self.request_uuid,
+                'AccountSID': self.accountsid,
+                'BridgedTo': self.bridged_to,
+                'From': self.caller_num,
+                'To': self.called_num,
+                'StartTime': self.start_time,
+                'AnswerTime': self.answer_time}
+
+
+class CallRegistry(object):
+    """Active calls built from channel events, indexed by call uuid,
+    request uuid and AccountSID
+
+    A call is added on its first channel event and removed on hangup
+    complete. Calls started before the inbound socket connected are
+    seeded from FreeSWITCH between begin_sync and end_sync, calls
+    changed by an event meanwhile are newer and not seeded.
+    """
+    def __init__(self):
+        # call_uuid: ActiveCall
+        self._calls = {}
+        # request_uuid: set of call_uuid
+        self._by_request = {}
+        # accountsid: set of call_uuid
+        self._by_account = {}
+        # call_uuid changed by events while seeding, None if not seeding
+        self._touched = None
+
+    def __len__(self):
+        return len(self._calls)
+
+    def _index(self, index, key, call_uuid):
+        if key:
+            index.setdefault(key, set()).add(call_uuid)
+
+    def _unindex(self, index, key, call_uuid):
+        if not key:
+            return
+        try:
+            call_uuids = index[key]
+        except KeyError:
+            return
+        call_uuids.discard(call_uuid)
+        if not call_uuids:
+            del index[key]
+
+    def update(self, event, state=None):
+        """Add or update the call of a channel event, state defaults
+        to the event Channel-Call-State
+        """
+        call_uuid = event['Unique-ID']
+        if not call_uuid:
+            return None
+        if self._touched is not None:
+            self._touched.add(call_uuid)
+        try:
+            call = self._calls[call_uuid]
+        except KeyError:
+            call = ActiveCall(call_uuid)
+            call.start_time = get_event_time(event, 'Caller-Channel-Created-Time') \
+                                or time.time()
+            self._calls[call_uuid] = call
+        call.state = state or event['Channel-Call-State'] or call.state
+        call.direction = event['Call-Direction'] or call.direction
+        request_uuid = event['variable_plivo_request_uuid'] or ''
+        if request_uuid and request_uuid != call.request_uuid:
+            self._unindex(self._by_request, call.request_uuid, call_uuid)
+            self._index(self._by_request, request_uuid, call_uuid)
+            call.request_uuid = request_uuid
+        accountsid = event['variable_plivo_accountsid'] or ''
+        if accountsid and accountsid != call.accountsid:
+            self._unindex(self._by_account, call.accountsid, call_uuid)
+            self._index(self._by_account, accountsid, call_uuid)
+            call.accountsid = accountsid
+        caller_num = event['Caller-Caller-ID-Number']
+        if caller_num:
+            call.caller_num = caller_num.lstrip('+')
+        called_num = event['variable_plivo_destination_number']
+        if not called_num or called_num == '_undef_':
+            called_num = event['Caller-Destination-Number']
+        if called_num:
+            call.called_num = called_num.lstrip('+')
+        if call.answer_time is None:
+            call.answer_time = get_event_time(event, 'Caller-Channel-Answered-Time')
+        return call
+
+    def set_bridge(self, call_uuid, bridged_to):
+        try:
+            self._calls[call_uuid].bridged_to = bridged_to or ''
+        except KeyError:
+            pass
+
+    def remove(self, call_uuid):
+        if self._touched is not None:
+            self._touched.add(call_uuid)
+        call = self._calls.pop(call_uuid, None)
+        if call is None:
+            return None
+        self._unindex(self._by_request, call.request_uuid, call_uuid)
+        self._unindex(self._by_account, call.accountsid, call_uuid)
+        return call
+
+    def begin_sync(self):
+        """Start tracking calls changed until end_sync,
+        returns False if a sync is already in progress
+        """
+        if self._touched is not None:
+            return False
+        self._touched = set()
+        return True
+
+    def end_sync(self):
+        self._touched = None
+
+    def seed(self, jsonstr):
+        """Add the call of 'uuid_dump <uuid> json' if it is a plivo call
+        not changed by an event since begin_sync, returns the call or None
+        """
+        event = ChannelDump(json.loads(jsonstr))
+        if event['variable_plivo_app'] != 'true':
+            return None
+        call_uuid = event['Unique-ID']
+        if self._touched is not None and call_uuid in self._touched:
+            return None
+        return self.update(event)
+
+    def clear(self):
+        self._calls.clear()
+        self._by_request.clear()
+        self._by_account.clear()
+
+    def get(self, call_uuid):
+        return self._calls.get(call_uuid)
+
+    def find(self, request_uuid='', accountsid='', direction=''):
+        """Returns active calls matching all given filters
+        """
+        call_uuids = None
+        if request_uuid:
+            call_uuids = self._by_request.get(request_uuid, ())
+        if accountsid:
+            by_account = self._by_account.get(accountsid, ())
+            if call_uuids is None:
+                call_uuids = by_account
+            else:
+                call_uuids = set(call_uuids) & set(by_account)
+        if call_uuids is None:
+            calls = self._calls.values()
+        else:
+            calls = [ self._calls[call_uuid] for call_uuid in call_uuids ]
+        if direction:
+            calls = [ call for call in calls if call.direction == direction ]
+        return calls
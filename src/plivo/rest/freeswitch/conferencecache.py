@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+import time
+
+try:
+    import xml.etree.cElementTree as etree
+except ImportError:
+    from xml.etree.elementtree import ElementTree as etree
+
+
+class ConferenceMember(object):
+    __slots__ = ('member_id', 'call_uuid', 'caller_name', 'caller_num',
+                 'joined', 'muted', 'deaf')
+
+    def __init__(self, member_id, call_uuid, joined=None):
+        self.member_id = member_id
+        self.call_uuid = call_uuid
+        self.caller_name = ''
+        self.caller_num = ''
+        self.joined = joined or time.time()
+        self.muted = False
+        self.deaf = False
+
+
+class Conference(object):
+    __slots__ = ('name', 'uuid', 'started', 'members', 'floor')
+
+    def __init__(self, name, uuid='', started=None):
+        self.name = name
+        self.uuid = uuid
+        self.started = started or time.time()
+        # member_id: ConferenceMember
+        self.members = {}
+        # member_id holding the floor
+        self.floor = None
+
+
+def split_filter(value):
+    if not value:
+        return ()
+    return tuple([ item.strip() for item in value.split(',') if item.strip() ])
+
+
+class ConferenceCache(object):
+    """Live model of conference rooms and members built from
+    conference::maintenance events
+
+    The model is reconciled with 'conference xml_list' by load_xml.
+    Rooms changed by an event while the xml_list job is running keep
+    their event state, the job result may be older than the event.
+    Lists are only served from the model once it has been loaded.
+    """
+    def __init__(self):
+        # room name: Conference
+        self._rooms = {}
+        self.synced = False
+        self.last_sync = None
+        # rooms changed since begin_sync, None if no sync in progress
+        self._touched = None
+
+    def clear(self):
+        self._rooms.clear()
+        self.synced = False
+        self._touched = None
+
+    def get_room(self, name, uuid=''):
+        try:
+            room = self._rooms[name]
+        except KeyError:
+            room = Conference(name, uuid)
+            self._rooms[name] = room
+        if uuid:
+            room.uuid = uuid
+        return room
+
+    def on_event(self, event):
+        """Update the model from a conference::maintenance event
+        """
+        name = event['Conference-Name']
+        if not name:
+            return
+        action = event['Action']
+        if self._touched is not None:
+            self._touched.add(name)
+        if action == 'conference-destroy':
+            self._rooms.pop(name, None)
+            return
+        room = self.get_room(name, event['Conference-Unique-ID'] or '')
+        if action == 'conference-create':
+            return
+        if action == 'floor-change':
+            new_id = event['New-ID']
+            if new_id and new_id != 'none':
+                room.floor = new_id
+            else:
+                room.floor = None
+            return
+        member_id = event['Member-ID']
+        if not member_id:
+            return
+        if action in ('del-member', 'kick-member'):
+            room.members.pop(member_id, None)
+            if room.floor == member_id:
+                room.floor = None
+            return
+        try:
+            member = room.members[member_id]
+        except KeyError:
+            call_uuid = event['Unique-ID']
+            if not call_uuid:
+                return
+            member = ConferenceMember(member_id, call_uuid)
+            room.members[member_id] = member
+        member.caller_name = event['Caller-Caller-ID-Name'] or member.caller_name
+        member.caller_num = event['Caller-Caller-ID-Number'] or member.caller_num
+        if event['Speak']:
+            member.muted = event['Speak'] == 'false'
+        if event['Hear']:
+            member.deaf = event['Hear'] == 'false'
+        if event['Floor'] == 'true':
+            room.floor = member_id
+        elif event['Floor'] == 'false' and room.floor == member_id:
+            room.floor = None
+
+    def begin_sync(self):
+        """Start tracking rooms changed until load_xml,
+        returns False if a sync is already in progress
+        """
+        if self._touched is not None:
+            return False
+        self._touched = set()
+        return True
+
+    def end_sync(self):
+        """Sync failed, stop tracking changed rooms
+        """
+        self._touched = None
+
+    def load_xml(self, xmlstr):
+        """Reconcile the model with the result of 'conference xml_list',
+        raises an exception if xmlstr cannot be parsed
+        """
+        touched = self._touched or set()
+        self._touched = None
+        rooms = {}
+        if not xmlstr.startswith('No active conferences'):
+            now = time.time()
+            doc = etree.fromstring(xmlstr)
+            if doc.tag != 'conferences':
+                raise ValueError("Root tag must be 'conferences'")
+            for conf in doc:
+                name = conf.get('name', None)
+                if not name:
+                    continue
+                run_time = int(conf.get('run_time', None) or 0)
+                room = Conference(name, conf.get('uuid', ''), now - run_time)
+                for node in conf.findall('members/member'):
+                    member_id = node.findtext('id')
+                    call_uuid = node.findtext('uuid')
+                    if not member_id or not call_uuid:
+                        continue
+                    join_time = int(node.findtext('join_time') or 0)
+                    member = ConferenceMember(member_id, call_uuid, now - join_time)
+                    member.caller_name = node.findtext('caller_id_name') or ''
+                    member.caller_num = node.findtext('caller_id_number') or ''
+                    member.muted = node.findtext('flags/can_speak') == 'false'
+                    member.deaf = node.findtext('flags/can_hear') == 'false'
+                    if node.findtext('flags/has_floor') == 'true':
+                        room.floor = member_id
+                    room.members[member_id] = member
+                rooms[name] = room
+        for name in touched:
+            if name in self._rooms:
+                rooms[name] = self._rooms[name]
+            else:
+                rooms.pop(name, None)
+        self._rooms = rooms
+        self.synced = True
+        self.last_sync = time.time()
+
+    def has_room(self, name):
+        return name in self._rooms
+
+    def get_list(self, room=None, member_filter=None, uuid_filter=None,
+                 mute_filter=False, deaf_filter=False):
+        """Returns rooms as PlivoRestApi._parse_conference_xml_list,
+        all rooms if room is not set
+        """
+        mfilter = split_filter(member_filter)
+        ufilter = split_filter(uuid_filter)
+        any_filter = mfilter or ufilter or mute_filter or deaf_filter
+        if room:
+            rooms = [ self._rooms[room] ] if room in self._rooms else []
+        else:
+            rooms = self._rooms.values()
+        now = time.time()
+        res = {}
+        for conf in rooms:
+            members = []
+            for member in sorted(conf.members.itervalues(),
+                                 key=lambda member: member.joined):
+                if any_filter \
+                    and not (mfilter and member.member_id in mfilter) \
+                    and not (ufilter and member.call_uuid in ufilter) \
+                    and not (mute_filter and member.muted) \
+                    and not (deaf_filter and member.deaf):
+                    continue
+                members.append({'MemberID': member.member_id,
+                                'Deaf': member.deaf,
+                                'Muted': member.muted,
+                                'Floor': conf.floor == member.member_id,
+                                'CallUUID': member.call_uuid,
+                                'CallName': member.caller_name,
+                                'CallNumber': member.caller_num,
+                                'JoinTime': str(int(now - member.joined))})
+            res[conf.name] = {'ConferenceUUID': conf.uuid,
+                              'ConferenceRunTime': str(int(now - conf.started)),
+                              'ConferenceName': conf.name,
+                              'ConferenceMemberCount': str(len(conf.members)),
+                              'Members': members}
+        return res
@@ -16,9 +16,12 @@ import gevent
 from gevent import spawn_raw
 
 from plivo.rest.freeswitch.helpers import is_valid_url, is_sip_url, \
+                                        is_template_url, \
                                         file_exists, normalize_url_space, \
-                                        get_resource, get_grammar_resource, \
+                                        get_resource, get_resources, \
                                         HTTPRequest
+from plivo.rest.freeswitch.grammars import GRAMMAR_EXT
+from plivo.rest.freeswitch.speakcache import get_speak_file
 
 from plivo.rest.freeswitch.exceptions import RESTFormatException, \
                                             RESTAttributeException, \
@@ -136,33 +139,41 @@ ELEMENTS_DEFAULT_PARAMS = {
                 'timeout': 5,
                 'playBeep': 'false',
                 'engine': 'pocketsphinx',
-                'grammar': '',
-                'grammarPath': '/usr/local/freeswitch/grammar'
+                'grammar': ''
         }
     }
 
+# attributes without default, accepted by element
+ELEMENTS_EXTRA_PARAMS = {
+        'Dial': ('action', 'callerId', 'callerName', 'timeout'),
+        'GetDigits': ('action',),
+        'Number': ('gateways', 'gatewayCodecs', 'gatewayTimeouts',
+                   'gatewayRetries', 'extraDialString', 'sendOnPreanswer'),
+        'Record': ('action',),
+        'GetSpeech': ('action', 'grammarPath')
+    }
+
 
 MAX_LOOPS = 10000
 
 
 class Element(object):
     """Abstract Element Class to be inherited by all other elements"""
+    __slots__ = ('attributes', 'text', 'children', 'uri')
+    nestables = ()
 
     def __init__(self):
-        self.name = str(self.__class__.__name__)
-        self.nestables = None
         self.attributes = {}
         self.text = ''
         self.children = []
         self.uri = None
-        self._element = None
 
-    def get_element(self):
-        return self._element
+    @property
+    def name(self):
+        return self.__class__.__name__
 
     def parse_element(self, element, uri=None):
-        self.uri = uri 
-        self._element = element
+        self.uri = uri
         self.prepare_attributes(element)
         self.prepare_text(element)
 
@@ -193,17 +204,19 @@ class Element(object):
 
     def extract_attribute_value(self, item, default=None):
         try:
-            item = self.attributes[item]
+            return self.attributes[item]
         except KeyError:
-            item = default
-        return item
+            return ELEMENTS_REGISTRY[self.name].defaults.get(item, default)
 
     def prepare_attributes(self, element):
-        element_dict = ELEMENTS_DEFAULT_PARAMS[self.name]
-        if element.attrib and not element_dict:
+        schema = ELEMENTS_REGISTRY[self.name]
+        attrib = element.attrib
+        if attrib and not schema.allowed:
             raise RESTFormatException("%s does not require any attributes!"
                                                                 % self.name)
-        self.attributes = dict(element_dict, **element.attrib)
+        # only keep attributes set in restxml, defaults are shared by schema
+        self.attributes = dict([ (k, v) for k, v in attrib.iteritems() \
+                                            if k in schema.allowed ])
 
     def prepare_text(self, element):
         text = element.text
@@ -266,6 +279,13 @@ class Conference(Element):
     DEFAULT_TIMELIMIT = 0
     DEFAULT_MAXMEMBERS = 200
 
+    __slots__ = ('full_room', 'room', 'moh_sound', 'muted', 'start_on_enter',
+                 'end_on_exit', 'stay_alone', 'time_limit', 'max_members',
+                 'enter_sound', 'exit_sound', 'hangup_on_star',
+                 'record_file_path', 'record_file_format', 'record_filename',
+                 'action', 'method', 'callback_url', 'callback_method',
+                 'digits_match', 'floor', 'speaker', 'conf_id', 'member_id')
+
     def __init__(self):
         Element.__init__(self)
         self.full_room = ''
@@ -362,16 +382,22 @@ class Conference(Element):
                 outbound_socket.log.warn('No Response Tag Present')
                 return sound_files
 
-            # build play string from remote restxml
+            # resolve all Play urls with one cache lookup
+            plays = {}
             for element in doc:
-                # Play element
                 if element.tag == 'Play':
                     child_instance = Play()
                     child_instance.parse_element(element)
-                    child_instance.prepare(outbound_socket)
+                    plays[element] = child_instance
+            prepare_plays(outbound_socket, plays.values())
+
+            # build play string from remote restxml
+            for element in doc:
+                # Play element
+                if element.tag == 'Play':
+                    child_instance = plays[element]
                     sound_file = child_instance.sound_file_path
                     if sound_file:
-                        sound_file = get_resource(outbound_socket, sound_file)
                         loop = child_instance.loop_times
                         if loop == 0:
                             loop = MAX_LOOPS  # Add a high number to Play infinitely
@@ -609,9 +635,14 @@ class Dial(Element):
     """
     DEFAULT_TIMELIMIT = 14400
 
+    __slots__ = ('method', 'action', 'hangup_on_star', 'caller_id',
+                 'caller_name', 'time_limit', 'timeout', 'dial_str', 'confirm_sound',
+                 'confirm_key', 'dial_music', 'redirect', 'callback_url',
+                 'callback_method', 'digits_match')
+    nestables = ('Number',)
+
     def __init__(self):
         Element.__init__(self)
-        self.nestables = ('Number',)
         self.method = ''
         self.action = ''
         self.hangup_on_star = False
@@ -673,16 +704,22 @@ class Dial(Element):
                 outbound_socket.log.warn('No Response Tag Present')
                 return sound_files
 
-            # build play string from remote restxml
+            # resolve all Play urls with one cache lookup
+            plays = {}
             for element in doc:
-                # Play element
                 if element.tag == 'Play':
                     child_instance = Play()
                     child_instance.parse_element(element)
-                    child_instance.prepare(outbound_socket)
+                    plays[element] = child_instance
+            prepare_plays(outbound_socket, plays.values())
+
+            # build play string from remote restxml
+            for element in doc:
+                # Play element
+                if element.tag == 'Play':
+                    child_instance = plays[element]
                     sound_file = child_instance.sound_file_path
                     if sound_file:
-                        sound_file = get_resource(outbound_socket, sound_file)
                         loop = child_instance.loop_times
                         if loop == 0:
                             loop = MAX_LOOPS  # Add a high number to Play infinitely
@@ -711,7 +748,10 @@ class Dial(Element):
                     else:
                         engine = child_instance.engine
                         voice = child_instance.voice
-                        say_str = "say:%s:%s:'%s'" % (engine, voice, text)
+                        # play the phrase rendered by the speak cache if any
+                        say_str = get_speak_file(outbound_socket, engine, voice,
+                                    child_instance.language, child_instance.text) \
+                                    or "say:%s:%s:'%s'" % (engine, voice, text)
                     if not say_str:
                         continue
                     for i in range(loop):
@@ -1006,9 +1046,13 @@ class GetDigits(Element):
     DEFAULT_MAX_DIGITS = 99
     DEFAULT_TIMEOUT = 5
 
+    __slots__ = ('num_digits', 'timeout', 'finish_on_key', 'action',
+                 'play_beep', 'valid_digits', 'invalid_digits_sound', 'retries',
+                 'sound_files', 'method')
+    nestables = ('Speak', 'Play', 'Wait')
+
     def __init__(self):
         Element.__init__(self)
-        self.nestables = ('Speak', 'Play', 'Wait')
         self.num_digits = None
         self.timeout = None
         self.finish_on_key = None
@@ -1067,9 +1111,9 @@ class GetDigits(Element):
         self.retries = retries
 
     def prepare(self, outbound_socket):
+        prepare_plays(outbound_socket, self.children)
         for child_instance in self.children:
             if hasattr(child_instance, "prepare"):
-                # :TODO Prepare Element concurrently
                 child_instance.prepare(outbound_socket)
 
     def execute(self, outbound_socket):
@@ -1107,7 +1151,10 @@ class GetDigits(Element):
                 else:
                     engine = child_instance.engine
                     voice = child_instance.voice
-                    say_str = "say:%s:%s:'%s'" % (engine, voice, text)
+                    # play the phrase rendered by the speak cache if any
+                    say_str = get_speak_file(outbound_socket, engine, voice,
+                                child_instance.language, child_instance.text) \
+                                or "say:%s:%s:'%s'" % (engine, voice, text)
                 if not say_str:
                     continue
                 for i in range(loop):
@@ -1149,6 +1196,8 @@ class Hangup(Element):
 
     Note: when hangup is scheduled, reason is not taken into account.
     """
+    __slots__ = ('reason', 'schedule')
+
     def __init__(self):
         Element.__init__(self)
         self.reason = ""
@@ -1209,6 +1258,10 @@ class Number(Element):
     gatewayRetries: number of times to retry each gateway separated by comma
     extraDialString: extra freeswitch dialstring to be added while dialing out to number
     """
+    __slots__ = ('number', 'gateways', 'gateway_codecs', 'gateway_timeouts',
+                 'gateway_retries', 'extra_dial_string', 'send_digits',
+                 'send_on_preanswer')
+
     def __init__(self):
         Element.__init__(self)
         self.number = ''
@@ -1255,6 +1308,8 @@ class Wait(Element):
 
     length: length of wait time in seconds
     """
+    __slots__ = ('length',)
+
     def __init__(self):
         Element.__init__(self)
         self.length = 1
@@ -1284,6 +1339,9 @@ class Play(Element):
     url: url of audio file, MIME type on file must be set correctly
     loop: number of time to play the audio - (0 means infinite)
     """
+    __slots__ = ('audio_directory', 'loop_times', 'sound_file_path',
+                 'temp_audio_path')
+
     def __init__(self):
         Element.__init__(self)
         self.audio_directory = ''
@@ -1348,12 +1406,28 @@ class Play(Element):
             outbound_socket.log.error("Invalid Sound File - Ignoring Play")
 
 
+def prepare_plays(outbound_socket, children):
+    """Resolve remote audio of Play children
+    with one cache server lookup
+    """
+    plays = [ child for child in children if isinstance(child, Play) \
+                                    and not child.sound_file_path ]
+    if not plays:
+        return
+    urls = [ normalize_url_space(play.temp_audio_path) for play in plays ]
+    for play, sound_file in zip(plays, get_resources(outbound_socket, urls)):
+        play.sound_file_path = sound_file
+
+
 class PreAnswer(Element):
     """Answer the call in Early Media Mode and execute nested element
     """
+    __slots__ = ()
+    nestables = ('Play', 'Speak', 'GetDigits', 'Wait', 'GetSpeech',
+                 'Redirect', 'SIPTransfer')
+
     def __init__(self):
         Element.__init__(self)
-        self.nestables = ('Play', 'Speak', 'GetDigits', 'Wait', 'GetSpeech', 'Redirect', 'SIPTransfer')
 
     def parse_element(self, element, uri=None):
         Element.parse_element(self, element, uri)
@@ -1361,8 +1435,6 @@ class PreAnswer(Element):
     def prepare(self, outbound_socket):
         for child_instance in self.children:
             if hasattr(child_instance, "prepare"):
-                outbound_socket.validate_element(child_instance.get_element(), 
-                                                 child_instance)
                 child_instance.prepare(outbound_socket)
 
     def execute(self, outbound_socket):
@@ -1392,6 +1464,10 @@ class Record(Element):
     redirect: if 'false', don't redirect to 'action', only request url
         and continue to next element. (default 'true')
     """
+    __slots__ = ('silence_threshold', 'max_length', 'timeout', 'finish_on_key',
+                 'file_path', 'play_beep', 'file_format', 'filename',
+                 'both_legs', 'action', 'method', 'redirect')
+
     def __init__(self):
         Element.__init__(self)
         self.silence_threshold = 500
@@ -1524,6 +1600,8 @@ class Record(Element):
 
 
 class SIPTransfer(Element):
+    __slots__ = ('sip_url',)
+
     def __init__(self):
         Element.__init__(self)
         self.sip_url = ""
@@ -1556,6 +1634,8 @@ class Redirect(Element):
     Url is set in element body
     method: GET or POST
     """
+    __slots__ = ('method', 'url')
+
     def __init__(self):
         Element.__init__(self)
         self.method = ""
@@ -1569,7 +1649,7 @@ class Redirect(Element):
         url = element.text.strip()
         if not url:
             raise RESTFormatException("Redirect must have an URL")
-        if is_valid_url(url):
+        if is_valid_url(url) or is_template_url(url):
             self.method = method
             self.url = url
             return
@@ -1586,6 +1666,8 @@ class Notify(Element):
     Url is set in element body
     method: GET or POST
     """
+    __slots__ = ('method', 'url')
+
     def __init__(self):
         Element.__init__(self)
         self.method = ""
@@ -1654,6 +1736,9 @@ class Speak(Element):
                    'POSTAL_ADDRESS', 'ACCOUNT_NUMBER', 'NAME_SPELLED',
                    'NAME_PHONETIC', 'SHORT_DATE_TIME')
 
+    __slots__ = ('loop_times', 'language', 'sound_file_path', 'engine',
+                 'voice', 'item_type', 'method')
+
     def __init__(self):
         Element.__init__(self)
         self.loop_times = 1
@@ -1697,7 +1782,13 @@ class Speak(Element):
         if self.item_type and self.method:
             res = outbound_socket.say(say_args, loops=self.loop_times)
         else:
-            res = outbound_socket.speak(say_args, loops=self.loop_times)
+            # play the phrase rendered by the speak cache if any
+            speak_file = get_speak_file(outbound_socket, self.engine, self.voice,
+                                        self.language, self.text)
+            if speak_file:
+                res = outbound_socket.playback(speak_file, loops=self.loop_times)
+            else:
+                res = outbound_socket.speak(say_args, loops=self.loop_times)
         if res.is_success():
             for i in range(self.loop_times):
                 outbound_socket.log.debug("Speaking %d times ..." % (i+1))
@@ -1725,11 +1816,15 @@ class GetSpeech(Element):
     playBeep: play a beep after all plays and says finish
     engine: engine to be used by detect speech
     grammar: grammar to load
-    grammarPath: grammar path directory (default /usr/local/freeswitch/grammar)
+    grammarPath: grammar path directory (default GRAMMAR_PATH of outbound server)
     """
+    __slots__ = ('num_digits', 'timeout', 'finish_on_key', 'action',
+                 'play_beep', 'valid_digits', 'invalid_digits_sound', 'retries',
+                 'sound_files', 'method', 'grammar', 'grammarPath', 'engine')
+    nestables = ('Speak', 'Play', 'Wait')
+
     def __init__(self):
         Element.__init__(self)
-        self.nestables = ('Speak', 'Play', 'Wait')
         self.num_digits = None
         self.timeout = None
         self.finish_on_key = None
@@ -1747,7 +1842,10 @@ class GetSpeech(Element):
         self.grammar = self.extract_attribute_value("grammar")
         if not self.grammar:
             raise RESTAttributeException("GetSpeech 'grammar' is mandatory")
-        self.grammarPath = self.extract_attribute_value("grammarPath").rstrip(os.sep)
+        # None uses the grammar path of the grammar store
+        self.grammarPath = self.extract_attribute_value("grammarPath")
+        if self.grammarPath is not None:
+            self.grammarPath = self.grammarPath.rstrip(os.sep)
 
         self.engine = self.extract_attribute_value("engine")
         if not self.engine:
@@ -1776,48 +1874,54 @@ class GetSpeech(Element):
             self.action = None
 
     def prepare(self, outbound_socket):
+        prepare_plays(outbound_socket, self.children)
         for child_instance in self.children:
             if hasattr(child_instance, "prepare"):
-                # :TODO Prepare Element concurrently
                 child_instance.prepare(outbound_socket)
 
     def _parse_speech_result(self, result):
         return speech_result
 
     def execute(self, outbound_socket):
+        # (grammar path, file name) of stored grammars in use,
+        # kept by the grammar store until speech detection is done
+        held = []
+        try:
+            self._execute(outbound_socket, held)
+        finally:
+            for grammar_path, name in held:
+                outbound_socket.grammars.release(grammar_path, name)
+
+    def _execute(self, outbound_socket, held):
         speech_result = ''
         grammar_loaded = False
         grammars = self.grammar.split(';')
+        grammar_path = self.grammarPath
+        if grammar_path is None:
+            grammar_path = outbound_socket.grammars.grammar_path
 
         # unload previous grammars
         outbound_socket.execute("detect_speech", "grammarsalloff")
 
         for i, grammar in enumerate(grammars):
             grammar_file = ''
-            gpath = None
-            raw_grammar = get_grammar_resource(outbound_socket, grammar)
-            if raw_grammar:
-                outbound_socket.log.debug("Found grammar : %s" % str(raw_grammar))
-                grammar_file = "%s_%s" % (datetime.now().strftime("%Y%m%d-%H%M%S"),
-                                          outbound_socket.get_channel_unique_id())
-                gpath = self.grammarPath + os.sep + grammar_file + '.gram'
-                outbound_socket.log.debug("Writing grammar to %s" % str(gpath))
-                try:
-                    f = open(gpath, 'w')
-                    f.write(raw_grammar)
-                    f.close()
-                except Exception, e:
-                    outbound_socket.log.error("GetSpeech result failure, cannot write grammar: %s" % str(grammar_file))
-                    grammar_file = ''
-            elif raw_grammar is None:
+            # grammar stored by content digest, kept for next calls
+            stored_grammar = outbound_socket.grammars.get_file(outbound_socket,
+                                                    grammar, grammar_path)
+            if stored_grammar:
+                outbound_socket.log.debug("Found grammar : %s" % str(stored_grammar))
+                outbound_socket.grammars.hold(grammar_path, stored_grammar)
+                held.append((grammar_path, stored_grammar))
+                grammar_file = stored_grammar[:-len(GRAMMAR_EXT)]
+            elif stored_grammar is None:
                 outbound_socket.log.debug("Using grammar %s" % str(grammar))
                 grammar_file = grammar
             else:
                 outbound_socket.log.error("GetSpeech result failure, cannot get grammar: %s" % str(grammar))
 
             if grammar_file:
-                if self.grammarPath and grammar_file[:4] != 'url:' and grammar_file[:8] != 'builtin:':
-                    grammar_full_path = self.grammarPath + os.sep + grammar_file
+                if grammar_path and grammar_file[:4] != 'url:' and grammar_file[:8] != 'builtin:':
+                    grammar_full_path = grammar_path + os.sep + grammar_file
                 else:
                     if grammar_file[:4] == 'url:':
                         grammar_file = grammar_file[4:]
@@ -1833,11 +1937,6 @@ class GetSpeech(Element):
                     if not res.is_success():
                         outbound_socket.log.error("GetSpeech Failed - %s" \
                                                       % str(res.get_response()))
-                        if gpath:
-                            try:
-                                os.remove(gpath)
-                            except:
-                                pass
                         return
                     else:
                         grammar_loaded = True
@@ -1848,11 +1947,6 @@ class GetSpeech(Element):
                     if not res.is_success():
                         outbound_socket.log.error("GetSpeech Failed - %s" \
                                                       % str(res.get_response()))
-                        if gpath:
-                            try:
-                                os.remove(gpath)
-                            except:
-                                pass
                         return
                 # enable grammar
                 speech_args = "grammaron %s" % (grammar_tag)
@@ -1860,11 +1954,6 @@ class GetSpeech(Element):
                 if not res.is_success():
                     outbound_socket.log.error("GetSpeech Failed - %s" \
                                                   % str(res.get_response()))
-                    if gpath:
-                        try:
-                            os.remove(gpath)
-                        except:
-                            pass
                     return
 
         if grammar_loaded == True:
@@ -1903,7 +1992,10 @@ class GetSpeech(Element):
                     else:
                         engine = child_instance.engine
                         voice = child_instance.voice
-                        say_str = "say:%s:%s:'%s'" % (engine, voice, text)
+                        # play the phrase rendered by the speak cache if any
+                        say_str = get_speak_file(outbound_socket, engine, voice,
+                                    child_instance.language, child_instance.text) \
+                                    or "say:%s:%s:'%s'" % (engine, voice, text)
                     if not say_str:
                         continue
                     for i in range(loop):
@@ -1955,11 +2047,6 @@ class GetSpeech(Element):
                 return
             finally:
                 timer.cancel()
-                if gpath:
-                    try:
-                        os.remove(gpath) 
-                    except:
-                        pass
 
             outbound_socket.execute("detect_speech", "stop")
             outbound_socket.bgapi("uuid_break %s all" \
@@ -1990,3 +2077,32 @@ class GetSpeech(Element):
                     outbound_socket.log.error("GetSpeech result failure, cannot parse result: %s" % str(e))
             # Redirect
             self.fetch_rest_xml(self.action, params, self.method)
+
+
+class ElementSchema(object):
+    """Compiled schema of an element, built once at import time
+
+    klass: element class
+    defaults: default attributes values
+    allowed: frozenset of accepted attributes
+    nestables: frozenset of tags allowed as children
+    """
+    __slots__ = ('klass', 'defaults', 'allowed', 'nestables')
+
+    def __init__(self, klass):
+        name = klass.__name__
+        self.klass = klass
+        self.defaults = ELEMENTS_DEFAULT_PARAMS[name]
+        self.allowed = frozenset(self.defaults.keys()) \
+                        | frozenset(ELEMENTS_EXTRA_PARAMS.get(name, ()))
+        self.nestables = frozenset(klass.nestables)
+
+
+def compile_registry():
+    registry = {}
+    for name in ELEMENTS_DEFAULT_PARAMS:
+        registry[name] = ElementSchema(globals()[name])
+    return registry
+
+
+ELEMENTS_REGISTRY = compile_registry()
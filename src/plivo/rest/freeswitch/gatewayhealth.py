@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+import time
+
+
+# hangup causes telling the gateway reached the called party,
+# they don't count against the gateway
+USER_CAUSES = frozenset(('NORMAL_CLEARING', 'USER_BUSY', 'NO_ANSWER',
+                         'NO_USER_RESPONSE', 'CALL_REJECTED',
+                         'ORIGINATOR_CANCEL', 'UNALLOCATED_NUMBER',
+                         'NUMBER_CHANGED', 'INVALID_NUMBER_FORMAT',
+                         'SUBSCRIBER_ABSENT', 'ALLOTTED_TIMEOUT',
+                         'LOSE_RACE', 'PICKED_OFF', 'MANAGER_REQUEST'))
+
+# gateway orderings
+ORDERING_OFF = 'off'
+ORDERING_HEALTH = 'health'
+ORDERING_LATENCY = 'latency'
+ORDERINGS = (ORDERING_OFF, ORDERING_HEALTH, ORDERING_LATENCY)
+
+# weight of the last attempt in score and post dial delay averages
+EWMA_ALPHA = 0.1
+
+# max number of hangup causes tracked by gateway
+MAX_CAUSES = 50
+
+# seconds other calls skip an half-open gateway while its probe is running
+PROBE_TIMEOUT = 60
+
+
+class GatewayHealth(object):
+    """Call attempts stats and circuit breaker of a gateway
+
+    score is a moving average of attempts reaching the called party,
+    pdd a moving average of the post dial delay up to ringing,
+    early media or answer.
+    The breaker opens after breaker_failures failures in a row, the
+    gateway is then skipped for cooldown seconds, then a single
+    attempt is let through to close it again or reopen it.
+    """
+    __slots__ = ('attempts', 'successes', 'failures', 'causes', 'score',
+                 'pdd', 'consecutive', 'open_until', 'probing', 'trips')
+
+    def __init__(self):
+        self.attempts = 0
+        self.successes = 0
+        self.failures = 0
+        # hangup cause: count
+        self.causes = {}
+        self.score = 1.0
+        self.pdd = None
+        self.consecutive = 0
+        self.open_until = 0
+        # start time of the probe of an half-open gateway
+        self.probing = 0
+        self.trips = 0
+
+    def is_open(self, now=None):
+        """Breaker is open and gateway must be skipped
+        """
+        if not self.open_until:
+            return False
+        now = now or time.time()
+        if self.probing and now - self.probing < PROBE_TIMEOUT:
+            return True
+        return now < self.open_until
+
+    def get_state(self, now=None):
+        if not self.open_until:
+            return 'closed'
+        if self.is_open(now):
+            return 'open'
+        return 'half-open'
+
+    def success(self, pdd=None):
+        self.successes += 1
+        self.score += EWMA_ALPHA * (1.0 - self.score)
+        if pdd is not None:
+            if self.pdd is None:
+                self.pdd = pdd
+            else:
+                self.pdd += EWMA_ALPHA * (pdd - self.pdd)
+        self.consecutive = 0
+        self.open_until = 0
+        self.probing = 0
+
+    def failure(self, cause, breaker_failures, cooldown):
+        self.failures += 1
+        if cause in self.causes or len(self.causes) < MAX_CAUSES:
+            self.causes[cause] = self.causes.get(cause, 0) + 1
+        self.score -= EWMA_ALPHA * self.score
+        self.consecutive += 1
+        # failed probe or too many failures in a row
+        if self.probing or self.open_until \
+            or (breaker_failures > 0 and self.consecutive >= breaker_failures):
+            self.open_until = time.time() + cooldown
+            self.trips += 1
+        self.probing = 0
+
+    def get_status(self, now=None):
+        pdd = None
+        if self.pdd is not None:
+            pdd = round(self.pdd, 3)
+        return {'Attempts': self.attempts,
+                'Successes': self.successes,
+                'Failures': self.failures,
+                'HangupCauses': self.causes,
+                'Score': round(self.score, 3),
+                'PostDialDelay': pdd,
+                'Breaker': self.get_state(now),
+                'Trips': self.trips}
+
+
+class GatewayMonitor(object):
+    """Health of gateways from call attempts results
+
+    start(request_uuid, gw) is called when a call attempt is sent to gw,
+    then reached(request_uuid) on ringing, early media or answer, or
+    failed(request_uuid, cause) when the attempt fails.
+    order(gateways) returns gateways to try, open gateways are skipped
+    unless all of them are open. With ordering 'health', gateways with
+    a score under min_score are tried after the others, with 'latency'
+    gateways are also sorted by post dial delay.
+    """
+    def __init__(self, log, ordering=ORDERING_OFF, breaker_failures=5,
+                 cooldown=30, min_score=0.5):
+        self.log = log
+        # gateway: GatewayHealth
+        self._gateways = {}
+        # request_uuid: (gateway, start time)
+        self._attempts = {}
+        self.configure(ordering, breaker_failures, cooldown, min_score)
+
+    def configure(self, ordering=ORDERING_OFF, breaker_failures=5,
+                  cooldown=30, min_score=0.5):
+        if not ordering in ORDERINGS:
+            raise ValueError("Invalid gateway ordering '%s'" % ordering)
+        self.ordering = ordering
+        self.breaker_failures = breaker_failures
+        self.cooldown = cooldown
+        self.min_score = min_score
+
+    def get_gateway(self, gw):
+        try:
+            return self._gateways[gw]
+        except KeyError:
+            health = GatewayHealth()
+            self._gateways[gw] = health
+            return health
+
+    def start(self, request_uuid, gw):
+        health = self.get_gateway(gw)
+        health.attempts += 1
+        now = time.time()
+        # a call through an half-open gateway is its probe
+        if health.open_until and not health.is_open(now):
+            health.probing = now
+        self._attempts[request_uuid] = (gw, now)
+
+    def reached(self, request_uuid):
+        try:
+            gw, started = self._attempts.pop(request_uuid)
+        except KeyError:
+            return
+        self.get_gateway(gw).success(time.time() - started)
+
+    def failed(self, request_uuid, cause):
+        try:
+            gw, started = self._attempts.pop(request_uuid)
+        except KeyError:
+            return
+        health = self.get_gateway(gw)
+        if cause in USER_CAUSES:
+            # called party reached, no post dial delay to measure
+            health.success()
+            return
+        was_open = health.open_until
+        health.failure(cause, self.breaker_failures, self.cooldown)
+        if health.open_until and not was_open:
+            self.log.warn("Gateway %s circuit open for %ss after %d failures (%s)" \
+                            % (gw, self.cooldown, health.consecutive, cause))
+
+    def discard(self, request_uuid):
+        """Forget call attempt of request_uuid without result
+        """
+        self._attempts.pop(request_uuid, None)
+
+    def order(self, gateways):
+        """Returns gateways, a list of Gateway, in the order to try them
+        """
+        if self.ordering == ORDERING_OFF or len(gateways) < 2:
+            return gateways
+        now = time.time()
+        ranked = []
+        for index, gateway in enumerate(gateways):
+            health = self._gateways.get(gateway.gw)
+            if health is None:
+                ranked.append((0, 0, index, gateway))
+                continue
+            if health.is_open(now):
+                continue
+            degraded = int(health.score < self.min_score)
+            pdd = 0
+            if self.ordering == ORDERING_LATENCY and health.pdd is not None:
+                pdd = health.pdd
+            ranked.append((degraded, pdd, index, gateway))
+        if not ranked:
+            return gateways
+        ranked.sort()
+        return [ gateway for degraded, pdd, index, gateway in ranked ]
+
+    def get_status(self):
+        now = time.time()
+        gateways = {}
+        for gw, health in self._gateways.iteritems():
+            gateways[gw] = health.get_status(now)
+        return {'Ordering': self.ordering,
+                'Attempts': len(self._attempts),
+                'Gateways': gateways}
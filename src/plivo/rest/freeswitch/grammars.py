@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from collections import OrderedDict
+from hashlib import sha1
+import os
+import os.path
+import traceback
+import uuid
+
+from plivo.rest.freeswitch.helpers import ResourceMemo, get_grammar_resource
+
+
+GRAMMAR_PREFIX = 'plivo_'
+
+GRAMMAR_EXT = '.gram'
+
+
+class GrammarStore(object):
+    """Store of GetSpeech grammars written under grammarPath
+
+    Grammars are written once in a file named by their content digest,
+    so the speech engine gets the same file for the same grammar
+    and can reuse it instead of compiling a new file on every call.
+    Remote grammar urls are memoized to their file for ttl seconds.
+    At most max_files grammar files are kept, least recently used
+    files are removed first. Files held by a GetSpeech in progress
+    are only removed once released. Grammar files stored before start
+    are found on disk.
+    """
+    def __init__(self, log, grammar_path='', max_files=1000, ttl=60):
+        # url: (grammar path, file name)
+        self.memo = ResourceMemo(max_files, ttl)
+        # file path: None, in use order
+        self._files = OrderedDict()
+        # file path: number of GetSpeech holding it
+        self._holds = {}
+        self.grammar_path = None
+        self.configure(log, grammar_path, max_files, ttl)
+
+    def configure(self, log, grammar_path='', max_files=1000, ttl=60):
+        """Set limits when reloading, stored and held files are kept
+        """
+        self.log = log
+        self.max_files = max_files
+        self.memo.max_size = max_files
+        self.memo.ttl = ttl
+        grammar_path = grammar_path.rstrip(os.sep)
+        if grammar_path != self.grammar_path:
+            self.grammar_path = grammar_path
+            self.index_files()
+        self.evict()
+
+    def index_files(self):
+        """Index grammar files stored before start, oldest first
+        """
+        if not self.grammar_path:
+            return
+        try:
+            names = os.listdir(self.grammar_path)
+        except OSError:
+            return
+        files = []
+        for name in names:
+            if not name.startswith(GRAMMAR_PREFIX) or not name.endswith(GRAMMAR_EXT):
+                continue
+            path = os.path.join(self.grammar_path, name)
+            try:
+                files.append((os.stat(path).st_mtime, path))
+            except OSError:
+                continue
+        files.sort()
+        for mtime, path in files:
+            if not path in self._files:
+                self._files[path] = None
+
+    def get_file_name(self, raw_grammar):
+        return '%s%s%s' % (GRAMMAR_PREFIX, sha1(raw_grammar).hexdigest(), GRAMMAR_EXT)
+
+    def store(self, grammar_path, raw_grammar):
+        """Write raw_grammar under grammar_path if not already there,
+        returns the file name
+        """
+        name = self.get_file_name(raw_grammar)
+        path = os.path.join(grammar_path, name)
+        if not os.path.isfile(path):
+            # write then rename so a reader never gets a partial file
+            tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+            fd = open(tmp_path, 'w')
+            try:
+                fd.write(raw_grammar)
+            finally:
+                fd.close()
+            os.rename(tmp_path, path)
+            self.log.debug("Grammar stored to %s" % path)
+        self._use(path)
+        return name
+
+    def _use(self, path):
+        self._files.pop(path, None)
+        self._files[path] = None
+        # file just used is about to be held
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """Remove least recently used files beyond max_files,
+        held files and keep are skipped
+        """
+        excess = len(self._files) - self.max_files
+        if excess <= 0:
+            return
+        old_paths = []
+        for path in self._files:
+            if len(old_paths) == excess:
+                break
+            if path != keep and not path in self._holds:
+                old_paths.append(path)
+        for path in old_paths:
+            del self._files[path]
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def hold(self, grammar_path, name):
+        """Keep file name of grammar_path until released,
+        while the speech engine may read it
+        """
+        path = os.path.join(grammar_path, name)
+        self._holds[path] = self._holds.get(path, 0) + 1
+
+    def release(self, grammar_path, name):
+        path = os.path.join(grammar_path, name)
+        try:
+            count = self._holds.pop(path)
+        except KeyError:
+            return
+        if count > 1:
+            self._holds[path] = count - 1
+        else:
+            self.evict()
+
+    def get_file(self, socket, grammar, grammar_path=None):
+        """Returns the grammar file name under grammar_path,
+        None if grammar must be used as is (local file, url: or builtin:),
+        False if grammar cannot be fetched or written
+        """
+        if grammar_path is None:
+            grammar_path = self.grammar_path
+        cached = self.memo.get(grammar)
+        if cached and cached[0] == grammar_path:
+            path = os.path.join(grammar_path, cached[1])
+            if os.path.isfile(path):
+                socket.log.debug("Using stored grammar %s" % path)
+                self._use(path)
+                return cached[1]
+        raw_grammar = get_grammar_resource(socket, grammar)
+        if not raw_grammar:
+            return raw_grammar
+        try:
+            name = self.store(grammar_path, raw_grammar)
+        except Exception, e:
+            socket.log.error("Cannot write grammar %s to %s: %s" \
+                                % (grammar, grammar_path, str(e)))
+            return False
+        # raw grammars are already keyed by content
+        if grammar[:4] != 'raw:':
+            self.memo.set(grammar, (grammar_path, name))
+        return name
+
+    def warm(self, socket, grammars):
+        """Fetch and store grammars under the default grammar path
+        """
+        count = 0
+        for grammar in grammars:
+            try:
+                if self.get_file(socket, grammar):
+                    count += 1
+            except Exception, e:
+                self.log.error("Cannot warm grammar %s: %s" % (grammar, str(e)))
+                [ self.log.error(line) for line in \
+                            traceback.format_exc().splitlines() ]
+        self.log.info("Warmed %d grammars into %s" % (count, self.grammar_path))
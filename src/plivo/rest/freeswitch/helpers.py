@@ -5,6 +5,8 @@ from gevent import monkey
 monkey.patch_all()
 
 import base64
+from bisect import bisect
+from collections import OrderedDict
 import ConfigParser
 from hashlib import sha1
 import hmac
@@ -17,6 +19,15 @@ import urlparse
 import uuid
 import traceback
 import re
+import subprocess
+import time
+
+try:
+    import xml.etree.cElementTree as etree
+except ImportError:
+    from xml.etree.elementtree import ElementTree as etree
+
+import gevent
 import ujson as json
 from werkzeug.datastructures import MultiDict
 
@@ -32,6 +43,8 @@ MIME_TYPES = {'audio/mpeg': 'mp3',
               'audio/x-wav': 'wav',
               }
 
+TEMPLATE_PREFIX = 'template://'
+
 
 VALID_SOUND_PROTOCOLS = (
     "tone_stream://",
@@ -90,6 +103,11 @@ def is_valid_url(value):
         return False
     return value[:7] == 'http://' or value[:8] == 'https://'
 
+def is_template_url(value):
+    if not value:
+        return False
+    return value[:len(TEMPLATE_PREFIX)] == TEMPLATE_PREFIX
+
 def is_sip_url(value):
     if not value:
         return False
@@ -185,6 +203,16 @@ class HTTPRequest:
         return _request
 
     def fetch_response(self, uri, params={}, method='POST', log=None):
+        res = self.open_response(uri, params, method, log).read()
+        if log:
+            log.info("Sent to %s %s with %s -- Result: %s" \
+                                % (method, uri, params, res))
+        return res
+
+    def open_response(self, uri, params={}, method='POST', log=None):
+        """Send the request and return the response file object
+        without reading the body
+        """
         if not method in ('GET', 'POST'):
             raise NotImplementedError('HTTP %s method not implemented' \
                                                             % method)
@@ -203,11 +231,94 @@ class HTTPRequest:
             log.info("Fetching %s %s with %s" \
                             % (method, uri, _params))
         req = self._prepare_http_request(uri, _params, method)
-        res = urllib2.urlopen(req).read()
-        if log:
-            log.info("Sent to %s %s with %s -- Result: %s" \
-                                % (method, uri, _params, res))
-        return res
+        return urllib2.urlopen(req)
+
+
+class _StreamTarget(object):
+    """TreeBuilder target recording start and end events
+    """
+    def __init__(self):
+        self.builder = etree.TreeBuilder()
+        self.events = []
+
+    def start(self, tag, attrib):
+        element = self.builder.start(tag, attrib)
+        self.events.append(('start', element))
+        return element
+
+    def end(self, tag):
+        element = self.builder.end(tag)
+        self.events.append(('end', element))
+        return element
+
+    def data(self, data):
+        self.builder.data(data)
+
+    def close(self):
+        return self.builder.close()
+
+
+# bytes read at once from a RESTXML stream
+STREAM_CHUNK_SIZE = 4096
+
+
+def _read_available(response, size):
+    """Read at most size bytes of an identity encoded httplib response,
+    returns as soon as some bytes are received
+    """
+    if response.length is not None:
+        size = min(size, response.length)
+        if size <= 0:
+            return ''
+    fp = response.fp
+    # body bytes buffered while reading the headers go first
+    buf = fp._rbuf
+    buf.seek(0, 2)
+    buffered = buf.tell()
+    if buffered:
+        data = fp.read(min(size, buffered))
+    else:
+        data = fp._sock.recv(size)
+    if response.length is not None:
+        response.length -= len(data)
+    return data
+
+
+def get_stream_reader(fd):
+    """Returns read(size) of fd returning as soon as some bytes are
+    received when fd is an urllib2 response without chunked encoding
+
+    Other streams are read with fd.read(size), urllib2 responses
+    block there until size bytes or the end of the body are received.
+    """
+    response = getattr(getattr(fd, 'fp', None), '_sock', None)
+    if isinstance(response, httplib.HTTPResponse) and not response.chunked \
+        and response.fp is not None:
+        return lambda size: _read_available(response, size)
+    return fd.read
+
+
+def iterparse_stream(fd, chunk_size=STREAM_CHUNK_SIZE):
+    """Same as etree.iterparse(fd, events=('start', 'end')) but yields
+    each event as soon as its tag is received,
+    raises SyntaxError on invalid xml
+    """
+    read = get_stream_reader(fd)
+    target = _StreamTarget()
+    parser = etree.XMLParser(target=target)
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        parser.feed(chunk)
+        # events of each tag parsed in chunk, in order
+        events = target.events
+        target.events = []
+        for event in events:
+            yield event
+    parser.close()
+    for event in target.events:
+        yield event
 
 
 def get_config(filename):
@@ -313,6 +424,213 @@ class PlivoConfig(object):
         self.read()
 
 
+def get_shared_file_name(digest, suffix):
+    """Content addressed file name of a cached resource in shared path
+    """
+    return os.path.join(digest[:2], '%s%s' % (digest, suffix))
+
+
+class ResourceMemo(object):
+    """Bounded memo of cache server lookups, url: (cache_type, stream)
+
+    Entries expire after ttl seconds and least recently used
+    entries are dropped when max_size is reached.
+    """
+    def __init__(self, max_size=1000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+
+    def get(self, url):
+        try:
+            expires, value = self._items.pop(url)
+        except KeyError:
+            return None
+        if expires < time.time():
+            return None
+        # move to most recently used
+        self._items[url] = (expires, value)
+        return value
+
+    def set(self, url, value):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        self._items.pop(url, None)
+        self._items[url] = (time.time() + self.ttl, value)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def invalidate(self, url=None):
+        """Drop url from memo, or all urls if url is None
+        """
+        if url is None:
+            self._items.clear()
+        else:
+            self._items.pop(url, None)
+
+
+class CacheRing(object):
+    """Consistent hash ring of cache servers
+
+    Each server gets replicas points on the ring and a resource key
+    is served by the next server on the ring, then by the following
+    ones if it fails. A failing server is skipped for retry seconds.
+    """
+    def __init__(self, urls, replicas=100, retry=30, timeout=5):
+        self.urls = []
+        for url in urls:
+            url = url.strip().strip('/')
+            if url and not url in self.urls:
+                self.urls.append(url)
+        self.retry = retry
+        self.timeout = timeout
+        # url: time until server is skipped
+        self._down = {}
+        points = []
+        for url in self.urls:
+            for i in range(replicas):
+                points.append((self._hash('%s#%d' % (url, i)), url))
+        points.sort()
+        self._hashes = [ point[0] for point in points ]
+        self._nodes = [ point[1] for point in points ]
+
+    @staticmethod
+    def _hash(key):
+        return int(_md5(key).hexdigest()[:8], 16)
+
+    def get_urls(self, resource_key):
+        """Returns cache server urls for resource_key in ring order,
+        servers up first
+        """
+        if len(self.urls) < 2:
+            return list(self.urls)
+        urls = []
+        start = bisect(self._hashes, self._hash(resource_key))
+        for i in xrange(len(self._nodes)):
+            url = self._nodes[(start + i) % len(self._nodes)]
+            if not url in urls:
+                urls.append(url)
+                if len(urls) == len(self.urls):
+                    break
+        up = [ url for url in urls if self.is_up(url) ]
+        # down servers are last resort
+        return up + [ url for url in urls if not url in up ]
+
+    def is_up(self, url):
+        return self._down.get(url, 0) <= time.time()
+
+    def mark_down(self, url):
+        self._down[url] = time.time() + self.retry
+
+    def mark_up(self, url):
+        self._down.pop(url, None)
+
+    def check_health(self):
+        """Check all cache servers answer their index url
+        """
+        for url in self.urls:
+            try:
+                urllib2.urlopen('%s/' % url, timeout=self.timeout).read()
+                self.mark_up(url)
+            except Exception:
+                self.mark_down(url)
+
+
+def check_cache_health(server, interval):
+    """Check health of server cache ring every interval seconds
+    while server is running
+    """
+    while server._run:
+        gevent.sleep(interval)
+        ring = (server.cache or {}).get('ring')
+        if ring and len(ring.urls) > 1:
+            ring.check_health()
+
+
+def run_command(args):
+    """Run command without blocking other greenlets
+
+    Returns the command exit code
+    """
+    devnull = open(os.devnull, 'wb')
+    try:
+        proc = subprocess.Popen(args, stdout=devnull, stderr=devnull,
+                                close_fds=True)
+        while proc.poll() is None:
+            gevent.sleep(0.05)
+        return proc.returncode
+    finally:
+        devnull.close()
+
+
+def get_resource_key(url):
+    """Same key as the cache server ResourceCache.get_resource_key
+    """
+    return base64.urlsafe_b64encode(_md5(url).digest())
+
+
+def fetch_cache(socket, resource_key, path, data=None):
+    """Send a request to the cache server of resource_key,
+    failover to the next servers on the ring
+
+    Returns (cache_url, response)
+    """
+    ring = socket.cache['ring']
+    error = None
+    for cache_url in ring.get_urls(resource_key):
+        try:
+            req = urllib2.Request(cache_url + path, data)
+            handler = urllib2.urlopen(req, timeout=ring.timeout)
+            response = handler.read()
+            ring.mark_up(cache_url)
+            return cache_url, response
+        except urllib2.HTTPError, e:
+            # server answered, no failover
+            if e.code < 500:
+                raise
+            error = e
+        except Exception, e:
+            error = e
+        socket.log.warn("Cache server %s failed: %s" % (cache_url, str(error)))
+        ring.mark_down(cache_url)
+    raise error or Exception("No cache server")
+
+
+def get_cache_stream(socket, cache_url, url, result):
+    """Returns the playable stream of url from cache server
+    cache_url CacheType result, None if format is not supported
+    """
+    url_values = urllib.urlencode({'url': url})
+    cache_type = result['CacheType']
+    # play pre-transcoded variant, no transcoding needed
+    variant = socket.cache.get('variant')
+    if not variant in (result.get('Variants') or []):
+        variant = None
+    # play file from shared path with native file access
+    shared_path = socket.cache.get('shared_path')
+    digest = result.get('Digest')
+    if shared_path and digest:
+        if variant:
+            suffix = '.%s.wav' % variant
+        else:
+            suffix = '.%s' % cache_type
+        return os.path.join(shared_path,
+                            get_shared_file_name(digest, suffix))
+    if variant:
+        # needs mod_http_cache loaded in FreeSWITCH
+        return 'http_cache://%s/CacheFile/%s.%s.wav' \
+                        % (cache_url, result['ResourceKey'], variant)
+    if cache_type == 'wav':
+        wav_stream = 'shell_stream://%s %s/Cache/?%s' % (socket.cache['script'], cache_url, url_values)
+        return wav_stream
+    elif cache_type == 'mp3':
+        _url = cache_url[7:]
+        mp3_stream = "shout://%s/Cache/?%s" % (_url, url_values)
+        return mp3_stream
+    socket.log.warn("Unsupported format %s" % str(cache_type))
+    return None
+
+
 def get_resource(socket, url):
     try:
         if socket.cache:
@@ -321,30 +639,34 @@ def get_resource(socket, url):
                 and not url[:8].lower() == "https://":
                 return url
 
-            cache_url = socket.cache['url'].strip('/')
+            memo = socket.cache.get('memo')
+            if memo:
+                cached = memo.get(url)
+                if cached:
+                    return cached[1]
+
             data = {}
             data['url'] = url
             url_values = urllib.urlencode(data)
-            full_url = '%s/CacheType/?%s' % (cache_url, url_values)
-            req = urllib2.Request(full_url)
-            handler = urllib2.urlopen(req)
-            response = handler.read()
+            cache_url, response = fetch_cache(socket, get_resource_key(url),
+                                              '/CacheType/?%s' % url_values)
             result = json.loads(response)
-            cache_type = result['CacheType']
-            if cache_type == 'wav':
-                wav_stream = 'shell_stream://%s %s/Cache/?%s' % (socket.cache['script'], cache_url, url_values)
-                return wav_stream
-            elif cache_type == 'mp3':
-                _url = socket.cache['url'][7:].strip('/')
-                mp3_stream = "shout://%s/Cache/?%s" % (_url, url_values)
-                return mp3_stream
-            else:
-                socket.log.warn("Unsupported format %s" % str(cache_type))
+            stream = get_cache_stream(socket, cache_url, url, result)
+            if stream:
+                if memo:
+                    memo.set(url, (result['CacheType'], stream))
+                return stream
 
     except Exception, e:
         socket.log.error("Cache Error !")
         socket.log.error("Cache Error: %s" % str(e))
 
+    return get_uncached_stream(url)
+
+
+def get_uncached_stream(url):
+    """Returns the stream of url played without cache server
+    """
     if url[:7].lower() == "http://":
         if url[-4:] != ".wav":
             audio_path = url[7:]
@@ -353,10 +675,59 @@ def get_resource(socket, url):
         if url[-4:] != ".wav":
             audio_path = url[8:]
             url = "shout://%s" % audio_path
-
     return url
 
 
+def get_resources(socket, urls):
+    """Batch version of get_resource, returns the list of streams
+    of urls, looked up with one request by cache server
+    """
+    streams = {}
+    if socket.cache:
+        memo = socket.cache.get('memo')
+        lookups = []
+        for url in urls:
+            if not url[:7].lower() == "http://" \
+                and not url[:8].lower() == "https://":
+                streams[url] = url
+                continue
+            cached = None
+            if memo:
+                cached = memo.get(url)
+            if cached:
+                streams[url] = cached[1]
+            elif not url in lookups:
+                lookups.append(url)
+        # group urls by cache server
+        ring = socket.cache['ring']
+        groups = OrderedDict()
+        for url in lookups:
+            resource_key = get_resource_key(url)
+            cache_url = ring.get_urls(resource_key)[0]
+            groups.setdefault(cache_url, (resource_key, []))[1].append(url)
+        for resource_key, group in groups.values():
+            if len(group) == 1:
+                streams[group[0]] = get_resource(socket, group[0])
+                continue
+            try:
+                data = urllib.urlencode([ ('url', url) for url in group ])
+                cache_url, response = fetch_cache(socket, resource_key,
+                                                  '/CacheBatch/', data)
+                result = json.loads(response)
+                for res in result['Resources']:
+                    if not res['CacheType']:
+                        continue
+                    stream = get_cache_stream(socket, cache_url, res['Url'], res)
+                    if stream:
+                        if memo:
+                            memo.set(res['Url'], (res['CacheType'], stream))
+                        streams[res['Url']] = stream
+            except Exception, e:
+                socket.log.error("Cache Error !")
+                socket.log.error("Cache Error: %s" % str(e))
+    return [ streams.get(url) or get_uncached_stream(url) for url in urls ]
+
+
 def get_grammar_resource(socket, grammar):
     try:
         # don't do cache if not a remote file
@@ -378,20 +749,26 @@ def get_grammar_resource(socket, grammar):
         # do cache
         if socket.cache:
             try:
-                cache_url = socket.cache['url'].strip('/')
                 data = {}
                 data['url'] = grammar
                 url_values = urllib.urlencode(data)
-                full_url = '%s/CacheType/?%s' % (cache_url, url_values)
-                req = urllib2.Request(full_url)
-                handler = urllib2.urlopen(req)
-                response = handler.read()
-                result = json.loads(response)
-                cache_type = result['CacheType']
+                memo = socket.cache.get('memo')
+                cached = None
+                if memo:
+                    cached = memo.get(grammar)
+                if cached:
+                    cache_type, full_url = cached
+                else:
+                    cache_url, response = fetch_cache(socket, get_resource_key(grammar),
+                                                      '/CacheType/?%s' % url_values)
+                    result = json.loads(response)
+                    cache_type = result['CacheType']
+                    full_url = '%s/Cache/?%s' % (cache_url, url_values)
                 if not cache_type in ('grxml', 'jsgf'):
                     socket.log.warn("Unsupported format %s" % str(cache_type))
-                    raise("Unsupported format %s" % str(cache_type))
-                full_url = '%s/Cache/?%s' % (cache_url, url_values)
+                    raise Exception("Unsupported format %s" % str(cache_type))
+                if memo and not cached:
+                    memo.set(grammar, (cache_type, full_url))
                 socket.log.debug("Fetch grammar from %s" % str(full_url))
                 req = urllib2.Request(full_url)
                 handler = urllib2.urlopen(req)
@@ -5,6 +5,7 @@ from gevent import monkey
 monkey.patch_all()
 
 import os.path
+import time
 import uuid
 try:
     import xml.etree.cElementTree as etree
@@ -12,18 +13,26 @@ except ImportError:
     from xml.etree.elementtree import ElementTree as etree
 
 from gevent import spawn_raw
-from gevent import pool
 import gevent.event
 
 from plivo.core.freeswitch.inboundsocket import InboundEventSocket
 from plivo.rest.freeswitch.helpers import HTTPRequest, get_substring, \
                                         is_valid_url, \
                                         file_exists, normalize_url_space, \
-                                        get_resource, \
+                                        get_resources, \
                                         is_valid_sound_proto
+from plivo.rest.freeswitch.originate import OriginateScheduler
+from plivo.rest.freeswitch.gatewayhealth import GatewayMonitor
+from plivo.rest.freeswitch.callregistry import CallRegistry, \
+                                            parse_channel_uuids
+from plivo.rest.freeswitch.conferencecache import ConferenceCache
 
 
-EVENT_FILTER = "BACKGROUND_JOB CHANNEL_PROGRESS CHANNEL_PROGRESS_MEDIA CHANNEL_HANGUP_COMPLETE CHANNEL_STATE SESSION_HEARTBEAT CALL_UPDATE RECORD_STOP CUSTOM conference::maintenance"
+# seconds between checks of conference_sync_interval, changed by config reload
+CONFERENCE_SYNC_TICK = 1
+
+
+EVENT_FILTER = "BACKGROUND_JOB CHANNEL_CREATE CHANNEL_ANSWER CHANNEL_UNBRIDGE CHANNEL_PROGRESS CHANNEL_PROGRESS_MEDIA CHANNEL_HANGUP_COMPLETE CHANNEL_STATE SESSION_HEARTBEAT CALL_UPDATE RECORD_STOP CUSTOM conference::maintenance"
 
 
 class RESTInboundSocket(InboundEventSocket):
@@ -34,6 +43,7 @@ class RESTInboundSocket(InboundEventSocket):
         self.server = server
         self.log = self.server.log
         self.cache = self.server.get_cache()
+        self.speak_cache = self.server.speak_cache
 
         InboundEventSocket.__init__(self, self.get_server().fs_host,
                                     self.get_server().fs_port,
@@ -48,14 +58,119 @@ class RESTInboundSocket(InboundEventSocket):
         self.conf_sync_jobs = {}
         # Call Requests
         self.call_requests = {}
+        # Streamed BulkCall batches
+        self.batches = {}
+        # Active calls from channel events
+        self.active_calls = CallRegistry()
+        # Conference rooms and members from conference::maintenance events
+        self.conferences = ConferenceCache()
+        # Originate queue, paced by cps and gateway limits
+        self.scheduler = OriginateScheduler(self._dispatch_originate, self.log)
+        # Gateways health from call attempts
+        self.gateway_monitor = GatewayMonitor(self.log)
+        self.configure_scheduler()
 
     def get_server(self):
         return self.server
 
+    def connect(self):
+        # hangups may have been missed while disconnected
+        self.active_calls.clear()
+        self.conferences.clear()
+        res = InboundEventSocket.connect(self)
+        spawn_raw(self.seed_active_calls)
+        if self.get_server().conference_sync_interval > 0:
+            spawn_raw(self.reconcile_conferences)
+        return res
+
+    def seed_active_calls(self):
+        """Load plivo calls already up from FreeSWITCH
+        """
+        if not self.active_calls.begin_sync():
+            return
+        try:
+            res = self.api("show channels as json")
+            if not res.get_response():
+                self.log.warn("Active Calls Seed Failed -- no response")
+                return
+            count = 0
+            for call_uuid in parse_channel_uuids(res.get_response()):
+                res = self.api("uuid_dump %s json" % call_uuid)
+                dump = res.get_response()
+                # channel hung up since listed
+                if not dump or dump[:4] == '-ERR':
+                    continue
+                if self.active_calls.seed(dump):
+                    count += 1
+            self.log.info("Active Calls Seeded with %d calls" % count)
+        except Exception, e:
+            self.log.error("Active Calls Seed Failed -- %s" % str(e))
+        finally:
+            self.active_calls.end_sync()
+
+    def reconcile_conferences(self):
+        """Reload conference rooms and members from FreeSWITCH
+        """
+        if not self.conferences.begin_sync():
+            return
+        try:
+            res = self.conference_api(room='', command='xml_list', async=False)
+            if not res:
+                self.conferences.end_sync()
+                self.log.warn("Conference Reconcile Failed -- no response")
+                return
+            self.conferences.load_xml(res)
+            self.log.debug("Conference Reconcile Done")
+        except Exception, e:
+            self.conferences.end_sync()
+            self.log.error("Conference Reconcile Failed -- %s" % str(e))
+
+    def sync_conferences(self):
+        """Reconcile conferences every conference_sync_interval seconds
+        while server is running
+
+        The interval is read again every CONFERENCE_SYNC_TICK seconds,
+        so a config reload can disable the sync (interval 0) and enable
+        it again, conferences are then reconciled at once.
+        """
+        server = self.get_server()
+        last_sync = time.time()
+        while server._run:
+            gevent.sleep(CONFERENCE_SYNC_TICK)
+            interval = server.conference_sync_interval
+            if interval <= 0:
+                # model is not used nor reconciled while disabled
+                self.conferences.clear()
+                last_sync = 0
+                continue
+            now = time.time()
+            if now - last_sync >= interval and self.connected:
+                last_sync = now
+                self.reconcile_conferences()
+
     def reload_config(self):
         self.get_server().load_config(reload=True)
         self.log = self.server.log
         self.cache = self.server.get_cache()
+        self.speak_cache = self.server.speak_cache
+        self.scheduler.log = self.log
+        self.gateway_monitor.log = self.log
+        self.configure_scheduler()
+
+    def configure_scheduler(self):
+        server = self.get_server()
+        self.scheduler.configure(cps=server.originate_cps,
+                                 max_queue=server.originate_max_queue,
+                                 gateway_limits=server.gateway_limits,
+                                 max_calls=server.gateway_max_calls,
+                                 gateway_cps=server.gateway_cps,
+                                 account_limits=server.account_limits,
+                                 account_weight=server.account_weight,
+                                 account_max_calls=server.account_max_calls)
+        self.gateway_monitor.configure(ordering=server.gateway_ordering,
+                                       breaker_failures=server.gateway_breaker_failures,
+                                       cooldown=server.gateway_breaker_cooldown,
+                                       min_score=server.gateway_min_score)
 
     def get_extra_fs_vars(self, event):
         params = {}
@@ -85,6 +200,8 @@ class RESTInboundSocket(InboundEventSocket):
         self.send_to_url(self.get_server().record_url, params)
 
     def on_custom(self, event):
+        if event['Event-Subclass'] == 'conference::maintenance':
+            self.conferences.on_event(event)
         if event['Event-Subclass'] == 'conference::maintenance' \
             and event['Action'] == 'stop-recording':
             if not self.get_server().record_url:
@@ -143,7 +260,10 @@ class RESTInboundSocket(InboundEventSocket):
             # All other failures will be captured by on_channel_hangup
             status = status.strip()
             reason = reason.strip()
-            if status[:3] != '+OK':
+            if status[:3] == '+OK':
+                self.gateway_monitor.reached(request_uuid)
+            else:
+                self.gateway_monitor.failed(request_uuid, reason)
                 # In case ring/early state done, just warn
                 # releasing call request will be done in hangup event
                 if call_req.state_flag in ('Ringing', 'EarlyMedia'):
@@ -185,7 +305,18 @@ class RESTInboundSocket(InboundEventSocket):
             async_res.set(result)
             self.log.info("Conference Api (sync) Response for JobUUID %s -- %s" % (job_uuid, result))
 
+    def on_channel_create(self, event):
+        self.active_calls.update(event)
+
+    def on_channel_answer(self, event):
+        self.active_calls.update(event)
+
+    def on_channel_unbridge(self, event):
+        self.active_calls.update(event)
+        self.active_calls.set_bridge(event['Unique-ID'], '')
+
     def on_channel_progress(self, event):
+        self.active_calls.update(event)
         request_uuid = event['variable_plivo_request_uuid']
         direction = event['Call-Direction']
         # Detect ringing state
@@ -201,6 +332,7 @@ class RESTInboundSocket(InboundEventSocket):
                     call_req = self.call_requests[request_uuid]
                 except (KeyError, AttributeError):
                     return
+                self.gateway_monitor.reached(request_uuid)
                 # notify call and
                 self.log.debug("Notify Call success (Ringing) for RequestUUID %s" % request_uuid)
                 call_req.notify_call_end()
@@ -241,6 +373,7 @@ class RESTInboundSocket(InboundEventSocket):
                 spawn_raw(self.send_to_url, ring_url, params)
 
     def on_channel_progress_media(self, event):
+        self.active_calls.update(event)
         request_uuid = event['variable_plivo_request_uuid']
         direction = event['Call-Direction']
         # Detect early media state
@@ -252,6 +385,7 @@ class RESTInboundSocket(InboundEventSocket):
                 call_req = self.call_requests[request_uuid]
             except (KeyError, AttributeError):
                 return
+            self.gateway_monitor.reached(request_uuid)
             # notify call end
             self.log.debug("Notify Call success (EarlyMedia) for RequestUUID %s" % request_uuid)
             call_req.notify_call_end()
@@ -294,6 +428,9 @@ class RESTInboundSocket(InboundEventSocket):
     def on_call_update(self, event):
         """A Leg from API outbound call answered
         """
+        self.active_calls.update(event)
+        if event['Bridged-To']:
+            self.active_calls.set_bridge(event['Unique-ID'], event['Bridged-To'])
         # if plivo_app != 'true', check b leg Dial callback
         plivo_app_flag = event['variable_plivo_app'] == 'true'
         if not plivo_app_flag:
@@ -357,6 +494,7 @@ class RESTInboundSocket(InboundEventSocket):
     def on_channel_hangup_complete(self, event):
         """Capture Channel Hangup Complete
         """
+        self.active_calls.remove(event['Unique-ID'])
         # if plivo_app != 'true', check b leg Dial callback
 
         plivo_app_flag = event['variable_plivo_app'] == 'true'
@@ -556,6 +694,10 @@ class RESTInboundSocket(InboundEventSocket):
                 direction = "outbound"
                 self.call_requests[request_uuid] = None
                 del self.call_requests[request_uuid]
+                self.scheduler.finish(request_uuid)
+                self.gateway_monitor.discard(request_uuid)
+                if call_req.batch:
+                    call_req.batch.notify_end(reason)
             except (KeyError, AttributeError):
                 called_num = ''
                 caller_num = ''
@@ -616,25 +758,48 @@ class RESTInboundSocket(InboundEventSocket):
         except KeyError:
             self.log.warn("Call Request not found for RequestUUID %s" % request_uuid)
             return False
-        spawn_raw(self._spawn_originate, call_req)
-        self.log.warn("Call Request Spawned for RequestUUID %s" % request_uuid)
+        if not self.scheduler.submit([(request_uuid, call_req._accountsid)]):
+            self.log.error("Call Request Rejected for RequestUUID %s -- Originate Queue Full" \
+                                                                    % request_uuid)
+            self.call_requests.pop(request_uuid, None)
+            return False
+        self.log.info("Call Request Queued for RequestUUID %s" % request_uuid)
         return True
 
+    def _dispatch_originate(self, request_uuid):
+        try:
+            call_req = self.call_requests[request_uuid]
+        except KeyError:
+            self.log.warn("Call Request not found for RequestUUID %s" % request_uuid)
+            self.scheduler.finish(request_uuid)
+            return
+        spawn_raw(self._spawn_originate, call_req)
+        self.log.info("Call Request Spawned for RequestUUID %s" % request_uuid)
+
+    def end_call_request(self, request_uuid, cause):
+        """Drop a call request which will get no hangup event,
+        releases its originate slots and ends it in its batch
+        """
+        call_req = self.call_requests.pop(request_uuid, None)
+        self.scheduler.finish(request_uuid)
+        self.gateway_monitor.discard(request_uuid)
+        if call_req and call_req.batch:
+            call_req.batch.notify_end(cause)
+
     def _spawn_originate(self, call_req):
+        request_uuid = call_req.request_uuid
         try:
-            request_uuid = call_req.request_uuid
+            # skip gateways with an open circuit, healthy ones first
+            call_req.gateways = self.gateway_monitor.order(call_req.gateways)
             gw_count = len(call_req.gateways)
             for x in range(gw_count):
                 try:
                     gw = call_req.gateways.pop(0)
                 except IndexError:
-                    self.log.warn("No more Gateways to call for RequestUUID %s" % request_uuid)
-                    try:
-                        self.call_requests[request_uuid] = None
-                        del self.call_requests[request_uuid]
-                    except KeyError:
-                        pass
-                    return
+                    break
+
+                # wait for a call slot of this gateway, held until hangup
+                self.scheduler.acquire(request_uuid, gw.gw)
 
                 _options = []
                 # Set plivo app flag
@@ -660,21 +825,34 @@ class RESTInboundSocket(InboundEventSocket):
                 self.log.debug("spawn_originate: %s" % str(dial_str))
                 bg_api_response = self.bgapi(dial_str)
                 job_uuid = bg_api_response.get_job_uuid()
-                self.bk_jobs[job_uuid] = request_uuid
-                if not job_uuid:
+                self.gateway_monitor.start(request_uuid, gw.gw)
+                if job_uuid:
+                    self.bk_jobs[job_uuid] = request_uuid
+                else:
                     self.log.error("Call Failed for RequestUUID %s -- JobUUID not received" \
                                                                     % request_uuid)
+                    self.gateway_monitor.failed(request_uuid, 'JOB_FAILED')
+                    self.scheduler.release(request_uuid)
                     continue
                 # wait for current call attempt to finish
                 self.log.debug("Waiting Call attempt for RequestUUID %s ..." % request_uuid)
                 success = call_req.wait_call_attempt()
                 if success is True:
                     self.log.info("Call Attempt OK for RequestUUID %s" % request_uuid)
+                    # call request is gone if already hung up
+                    if not request_uuid in self.call_requests:
+                        self.scheduler.finish(request_uuid)
                     return
+                self.scheduler.release(request_uuid)
                 self.log.info("Call Attempt Failed for RequestUUID %s, retrying next gateway ..." % request_uuid)
                 continue
         except Exception, e:
-            self.log.error(str(e))
+            self.log.error("Call Failed for RequestUUID %s -- %s" % (request_uuid, str(e)))
+            self.end_call_request(request_uuid, 'ORIGINATE_ERROR')
+            return
+        # all attempts failed without any originate job
+        self.log.warn("No more Gateways to call for RequestUUID %s" % request_uuid)
+        self.end_call_request(request_uuid, 'NO_MORE_GATEWAYS')
 
     def group_originate(self, request_uuid, group_list, group_options=[], reject_causes=''):
         self.log.debug("GroupCall => %s %s" % (str(request_uuid), str(group_options)))
@@ -747,9 +925,19 @@ class RESTInboundSocket(InboundEventSocket):
     def bulk_originate(self, request_uuid_list):
         if request_uuid_list:
             self.log.info("BulkCall for RequestUUIDs %s" % str(request_uuid_list))
-            job_pool = pool.Pool(len(request_uuid_list))
-            [ job_pool.spawn(self.spawn_originate, request_uuid)
-                                        for request_uuid in request_uuid_list ]
+            requests = []
+            for request_uuid in request_uuid_list:
+                try:
+                    accountsid = self.call_requests[request_uuid]._accountsid
+                except KeyError:
+                    self.log.warn("Call Request not found for RequestUUID %s" % request_uuid)
+                    continue
+                requests.append((request_uuid, accountsid))
+            if not self.scheduler.submit(requests):
+                self.log.error("BulkCall Rejected -- Originate Queue Full")
+                for request_uuid in request_uuid_list:
+                    self.call_requests.pop(request_uuid, None)
+                return False
             return True
         self.log.error("BulkCall Failed -- No RequestUUID !")
         return False
@@ -890,6 +1078,11 @@ class RESTInboundSocket(InboundEventSocket):
             self.log.error("%s Failed -- Invalid legs arg '%s'" % (name, str(legs)))
             return False
 
+        # resolve all sound urls with one cache lookup
+        urls = [ normalize_url_space(sound) for sound in sounds_list \
+                    if not is_valid_sound_proto(sound) and is_valid_url(sound) ]
+        sound_file_paths = dict(zip(urls, get_resources(self, urls)))
+
         # get sound files
         sounds_to_play = []
         for sound in sounds_list:
@@ -902,7 +1095,7 @@ class RESTInboundSocket(InboundEventSocket):
                     self.log.warn("%s -- File %s not found" % (name, sound))
             else:
                 url = normalize_url_space(sound)
-                sound_file_path = get_resource(self, url)
+                sound_file_path = sound_file_paths.get(url)
                 if sound_file_path:
                     sounds_to_play.append(sound_file_path)
                 else:
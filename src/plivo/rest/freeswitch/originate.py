@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from collections import deque
+import time
+
+import gevent
+from gevent import spawn_raw
+from gevent.event import Event
+
+
+class TokenBucket(object):
+    """Token bucket filled with rate tokens per second, 0 for no limit
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'last')
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def set_rate(self, rate, burst=None):
+        """Change rate, tokens already taken are kept
+        """
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = min(self.tokens, self.burst)
+
+    def take(self):
+        """Take a token, returns seconds to wait before using it
+        """
+        if self.rate <= 0:
+            return 0
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        # token is reserved even if not available yet
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def give_back(self):
+        """Return a token taken but not used
+        """
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+
+class GatewayLimit(object):
+    """Max concurrent calls and calls per second of a gateway,
+    0 for no limit
+
+    active is the number of call slots taken, freed is set
+    when a slot is released or limits change.
+    """
+    __slots__ = ('max_calls', 'cps', 'bucket', 'active', 'freed')
+
+    def __init__(self, max_calls=0, cps=0):
+        self.max_calls = max_calls
+        self.cps = cps
+        self.bucket = TokenBucket(cps)
+        self.active = 0
+        self.freed = Event()
+
+    def set_limits(self, max_calls, cps):
+        """Change limits, calls in progress keep their slot
+        """
+        self.max_calls = max_calls
+        self.cps = cps
+        self.bucket.set_rate(cps)
+        self.freed.set()
+
+    def is_full(self):
+        return self.max_calls > 0 and self.active >= self.max_calls
+
+    def is_limited(self):
+        return self.max_calls > 0 or self.cps > 0
+
+
+def parse_gateway_limits(value):
+    """Parse 'gateway:max_calls:cps, ...' into {gateway: (max_calls, cps)}
+    """
+    limits = {}
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            gw, max_calls, cps = item.rsplit(':', 2)
+            limits[gw.strip()] = (int(max_calls), float(cps))
+        except ValueError:
+            raise ValueError("Invalid gateway limit '%s'" % item)
+    return limits
+
+
+def parse_account_limits(value):
+    """Parse 'accountsid:weight:max_calls, ...' into {accountsid: (weight, max_calls)}
+    """
+    limits = {}
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            account, weight, max_calls = item.rsplit(':', 2)
+            weight = float(weight)
+            if weight <= 0:
+                raise ValueError
+            limits[account.strip()] = (weight, int(max_calls))
+        except ValueError:
+            raise ValueError("Invalid account limit '%s'" % item)
+    return limits
+
+
+class AccountQueue(object):
+    """Queued call requests of an AccountSID
+
+    vtime is the virtual time of the next dispatch, increased by
+    1 / weight on each dispatch so accounts get calls in proportion
+    to their weight.
+    """
+    __slots__ = ('queue', 'weight', 'max_calls', 'active', 'vtime',
+                 'dispatched', 'wait_sum', 'wait_max')
+
+    def __init__(self, weight=1, max_calls=0):
+        # (request_uuid, queued time)
+        self.queue = deque()
+        self.weight = weight
+        self.max_calls = max_calls
+        self.active = 0
+        self.vtime = 0.0
+        self.dispatched = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+
+    def is_full(self):
+        return self.max_calls > 0 and self.active >= self.max_calls
+
+    def get_status(self):
+        wait_avg = 0.0
+        if self.dispatched:
+            wait_avg = self.wait_sum / self.dispatched
+        return {'Queued': len(self.queue),
+                'Active': self.active,
+                'Dispatched': self.dispatched,
+                'WaitAvg': round(wait_avg, 3),
+                'WaitMax': round(self.wait_max, 3),
+                'Weight': self.weight,
+                'MaxCalls': self.max_calls}
+
+
+class OriginateScheduler(object):
+    """Central queue of call requests to originate
+
+    Requests are queued by AccountSID and dispatched to spawn(request_uuid)
+    at most cps per second, with weighted fair queuing between accounts
+    so a big BulkCall doesn't delay the calls of other accounts.
+    An account has at most max_calls calls from dispatch to hangup.
+    Requests are rejected when max_queue requests are already queued.
+    Each call attempt then waits for a slot of its gateway, taken until
+    the call is hung up, and for the gateway calls per second.
+    gateway_limits is {gateway: (max_calls, cps)}, other gateways use
+    max_calls and gateway_cps. account_limits is
+    {accountsid: (weight, max_calls)}, other accounts use account_weight
+    and account_max_calls. 0 means no limit.
+    """
+    def __init__(self, spawn, log, cps=0, max_queue=0, gateway_limits=None,
+                 max_calls=0, gateway_cps=0, account_limits=None,
+                 account_weight=1, account_max_calls=0):
+        self.spawn = spawn
+        self.log = log
+        # accountsid: AccountQueue
+        self._accounts = {}
+        self._queued = 0
+        # virtual time of last dispatch
+        self._vtime = 0.0
+        self._running = False
+        self._wake = Event()
+        # request_uuid: AccountQueue, from dispatch to hangup
+        self._active = {}
+        # request_uuid: (gateway, GatewayLimit)
+        self._held = {}
+        # gateway: GatewayLimit
+        self._gateways = {}
+        self.waiting = 0
+        self.dispatched = 0
+        self.rejected = 0
+        self.bucket = TokenBucket(cps)
+        self.configure(cps, max_queue, gateway_limits, max_calls, gateway_cps,
+                       account_limits, account_weight, account_max_calls)
+
+    def configure(self, cps=0, max_queue=0, gateway_limits=None,
+                  max_calls=0, gateway_cps=0, account_limits=None,
+                  account_weight=1, account_max_calls=0):
+        """Set limits, calls in progress keep the slot they hold
+        """
+        self.cps = cps
+        # tokens already taken are kept, a reload doesn't allow a burst
+        self.bucket.set_rate(cps)
+        self.max_queue = max_queue
+        self.gateway_limits = gateway_limits or {}
+        self.max_calls = max_calls
+        self.gateway_cps = gateway_cps
+        for gw, limit in self._gateways.items():
+            limit.set_limits(*self.gateway_limits.get(gw,
+                                    (self.max_calls, self.gateway_cps)))
+            # don't keep unlimited gateways
+            if not limit.active and not limit.is_limited():
+                del self._gateways[gw]
+        self.account_limits = account_limits or {}
+        self.account_weight = account_weight
+        self.account_max_calls = account_max_calls
+        for account, account_queue in self._accounts.iteritems():
+            account_queue.weight, account_queue.max_calls = \
+                    self.account_limits.get(account,
+                            (self.account_weight, self.account_max_calls))
+        self._wake.set()
+
+    def get_account(self, account):
+        try:
+            return self._accounts[account]
+        except KeyError:
+            weight, max_calls = self.account_limits.get(account,
+                                    (self.account_weight, self.account_max_calls))
+            account_queue = AccountQueue(weight, max_calls)
+            self._accounts[account] = account_queue
+            return account_queue
+
+    def has_room(self, count=1):
+        """Queue has room for count more requests
+        """
+        return self.max_queue <= 0 or self._queued + count <= self.max_queue
+
+    def submit(self, requests):
+        """Queue requests, a list of (request_uuid, accountsid),
+        returns False if the queue has no room for all of them
+        """
+        if not self.has_room(len(requests)):
+            self.rejected += len(requests)
+            self.log.warn("Originate queue full (%d queued), %d requests rejected" \
+                                    % (self._queued, len(requests)))
+            return False
+        now = time.time()
+        for request_uuid, account in requests:
+            account_queue = self.get_account(account)
+            if not account_queue.queue:
+                # idle account doesn't get credit for the time it was idle
+                account_queue.vtime = max(account_queue.vtime, self._vtime)
+            account_queue.queue.append((request_uuid, now))
+        self._queued += len(requests)
+        self._wake.set()
+        if not self._running:
+            self._running = True
+            spawn_raw(self._dispatch)
+        return True
+
+    def _next_account(self):
+        """Account with queued requests and lowest virtual time,
+        None if all of them have max calls
+        """
+        best = None
+        for account_queue in self._accounts.itervalues():
+            if not account_queue.queue or account_queue.is_full():
+                continue
+            if best is None or account_queue.vtime < best.vtime:
+                best = account_queue
+        return best
+
+    def _dispatch(self):
+        try:
+            while self._queued:
+                account_queue = self._next_account()
+                if account_queue is None:
+                    # wait for a call to end or a new account
+                    self._wake.clear()
+                    self._wake.wait()
+                    continue
+                # token is only taken for a request that can be dispatched
+                wait = self.bucket.take()
+                if wait > 0:
+                    gevent.sleep(wait)
+                    # a new account or a config reload may have
+                    # changed the next account while waiting
+                    account_queue = self._next_account()
+                    if account_queue is None:
+                        # token is used by the next dispatch
+                        self.bucket.give_back()
+                        continue
+                self._vtime = account_queue.vtime
+                account_queue.vtime += 1.0 / account_queue.weight
+                request_uuid, queued = account_queue.queue.popleft()
+                self._queued -= 1
+                waited = time.time() - queued
+                account_queue.dispatched += 1
+                account_queue.wait_sum += waited
+                account_queue.wait_max = max(account_queue.wait_max, waited)
+                account_queue.active += 1
+                self._active[request_uuid] = account_queue
+                self.dispatched += 1
+                try:
+                    self.spawn(request_uuid)
+                except Exception, e:
+                    self.log.error("Originate dispatch failed for RequestUUID %s: %s" \
+                                                        % (request_uuid, str(e)))
+        finally:
+            self._running = False
+
+    def finish(self, request_uuid):
+        """Call request is done, release its gateway slot
+        and its account call
+        """
+        self.release(request_uuid)
+        account_queue = self._active.pop(request_uuid, None)
+        if account_queue is not None:
+            account_queue.active -= 1
+            self._wake.set()
+
+    def get_gateway(self, gw):
+        try:
+            return self._gateways[gw]
+        except KeyError:
+            max_calls, cps = self.gateway_limits.get(gw,
+                                    (self.max_calls, self.gateway_cps))
+            limit = GatewayLimit(max_calls, cps)
+            self._gateways[gw] = limit
+            return limit
+
+    def acquire(self, request_uuid, gw):
+        """Wait for a call slot and calls per second of gateway gw
+        """
+        limit = self.get_gateway(gw)
+        self.waiting += 1
+        try:
+            while limit.is_full():
+                limit.freed.clear()
+                limit.freed.wait()
+            limit.active += 1
+            try:
+                wait = limit.bucket.take()
+                if wait > 0:
+                    gevent.sleep(wait)
+            except:
+                self._release_slot(gw, limit)
+                raise
+        finally:
+            self.waiting -= 1
+        self._held[request_uuid] = (gw, limit)
+
+    def release(self, request_uuid):
+        """Release gateway slot held by request_uuid
+        """
+        try:
+            gw, limit = self._held.pop(request_uuid)
+        except KeyError:
+            return
+        self._release_slot(gw, limit)
+
+    def _release_slot(self, gw, limit):
+        limit.active -= 1
+        limit.freed.set()
+        # don't keep unlimited gateways
+        if not limit.active and not limit.is_limited() \
+            and self._gateways.get(gw) is limit:
+            del self._gateways[gw]
+
+    def get_status(self, call_requests):
+        dialing = 0
+        ringing = 0
+        for request_uuid in self._held:
+            call_req = call_requests.get(request_uuid)
+            # ringing or early media, then answered until hangup
+            if call_req and call_req.state_flag:
+                ringing += 1
+            else:
+                dialing += 1
+        gateways = {}
+        for gw, limit in self._gateways.iteritems():
+            gateways[gw] = {'Active': limit.active,
+                            'MaxCalls': limit.max_calls,
+                            'CPS': limit.cps}
+        accounts = {}
+        for account, account_queue in self._accounts.iteritems():
+            accounts[account] = account_queue.get_status()
+        return {'Queued': self._queued,
+                'Waiting': self.waiting,
+                'Dialing': dialing,
+                'Ringing': ringing,
+                'Dispatched': self.dispatched,
+                'Rejected': self.rejected,
+                'Gateways': gateways,
+                'Accounts': accounts}
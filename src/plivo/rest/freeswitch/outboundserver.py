@@ -17,6 +17,9 @@ import gevent
 from plivo.core.freeswitch import outboundsocket
 from plivo.rest.freeswitch.outboundsocket import PlivoOutboundEventSocket
 from plivo.rest.freeswitch import helpers
+from plivo.rest.freeswitch.templates import TemplateStore
+from plivo.rest.freeswitch.grammars import GrammarStore
+from plivo.rest.freeswitch.speakcache import create_speak_cache
 import plivo.utils.daemonize
 from plivo.utils.logger import StdoutLogger, FileLogger, SysLogger, DummyLogger, HTTPLogger
 
@@ -39,6 +42,10 @@ class PlivoOutboundServer(outboundsocket.OutboundServer):
         # load config
         self._config = None
         self.cache = {}
+        self.templates = None
+        self.grammars = None
+        self.grammar_warm = []
+        self.speak_cache = None
         self.load_config()
 
         # This is where we define the connection with the
@@ -84,17 +91,58 @@ class PlivoOutboundServer(outboundsocket.OutboundServer):
             self.extra_fs_vars = config.get('common', 'EXTRA_FS_VARS', default='')
             self.proxy_url = config.get('common', 'PROXY_URL', default=None)
 
+            # execute restxml elements while downloading
+            self.stream_xml = config.get('outbound_server', 'STREAM_RESTXML', default='false') == 'true'
+
             # load cache params
             self.cache['url'] = config.get('common', 'CACHE_URL', default='')
             self.cache['script'] = config.get('common', 'CACHE_SCRIPT', default='')
+            self.cache['variant'] = config.get('common', 'CACHE_VARIANT', default='')
+            self.cache['shared_path'] = config.get('common', 'CACHE_SHARED_PATH', default='')
+            # memo of cache server lookups
+            self.cache['memo'] = helpers.ResourceMemo(
+                    int(config.get('common', 'CACHE_MEMO_SIZE', default='1000')),
+                    int(config.get('common', 'CACHE_MEMO_TTL', default='60')))
             if not self.cache['url'] or not self.cache['script']:
                 self.cache = {}
+            else:
+                # comma separated cache servers, sharded by resource
+                self.cache['ring'] = helpers.CacheRing(self.cache['url'].split(','),
+                        retry=int(config.get('common', 'CACHE_RETRY', default='30')),
+                        timeout=int(config.get('common', 'CACHE_TIMEOUT', default='5')))
+            self.cache_health_interval = int(config.get('common',
+                                        'CACHE_HEALTH_INTERVAL', default='10'))
 
             # create new logger if reloading
             if reload:
                 self.create_logger(config=config)
                 self.log.warn("New logger %s" % str(self.log))
 
+            # load restxml templates
+            templates = TemplateStore(config.get('outbound_server', 'TEMPLATE_DIR', default=''), self.log)
+            templates.load()
+            self.templates = templates
+
+            # getspeech grammars stored by content digest
+            grammar_path = config.get('outbound_server', 'GRAMMAR_PATH',
+                                      default='/usr/local/freeswitch/grammar')
+            grammar_max_files = int(config.get('outbound_server', 'GRAMMAR_MAX_FILES', default='1000'))
+            memo_ttl = int(config.get('common', 'CACHE_MEMO_TTL', default='60'))
+            # keep stored and held grammars when reloading
+            if self.grammars:
+                self.grammars.configure(self.log, grammar_path,
+                                        grammar_max_files, memo_ttl)
+            else:
+                self.grammars = GrammarStore(self.log, grammar_path,
+                                             grammar_max_files, memo_ttl)
+            # grammars to store at startup, separated by ;
+            self.grammar_warm = [ grammar.strip() for grammar in \
+                    config.get('outbound_server', 'GRAMMAR_WARM', default='').split(';') \
+                    if grammar.strip() ]
+
+            # cache of speak phrases rendered to files
+            self.speak_cache = create_speak_cache(config, self.log)
+
             # set new config
             self._config = config
             self.log.info("Config : %s" % str(self._config.dumps()))
@@ -134,7 +182,11 @@ class PlivoOutboundServer(outboundsocket.OutboundServer):
                                  auth_token=self.secret,
                                  request_id=request_id,
                                  trace=self._trace,
-                                 proxy_url=self.proxy_url
+                                 proxy_url=self.proxy_url,
+                                 stream_xml=self.stream_xml,
+                                 templates=self.templates,
+                                 grammars=self.grammars,
+                                 speak_cache=self.speak_cache
                                 )
         self.log.info("(%d) End request from %s" % (request_id, str(address)))
         try:
@@ -224,6 +276,13 @@ class PlivoOutboundServer(outboundsocket.OutboundServer):
         self._run = True
         if self._daemon:
             self.do_daemon()
+        # check cache servers health
+        if self.cache_health_interval > 0:
+            gevent.spawn_raw(helpers.check_cache_health, self,
+                             self.cache_health_interval)
+        # store startup grammars
+        if self.grammar_warm:
+            gevent.spawn_raw(self.grammars.warm, self, self.grammar_warm)
         super(PlivoOutboundServer, self).start()
         self.log.info("OutboundServer started at '%s'" \
                                     % str(self.fs_outbound_address))
@@ -18,7 +18,10 @@ from gevent.event import AsyncResult
 
 from plivo.utils.encode import safe_str
 from plivo.core.freeswitch.eventtypes import Event
-from plivo.rest.freeswitch.helpers import HTTPRequest, get_substring
+from plivo.rest.freeswitch.helpers import HTTPRequest, get_substring, \
+                                        is_template_url, iterparse_stream
+from plivo.rest.freeswitch.templates import parse_template_url
+from plivo.rest.freeswitch.grammars import GrammarStore
 from plivo.core.freeswitch.outboundsocket import OutboundEventSocket
 from plivo.rest.freeswitch import elements
 from plivo.rest.freeswitch.exceptions import RESTFormatException, \
@@ -94,7 +97,11 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
                  auth_token='',
                  request_id=0,
                  trace=False,
-                 proxy_url=None):
+                 proxy_url=None,
+                 stream_xml=False,
+                 templates=None,
+                 grammars=None,
+                 speak_cache=None):
         # the request id
         self._request_id = request_id
         # set logger
@@ -121,6 +128,16 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
         self.default_hangup_url = default_hangup_url
         # set proxy url
         self.proxy_url =  proxy_url
+        # set streaming restxml flag
+        self.stream_xml = stream_xml
+        # set restxml template store
+        self.templates = templates
+        # set getspeech grammar store
+        if grammars is None:
+            grammars = GrammarStore(self.log)
+        self.grammars = grammars
+        # set speak render cache
+        self.speak_cache = speak_cache
         # set default http method POST or GET
         self.default_http_method = default_http_method
         # identify the extra FS variables to be passed along
@@ -486,6 +503,17 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
                 # case answer url, add extra vars to http request :
                 if x == 0:
                     params = self.get_extra_fs_vars(event=self.get_channel())
+                # execute local restxml template, no fetch needed
+                if is_template_url(self.target_url):
+                    self.load_template(params=params)
+                    self.execute_xml()
+                    self.log.info('End of RESTXML')
+                    return
+                # fetch and execute restxml while downloading
+                if self.stream_xml:
+                    self.stream_and_execute_xml(params=params)
+                    self.log.info('End of RESTXML')
+                    return
                 # fetch remote restxml
                 self.fetch_xml(params=params)
                 # check hangup
@@ -550,6 +578,110 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
         self.xml_response = self.send_to_url(self.target_url, params, method)
         self.log.info("Requested RESTXML to %s" % self.target_url)
 
+    def load_template(self, params={}):
+        """
+        This method will render the local RESTXML template
+        from target_url template://name?lang=xx into parsed_element
+        """
+        name, template_params = parse_template_url(self.target_url)
+        template = None
+        if self.templates:
+            template = self.templates.get(name, template_params.get('lang'))
+        if not template:
+            self.log.warn('No RESTXML template %s' % self.target_url)
+            if not self.has_hangup():
+                self.hangup()
+            raise RESTHangup()
+        self.log.info("Using RESTXML template %s" % self.target_url)
+        template_vars = dict(params)
+        template_vars.update(self.session_params)
+        template_vars.update(template_params)
+        self.parsed_element = template.render(template_vars)
+
+    def stream_and_execute_xml(self, params={}, method=None):
+        """
+        This method will retrieve the xml from the answer_url
+        and execute each Element as soon as its end tag is received,
+        without waiting for the whole RESTXML document.
+        Elements already executed are not rolled back if a later
+        Element is invalid.
+        """
+        self.log.info("Streaming RESTXML from %s" % self.target_url)
+        fd = self.open_url(self.target_url, params, method)
+        if self.has_hangup():
+            if fd:
+                fd.close()
+            raise RESTHangup()
+        if not fd:
+            self.log.warn('No XML Response')
+            if not self.has_hangup():
+                self.hangup()
+            raise RESTHangup()
+        try:
+            self.lex_xml_stream(fd)
+        finally:
+            fd.close()
+        self.end_xml()
+
+    def lex_xml_stream(self, fd):
+        """
+        Validate, parse and execute each top level Element
+        while the RESTXML document is incrementally parsed
+        """
+        depth = 0
+        root = None
+        try:
+            for event, element in iterparse_stream(fd):
+                if event == 'start':
+                    depth += 1
+                    if depth == 1:
+                        # Make sure the document has a <Response> root
+                        if element.tag != 'Response':
+                            raise RESTFormatException('No Response Tag Present')
+                        root = element
+                    elif depth == 2 and \
+                        not element.tag in elements.ELEMENTS_REGISTRY:
+                        raise UnrecognizedElementException(
+                            "Unrecognized Element: %s" % [element.tag])
+                    continue
+                depth -= 1
+                if depth != 1:
+                    continue
+                # top level element is complete, run it now
+                for node in element.iter():
+                    if node.text:
+                        node.text = ' '.join(node.text.split())
+                self.lexed_xml_response = [element]
+                self.parse_xml()
+                root.clear()
+                self.execute_element(self.parsed_element.pop(0))
+        except SyntaxError, e:
+            raise RESTSyntaxException("Invalid RESTXML Response Syntax: %s" \
+                        % str(e))
+        finally:
+            self.lexed_xml_response = []
+            self.parsed_element = []
+
+    def open_url(self, url=None, params={}, method=None):
+        """
+        This method will do an http POST or GET request to the Url
+        and return the response file object
+        """
+        if method is None:
+            method = self.default_http_method
+
+        if not url:
+            self.log.warn("Cannot send %s, no url !" % method)
+            return None
+        params.update(self.session_params)
+        try:
+            http_obj = HTTPRequest(self.key, self.secret, proxy_url=self.proxy_url)
+            return http_obj.open_response(url, params, method, log=self.log)
+        except Exception, e:
+            self.log.error("Sending to %s %s with %s -- Error: %s" \
+                                        % (method, url, params, e))
+        return None
+
     def send_to_url(self, url=None, params={}, method=None):
         """
         This method will do an http POST or GET request to the Url
@@ -590,7 +722,7 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
         # Make sure we recognize all the Element in the xml
         for element in doc:
             invalid_element = []
-            if not hasattr(elements, element.tag):
+            if not element.tag in elements.ELEMENTS_REGISTRY:
                 invalid_element.append(element.tag)
             else:
                 self.lexed_xml_response.append(element)
@@ -605,30 +737,36 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
         """
         # Check all Elements tag name
         for element in self.lexed_xml_response:
-            element_class = getattr(elements, str(element.tag), None)
+            element_class = elements.ELEMENTS_REGISTRY[element.tag].klass
             element_instance = element_class()
             element_instance.parse_element(element, self.target_url)
             self.parsed_element.append(element_instance)
             # Validate, Parse & Store the nested children
             # inside the main element element
             self.validate_element(element, element_instance)
+        # etree is not needed anymore, parsed elements hold everything
+        self.lexed_xml_response = []
 
     def validate_element(self, element, element_instance):
         children = element.getchildren()
-        if children and not element_instance.nestables:
+        nestables = elements.ELEMENTS_REGISTRY[element_instance.name].nestables
+        if children and not nestables:
             raise RESTFormatException("%s cannot have any children!"
                                             % element_instance.name)
         for child in children:
-            if child.tag not in element_instance.nestables:
+            if child.tag not in nestables:
                 raise RESTFormatException("%s is not nestable inside %s"
                                             % (child, element_instance.name))
             else:
                 self.parse_children(child, element_instance)
 
     def parse_children(self, child_element, parent_instance):
-        child_element_class = getattr(elements, str(child_element.tag), None)
+        child_element_class = \
+                elements.ELEMENTS_REGISTRY[child_element.tag].klass
         child_element_instance = child_element_class()
         child_element_instance.parse_element(child_element, None)
+        # validate nested children now, before the etree is released
+        self.validate_element(child_element, child_element_instance)
         parent_instance.children.append(child_element_instance)
 
     def execute_xml(self):
@@ -639,22 +777,7 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
                 except IndexError:
                     self.log.warn("No more Elements !")
                     break
-                if hasattr(element_instance, 'prepare'):
-                    # TODO Prepare element concurrently
-                    element_instance.prepare(self)
-                # Check if it's an inbound call
-                if self.session_params['Direction'] == 'inbound':
-                    # Answer the call if element need it
-                    if not self.answered and \
-                        not element_instance.name in self.NO_ANSWER_ELEMENTS:
-                        self.log.debug("Answering because Element %s need it" \
-                            % element_instance.name)
-                        self.answer()
-                        self.answered = True
-                        # After answer, update callstatus to 'in-progress'
-                        self.session_params['CallStatus'] = 'in-progress'
-                # execute Element
-                element_instance.run(self)
+                self.execute_element(element_instance)
                 try:
                     del element_instance
                 except:
@@ -664,7 +787,27 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
             for element in self.parsed_element:
                 element = None
             self.parsed_element = []
-
+        self.end_xml()
+
+    def execute_element(self, element_instance):
+        if hasattr(element_instance, 'prepare'):
+            # TODO Prepare element concurrently
+            element_instance.prepare(self)
+        # Check if it's an inbound call
+        if self.session_params['Direction'] == 'inbound':
+            # Answer the call if element need it
+            if not self.answered and \
+                not element_instance.name in self.NO_ANSWER_ELEMENTS:
+                self.log.debug("Answering because Element %s need it" \
+                    % element_instance.name)
+                self.answer()
+                self.answered = True
+                # After answer, update callstatus to 'in-progress'
+                self.session_params['CallStatus'] = 'in-progress'
+        # execute Element
+        element_instance.run(self)
+
+    def end_xml(self):
         # If transfer is in progress, don't hangup call
         if not self.has_hangup():
             xfer_progress = self.get_var('plivo_transfer_progress') == 'true'
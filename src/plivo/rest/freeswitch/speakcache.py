@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from collections import OrderedDict
+from hashlib import sha1
+import os
+import os.path
+import traceback
+import uuid
+
+from gevent import spawn_raw
+
+from plivo.utils.encode import safe_str
+from plivo.rest.freeswitch.helpers import run_command
+
+
+SPEAK_EXT = '.wav'
+
+# text is read from a file, a text starting with '-'
+# would be read as an option with -t {text}
+DEFAULT_COMMAND = 'flite -voice {voice} -f {textfile} -o {file}'
+
+
+class SpeakCache(object):
+    """Cache of Speak phrases rendered to wav files
+
+    cache_path must be readable by FreeSWITCH, phrases found there are
+    played as files instead of being synthesized again by the media server.
+    A missing phrase is spoken as usual and rendered in background by
+    command, an argument list where {engine}, {voice}, {language},
+    {text}, {textfile} (a file holding the text) and {file} are
+    replaced. Only phrases of engines are rendered. Least recently used
+    files are removed when the cache exceeds max_size bytes.
+    Files rendered by other servers sharing cache_path are found on disk.
+    """
+    def __init__(self, log, cache_path, command=DEFAULT_COMMAND,
+                 engines=('flite',), max_size=256*1024*1024, max_renders=2):
+        self.log = log
+        self.cache_path = cache_path
+        self.command = command.split()
+        self.engines = frozenset(engines)
+        self.max_size = max_size
+        self.max_renders = max_renders
+        self.size = 0
+        # file path: size, in use order
+        self._files = OrderedDict()
+        # keys being rendered
+        self._renders = set()
+        self.index_files()
+
+    def index_files(self):
+        """Index files rendered before start, oldest first
+        """
+        files = []
+        for dirpath, dirnames, filenames in os.walk(self.cache_path):
+            for filename in filenames:
+                if not filename.endswith(SPEAK_EXT):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        files.sort()
+        for mtime, path, size in files:
+            self._files[path] = size
+            self.size += size
+        self.evict()
+
+    def get_key(self, engine, voice, language, text):
+        return sha1(safe_str('\0'.join((engine, voice, language, text)))).hexdigest()
+
+    def get_file_path(self, key):
+        return os.path.join(self.cache_path, key[:2], key + SPEAK_EXT)
+
+    def get_file(self, engine, voice, language, text):
+        """Returns the rendered file of text, None if not rendered yet
+        """
+        if not text or not engine in self.engines:
+            return None
+        key = self.get_key(engine, voice, language, text)
+        path = self.get_file_path(key)
+        try:
+            size = self._files.pop(path)
+        except KeyError:
+            # rendered by another server sharing cache_path
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                self.render(key, engine, voice, language, text)
+                return None
+            self._files[path] = size
+            self.size += size
+            self.evict()
+            if path in self._files:
+                return path
+            return None
+        if not os.path.isfile(path):
+            self.size -= size
+            self.render(key, engine, voice, language, text)
+            return None
+        # move to most recently used
+        self._files[path] = size
+        return path
+
+    def render(self, key, engine, voice, language, text):
+        """Render text in background, skipped if too many renders
+        are running
+        """
+        if key in self._renders or len(self._renders) >= self.max_renders:
+            return
+        self._renders.add(key)
+        spawn_raw(self._render, key, engine, voice, language, text)
+
+    def _render(self, key, engine, voice, language, text):
+        path = self.get_file_path(key)
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        text_path = '%s.%s.txt' % (path, uuid.uuid4().hex)
+        params = {'engine': safe_str(engine), 'voice': safe_str(voice),
+                  'language': safe_str(language), 'text': safe_str(text),
+                  'textfile': text_path, 'file': tmp_path}
+        try:
+            try:
+                dirpath = os.path.dirname(path)
+                if not os.path.isdir(dirpath):
+                    os.makedirs(dirpath)
+                fd = open(text_path, 'w')
+                try:
+                    fd.write(params['text'])
+                finally:
+                    fd.close()
+                args = [ arg.format(**params) for arg in self.command ]
+                code = run_command(args)
+                if code != 0 or not os.path.isfile(tmp_path):
+                    self.log.error("Speak render of '%s' failed (exit code %s)" \
+                                                            % (text, str(code)))
+                    return
+                os.rename(tmp_path, path)
+                size = os.path.getsize(path)
+                self.size -= self._files.pop(path, 0)
+                self._files[path] = size
+                self.size += size
+                self.log.debug("Speak '%s' rendered to %s" % (text, path))
+                self.evict()
+            except Exception, e:
+                self.log.error("Speak render of '%s' failed: %s" % (text, str(e)))
+                [ self.log.error(line) for line in \
+                            traceback.format_exc().splitlines() ]
+        finally:
+            self._renders.discard(key)
+            for file_path in (tmp_path, text_path):
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+
+    def evict(self):
+        while self.size > self.max_size and self._files:
+            path, size = self._files.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def get_speak_file(socket, engine, voice, language, text):
+    """Returns the rendered file of a Speak phrase if socket
+    has a speak cache and the phrase is cached, else None
+    """
+    if socket.speak_cache is None:
+        return None
+    return socket.speak_cache.get_file(engine, voice, language, text)
+
+
+def create_speak_cache(config, log):
+    """Returns the speak cache set in config, None if disabled
+    """
+    cache_path = config.get('common', 'SPEAK_CACHE_PATH', default='')
+    if not cache_path:
+        return None
+    engines = config.get('common', 'SPEAK_CACHE_ENGINES', default='flite')
+    return SpeakCache(log, cache_path,
+            command=config.get('common', 'SPEAK_CACHE_COMMAND', default=DEFAULT_COMMAND),
+            engines=[ engine.strip() for engine in engines.split(',') if engine.strip() ],
+            max_size=int(config.get('common', 'SPEAK_CACHE_MAX_SIZE',
+                                    default=str(256*1024*1024))),
+            max_renders=int(config.get('common', 'SPEAK_CACHE_MAX_RENDERS', default='2')))
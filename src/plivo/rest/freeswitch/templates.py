@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+import copy
+import os
+import os.path
+import re
+import traceback
+import urlparse
+try:
+    import xml.etree.cElementTree as etree
+except ImportError:
+    from xml.etree.elementtree import ElementTree as etree
+
+from plivo.utils.encode import safe_str
+from plivo.rest.freeswitch import elements
+from plivo.rest.freeswitch.helpers import TEMPLATE_PREFIX
+from plivo.rest.freeswitch.exceptions import RESTFormatException, \
+                                    UnrecognizedElementException
+
+
+TEMPLATE_EXT = '.xml'
+
+TEMPLATE_VAR = re.compile(r'{{\s*(\w+)\s*}}')
+
+
+def parse_template_url(url):
+    """Split template://name?key=value into (name, params)
+    """
+    name, _, query = url[len(TEMPLATE_PREFIX):].partition('?')
+    params = {}
+    if query:
+        for k, v in urlparse.parse_qs(query).iteritems():
+            if v:
+                params[k] = v[-1]
+    return name.strip('/'), params
+
+
+def _substitute(value, params):
+    return TEMPLATE_VAR.sub(lambda m: safe_str(params.get(m.group(1), '')), value)
+
+
+def check_element(element):
+    """Validate tag, attributes and nested elements of an etree element
+    without parsing attribute values, which may hold {{Var}}
+    """
+    try:
+        schema = elements.ELEMENTS_REGISTRY[element.tag]
+    except KeyError:
+        raise UnrecognizedElementException("Unrecognized Element: %s"
+                                                    % element.tag)
+    if element.attrib and not schema.allowed:
+        raise RESTFormatException("%s does not require any attributes!"
+                                                    % element.tag)
+    children = element.getchildren()
+    if children and not schema.nestables:
+        raise RESTFormatException("%s cannot have any children!"
+                                                    % element.tag)
+    for child in children:
+        if child.tag not in schema.nestables:
+            raise RESTFormatException("%s is not nestable inside %s"
+                                                % (child.tag, element.tag))
+        check_element(child)
+
+
+def compile_element(element, uri=None):
+    """Parse an etree element and its nested elements
+    into an Element instance, as OutboundSocket.parse_xml
+    """
+    instance = elements.ELEMENTS_REGISTRY[element.tag].klass()
+    instance.parse_element(element, uri)
+    for child in element.getchildren():
+        instance.children.append(compile_element(child))
+    return instance
+
+
+class RESTXMLTemplate(object):
+    """RESTXML template compiled once at load time
+
+    name: template name
+    dynamic: True if template has {{Var}} to substitute at run time
+    plan: parsed Element instances of a static template, copied on use
+    elements: validated top level etree elements of a dynamic template,
+    parsed on use once substituted
+    """
+    __slots__ = ('name', 'dynamic', 'plan', 'elements')
+
+    def __init__(self, name, xml_str):
+        self.name = name
+        xml_str = ' '.join(xml_str.split())
+        doc = etree.fromstring(xml_str)
+        if doc.tag != 'Response':
+            raise RESTFormatException('No Response Tag Present')
+        for element in doc:
+            check_element(element)
+        self.dynamic = TEMPLATE_VAR.search(xml_str) is not None
+        self.plan = []
+        self.elements = []
+        if self.dynamic:
+            self.elements = list(doc)
+        else:
+            self.plan = [ compile_element(element, self.get_uri())
+                          for element in doc ]
+
+    def get_uri(self):
+        return TEMPLATE_PREFIX + self.name
+
+    def render(self, params):
+        """Return the parsed Element instances to execute, with {{Var}}
+        replaced by params values
+        """
+        if not self.dynamic:
+            return copy.deepcopy(self.plan)
+        rendered = []
+        for element in self.elements:
+            element = copy.deepcopy(element)
+            for node in element.iter():
+                if node.text:
+                    node.text = _substitute(node.text, params)
+                for k, v in node.attrib.items():
+                    node.set(k, _substitute(v, params))
+            rendered.append(compile_element(element, self.get_uri()))
+        return rendered
+
+
+class TemplateStore(object):
+    """Store of RESTXML templates loaded from a directory
+
+    Templates are files named <name>.xml or <name>.<lang>.xml
+    and are used with answer url template://<name>?lang=<lang>
+    """
+    def __init__(self, template_dir, log):
+        self.template_dir = template_dir
+        self.log = log
+        self.templates = {}
+
+    def load(self):
+        templates = {}
+        if not self.template_dir:
+            self.templates = templates
+            return
+        try:
+            filenames = sorted(os.listdir(self.template_dir))
+        except OSError, e:
+            self.log.error("Cannot read RESTXML templates from %s: %s" \
+                                                % (self.template_dir, str(e)))
+            self.templates = templates
+            return
+        for filename in filenames:
+            if not filename.endswith(TEMPLATE_EXT):
+                continue
+            name = filename[:-len(TEMPLATE_EXT)]
+            path = os.path.join(self.template_dir, filename)
+            try:
+                fd = open(path, 'r')
+                try:
+                    xml_str = fd.read()
+                finally:
+                    fd.close()
+                templates[name] = RESTXMLTemplate(name, xml_str)
+            except Exception, e:
+                self.log.error("Cannot load RESTXML template %s: %s" \
+                                                    % (path, str(e)))
+                [ self.log.error(line) for line in \
+                            traceback.format_exc().splitlines() ]
+        self.templates = templates
+        self.log.info("Loaded %d RESTXML templates from %s" \
+                                % (len(templates), self.template_dir))
+
+    def get(self, name, lang=None):
+        if lang:
+            try:
+                return self.templates['%s.%s' % (name, lang)]
+            except KeyError:
+                pass
+        return self.templates.get(name, None)
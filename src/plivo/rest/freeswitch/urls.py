@@ -24,12 +24,26 @@ URLS = {
         '/' + PLIVO_VERSION + '/ReloadConfig/': (PlivoRestApi.reload_config, ['POST', 'GET']),
         # API to reload Plivo Cache config
         '/' + PLIVO_VERSION + '/ReloadCacheConfig/': (PlivoRestApi.reload_cache_config, ['POST', 'GET']),
+        # API to drop memoized cache lookups
+        '/' + PLIVO_VERSION + '/InvalidateCache/': (PlivoRestApi.invalidate_cache, ['POST']),
         # API to originate several calls simultaneously
         '/' + PLIVO_VERSION + '/BulkCall/': (PlivoRestApi.bulk_call, ['POST']),
+        # API to originate calls streamed as NDJSON
+        '/' + PLIVO_VERSION + '/BulkCallStream/': (PlivoRestApi.bulk_call_stream, ['POST']),
+        # API to get status of a streamed bulk call
+        '/' + PLIVO_VERSION + '/BulkCallStatus/': (PlivoRestApi.bulk_call_status, ['GET', 'POST']),
         # API to originate a single call
         '/' + PLIVO_VERSION + '/Call/': (PlivoRestApi.call, ['POST']),
         # API to originate a call group simultaneously
         '/' + PLIVO_VERSION + '/GroupCall/': (PlivoRestApi.group_call, ['POST']),
+        # API to get originate queue status
+        '/' + PLIVO_VERSION + '/CallQueue/': (PlivoRestApi.call_queue, ['GET', 'POST']),
+        # API to list active calls
+        '/' + PLIVO_VERSION + '/ActiveCalls/': (PlivoRestApi.active_calls, ['GET', 'POST']),
+        # API to get info of an active call
+        '/' + PLIVO_VERSION + '/CallInfo/': (PlivoRestApi.call_info, ['GET', 'POST']),
+        # API to get gateways health
+        '/' + PLIVO_VERSION + '/GatewayHealth/': (PlivoRestApi.gateway_health, ['GET', 'POST']),
         # API to hangup a single call
         '/' + PLIVO_VERSION + '/HangupCall/': (PlivoRestApi.hangup_call, ['POST']),
         # API to transfer a single call
@@ -13,6 +13,18 @@ def make_suite():
     return unittest.TestLoader().loadTestsFromNames([
         'tests.freeswitch.test_events',
         'tests.freeswitch.test_inboundsocket',
+        'tests.freeswitch.test_elements',
+        'tests.freeswitch.test_cacheapi',
+        'tests.freeswitch.test_helpers',
+        'tests.freeswitch.test_cachestats',
+        'tests.freeswitch.test_grammars',
+        'tests.freeswitch.test_speakcache',
+        'tests.freeswitch.test_originate',
+        'tests.freeswitch.test_bulkcall',
+        'tests.freeswitch.test_gatewayhealth',
+        'tests.freeswitch.test_callregistry',
+        'tests.freeswitch.test_conferencecache',
+        'tests.freeswitch.test_templates',
     ])
 
 def run_test():
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+import os
+import os.path
+import shutil
+import tempfile
+from StringIO import StringIO
+from unittest import TestCase
+
+import gevent
+
+from plivo.rest.freeswitch import bulkcall
+from plivo.rest.freeswitch.bulkcall import CallBatch, spool_batch
+from plivo.rest.freeswitch.api import CallRequest, Gateway
+from plivo.rest.freeswitch.inboundsocket import RESTInboundSocket
+from plivo.rest.freeswitch.originate import OriginateScheduler
+from plivo.rest.freeswitch.gatewayhealth import GatewayMonitor
+from plivo.utils.logger import DummyLogger
+
+
+class FakeCallRequest(object):
+    def __init__(self, request_uuid):
+        self.request_uuid = request_uuid
+        self.batch = None
+
+
+class FakeScheduler(object):
+    def __init__(self, room=True):
+        self.room = room
+
+    def has_room(self, count=1):
+        return self.room
+
+
+class FakeSocket(object):
+    def __init__(self, accept=True):
+        self.call_requests = {}
+        self.accept = accept
+        self.scheduler = FakeScheduler()
+
+    def spawn_originate(self, request_uuid):
+        return self.accept
+
+
+class FailingSocket(FakeSocket):
+    def spawn_originate(self, request_uuid):
+        if request_uuid == 'fail':
+            raise RuntimeError("originate failed")
+        return self.accept
+
+
+class FakeServer(object):
+    fs_out_address = '127.0.0.1:8084'
+
+
+class FakeJob(object):
+    def get_job_uuid(self):
+        return None
+
+
+def make_socket(bgapi):
+    """RESTInboundSocket without FreeSWITCH, bgapi(dial_str) originates
+    """
+    socket = RESTInboundSocket.__new__(RESTInboundSocket)
+    socket.log = DummyLogger()
+    socket.server = FakeServer()
+    socket.call_requests = {}
+    socket.bk_jobs = {}
+    socket.scheduler = OriginateScheduler(socket._dispatch_originate, socket.log)
+    socket.gateway_monitor = GatewayMonitor(socket.log)
+    socket.bgapi = bgapi
+    return socket
+
+
+def prepare_call(params):
+    gateways = [ Gateway(request_uuid=params['To'], to=params['To'], gw=gw,
+                         codecs='', timeout='')
+                 for gw in ('sofia/gateway/gw1/', 'sofia/gateway/gw2/') ]
+    return CallRequest(request_uuid=params['To'], gateways=gateways,
+                       answer_url='http://127.0.0.1/answer', ring_url='',
+                       hangup_url='', to=params['To'], _from='1000',
+                       accountsid='AC1')
+
+
+def prepare(params):
+    if not params.get('To'):
+        raise ValueError("Mandatory Parameters Missing")
+    if params['To'] == 'error':
+        raise KeyError('Gateways')
+    return FakeCallRequest(params['To'])
+
+
+class TestCallBatch(TestCase):
+    def setUp(self):
+        self.spool_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_path)
+
+    def make_batch(self, body, defaults=None, window=10):
+        path, total = spool_batch(StringIO(body), self.spool_path)
+        return CallBatch(path, total, defaults or {}, window, DummyLogger())
+
+    def test_spool_batch(self):
+        path, total = spool_batch(StringIO('{"To": "1"}\n{"To": "2"}'), self.spool_path)
+        self.assertEquals(total, 2)
+        self.assertEquals(open(path).read(), '{"To": "1"}\n{"To": "2"}')
+
+    def test_run(self):
+        batch = self.make_batch('{"To": "1000"}\n\n{"From": "1"}\n[1]\n{"To": "1001"}\n',
+                                defaults={'From': '2000'})
+        socket = FakeSocket()
+        batch.run(socket, prepare)
+        self.assertEquals(sorted(socket.call_requests), ['1000', '1001'])
+        self.assertTrue(socket.call_requests['1000'].batch is batch)
+        self.assertFalse(os.path.exists(batch.path))
+        status = batch.get_status()
+        self.assertEquals(status['Total'], 4)
+        self.assertEquals(status['Invalid'], 2)
+        self.assertEquals(status['Requested'], 2)
+        self.assertEquals(status['InProgress'], 2)
+        self.assertEquals([ error['Line'] for error in status['Errors'] ], [3, 4])
+        self.assertFalse(batch.is_done())
+        batch.notify_end('NORMAL_CLEARING')
+        batch.notify_end('NORMAL_CLEARING')
+        self.assertTrue(batch.is_done())
+        self.assertEquals(batch.get_status()['HangupCauses'], {'NORMAL_CLEARING': 2})
+
+    def test_rejected(self):
+        batch = self.make_batch('{"To": "1000"}\n')
+        batch.run(FakeSocket(accept=False), prepare)
+        self.assertEquals(batch.rejected, 1)
+        self.assertTrue(batch.is_done())
+
+    def test_failed_lines(self):
+        batch = self.make_batch('{"To": "error"}\n{"To": "fail"}\n{"To": "1000"}\n')
+        socket = FailingSocket()
+        batch.run(socket, prepare)
+        self.assertEquals(sorted(socket.call_requests), ['1000'])
+        status = batch.get_status()
+        self.assertEquals(status['Failed'], 2)
+        self.assertEquals(status['Invalid'], 0)
+        self.assertEquals(status['Requested'], 1)
+        self.assertEquals([ error['Line'] for error in status['Errors'] ], [1, 2])
+        batch.notify_end('NORMAL_CLEARING')
+        self.assertTrue(batch.is_done())
+
+    def test_wait_queue_room(self):
+        batch = self.make_batch('{"To": "1000"}\n{"To": "1001"}\n')
+        socket = FakeSocket()
+        socket.scheduler.room = False
+        wait = bulkcall.QUEUE_FULL_WAIT
+        bulkcall.QUEUE_FULL_WAIT = 0.01
+        try:
+            job = gevent.spawn(batch.run, socket, prepare)
+            gevent.sleep(0.05)
+            # nothing is rejected while the queue is full
+            self.assertEquals(batch.created, 0)
+            self.assertEquals(batch.rejected, 0)
+            socket.scheduler.room = True
+            job.join(timeout=1)
+        finally:
+            bulkcall.QUEUE_FULL_WAIT = wait
+        self.assertTrue(job.ready())
+        self.assertEquals(sorted(socket.call_requests), ['1000', '1001'])
+        self.assertEquals(batch.rejected, 0)
+
+    def run_failing_originate(self, bgapi, cause):
+        lines = [ '{"To": "%d"}' % n for n in range(1000, 1005) ]
+        batch = self.make_batch('\n'.join(lines), window=2)
+        socket = make_socket(bgapi)
+        job = gevent.spawn(batch.run, socket, prepare_call)
+        job.join(timeout=2)
+        self.assertTrue(job.ready())
+        gevent.sleep(0.05)
+        self.assertTrue(batch.is_done())
+        status = batch.get_status()
+        self.assertEquals(status['Requested'], 5)
+        self.assertEquals(status['InProgress'], 0)
+        self.assertEquals(status['HangupCauses'], {cause: 5})
+        self.assertEquals(socket.call_requests, {})
+        self.assertEquals(socket.scheduler._active, {})
+        self.assertEquals(socket.scheduler._held, {})
+
+    def test_originate_no_job(self):
+        dial_strs = []
+        def bgapi(dial_str):
+            dial_strs.append(dial_str)
+            return FakeJob()
+        self.run_failing_originate(bgapi, 'NO_MORE_GATEWAYS')
+        # both gateways were tried for each call
+        self.assertEquals(len(dial_strs), 10)
+
+    def test_originate_error(self):
+        def bgapi(dial_str):
+            raise IOError("connection lost")
+        self.run_failing_originate(bgapi, 'ORIGINATE_ERROR')
@@ -0,0 +1,730 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+import os
+import shutil
+import stat
+from StringIO import StringIO
+import tempfile
+import time
+from unittest import TestCase
+
+import flask
+import gevent
+import gevent.event
+import redis.exceptions
+
+from plivo.rest.freeswitch import cacheapi
+from plivo.rest.freeswitch.cacheapi import MemoryCache, ResourceCache, \
+                                            PlivoCacheApi, \
+                                            parse_range, iter_file, \
+                                            read_manifest, WarmUp
+from plivo.utils.logger import DummyLogger
+
+
+class TestMemoryCache(TestCase):
+    def test_get_set(self):
+        cache = MemoryCache(max_size=10, max_item_size=10)
+        self.assertEquals(cache.get('a'), None)
+        cache.set('a', '12')
+        self.assertEquals(cache.get('a'), '12')
+        self.assertEquals(cache.size, 2)
+        cache.set('a', '123')
+        self.assertEquals(cache.size, 3)
+        cache.delete('a')
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.size, 0)
+
+    def test_lru_eviction(self):
+        cache = MemoryCache(max_size=6, max_item_size=6)
+        cache.set('a', '12')
+        cache.set('b', '34')
+        cache.set('c', '56')
+        # 'a' is now most recently used
+        cache.get('a')
+        cache.set('d', '78')
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), '12')
+        self.assertEquals(cache.size, 6)
+
+    def test_max_item_size(self):
+        cache = MemoryCache(max_size=8)
+        cache.set('a', '123')
+        self.assertEquals(cache.get('a'), None)
+        cache.set('b', '12')
+        self.assertEquals(cache.get('b'), '12')
+
+
+class TestResourceCacheExpires(TestCase):
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+        self.cache = ResourceCache(cache_path=self.cache_path, default_ttl=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+
+    def test_max_age(self):
+        now = int(time.time())
+        expires = self.cache.get_expires({'Cache-Control': 'public, max-age=10'})
+        self.assertTrue(now + 10 <= expires <= now + 11)
+
+    def test_no_cache(self):
+        now = int(time.time())
+        expires = self.cache.get_expires({'Cache-Control': 'no-cache'})
+        self.assertTrue(expires <= now + 1)
+        self.assertFalse(self.cache.is_fresh({'expires': str(expires)}))
+
+    def test_expires(self):
+        expires = self.cache.get_expires({'Expires': 'Thu, 01 Dec 1994 16:00:00 GMT'})
+        self.assertEquals(expires, 786297600)
+        self.assertFalse(self.cache.is_fresh({'expires': str(expires)}))
+
+    def test_default_ttl(self):
+        now = int(time.time())
+        expires = self.cache.get_expires({})
+        self.assertTrue(now + 60 <= expires <= now + 61)
+        self.assertTrue(self.cache.is_fresh({'expires': str(expires)}))
+        self.assertFalse(self.cache.is_fresh({}))
+
+
+class TestResourceCacheSingleFlight(TestCase):
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+        self.cache = ResourceCache(cache_path=self.cache_path, max_downloads=1)
+        self.calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+
+    def download(self, value):
+        self.calls += 1
+        gevent.sleep(0.1)
+        if value is None:
+            raise IOError("download failed")
+        return value
+
+    def test_coalescing(self):
+        jobs = [ gevent.spawn(self.cache.single_flight, 'key', self.download, 'data')
+                 for i in range(5) ]
+        gevent.joinall(jobs)
+        self.assertEquals(self.calls, 1)
+        self.assertEquals([ job.value for job in jobs ], ['data'] * 5)
+        self.assertEquals(self.cache._downloads, {})
+
+    def test_shared_error(self):
+        jobs = [ gevent.spawn(self.cache.single_flight, 'key', self.download, None)
+                 for i in range(3) ]
+        gevent.joinall(jobs)
+        self.assertEquals(self.calls, 1)
+        for job in jobs:
+            self.assertTrue(isinstance(job.exception, IOError))
+
+
+class CountedFetchCache(ResourceCache):
+    """ResourceCache with a slow counted origin and no redis
+    """
+    def __init__(self, *args, **kwargs):
+        ResourceCache.__init__(self, *args, **kwargs)
+        self.fetches = 0
+
+    def open_url(self, url, headers={}):
+        self.fetches += 1
+        gevent.sleep(0.1)
+        if url.endswith('.bad'):
+            raise IOError("origin failed")
+        return url
+
+    def store_resource(self, url, handler, download=None):
+        download.headers.set('wav')
+        fd = open(download.tmp_path, 'wb')
+        fd.write('data')
+        fd.close()
+        download.file_path = download.tmp_path
+        return ('data', 'wav', 'digest')
+
+    def publish(self, resource_key, resource_type, digest):
+        pass
+
+
+class TestResourceCacheDownloads(TestCase):
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+        self.cache = CountedFetchCache(cache_path=self.cache_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+
+    def test_concurrent_misses(self):
+        url = 'http://127.0.0.1/a.wav'
+        jobs = [ gevent.spawn(self.cache.cache_resource, url) for i in range(10) ]
+        gevent.joinall(jobs)
+        self.assertEquals(self.cache.fetches, 1)
+        self.assertEquals([ job.value for job in jobs ], [('data', 'wav')] * 10)
+        self.assertEquals(self.cache.stats.counters['coalesced_downloads'], 9)
+        self.assertEquals(self.cache._active_downloads, {})
+        # next miss fetches again
+        self.cache.cache_resource(url)
+        self.assertEquals(self.cache.fetches, 2)
+
+    def test_concurrent_misses_error(self):
+        url = 'http://127.0.0.1/a.bad'
+        jobs = [ gevent.spawn(self.cache.cache_resource, url) for i in range(5) ]
+        gevent.joinall(jobs)
+        self.assertEquals(self.cache.fetches, 1)
+        for job in jobs:
+            self.assertTrue(isinstance(job.exception, IOError))
+        self.assertEquals(self.cache._active_downloads, {})
+
+    def test_distinct_urls(self):
+        jobs = [ gevent.spawn(self.cache.cache_resource, 'http://127.0.0.1/%d.wav' % i)
+                 for i in range(3) ]
+        gevent.joinall(jobs)
+        self.assertEquals(self.cache.fetches, 3)
+
+
+class FakeRedis(object):
+    """In memory redis hashes, sets and sorted sets,
+    shared by the clients of a FakeRedisCache
+    """
+    def __init__(self):
+        self.data = {}
+        # key: number of writes, checked by watching pipelines
+        self.versions = {}
+
+    def _write(self, key, default=None):
+        self.versions[key] = self.versions.get(key, 0) + 1
+        if default is None:
+            return None
+        return self.data.setdefault(key, default)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def delete(self, *keys):
+        for key in keys:
+            self._write(key)
+            self.data.pop(key, None)
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hvals(self, key):
+        return self.data.get(key, {}).values()
+
+    def hset(self, key, field, value):
+        self._write(key, {})[field] = str(value)
+
+    def hsetnx(self, key, field, value):
+        self._write(key, {}).setdefault(field, str(value))
+
+    def hmset(self, key, mapping):
+        hash = self._write(key, {})
+        for field, value in mapping.iteritems():
+            hash[field] = str(value)
+
+    def hdel(self, key, field):
+        self._write(key)
+        self.data.get(key, {}).pop(field, None)
+
+    def hincrby(self, key, field, amount=1):
+        hash = self._write(key, {})
+        hash[field] = str(int(hash.get(field, 0)) + amount)
+        return int(hash[field])
+
+    def sadd(self, key, member):
+        members = self._write(key, set())
+        added = not member in members
+        members.add(member)
+        return int(added)
+
+    def srem(self, key, member):
+        self._write(key)
+        members = self.data.get(key, set())
+        removed = member in members
+        members.discard(member)
+        if not members:
+            self.data.pop(key, None)
+        return int(removed)
+
+    def scard(self, key):
+        return len(self.data.get(key, ()))
+
+    def smembers(self, key):
+        return set(self.data.get(key, ()))
+
+    def execute_command(self, command, key, score, member):
+        zset = self._write(key, {})
+        if command == 'ZADD':
+            zset[member] = float(score)
+        elif command == 'ZINCRBY':
+            zset[member] = zset.get(member, 0) + float(score)
+
+    def zscore(self, key, member):
+        return self.data.get(key, {}).get(member)
+
+    def zrem(self, key, member):
+        self._write(key)
+        self.data.get(key, {}).pop(member, None)
+
+    def zrange(self, key, start, end):
+        zset = self.data.get(key, {})
+        members = sorted(zset, key=lambda member: (zset[member], member))
+        return members[start:end + 1]
+
+
+class FakePipeline(object):
+    """Queues commands until execute, or runs them at once
+    while watching keys until multi is called
+    """
+    def __init__(self, cx):
+        self.cx = cx
+        self.commands = []
+        self.watched = None
+        self.immediate = False
+
+    def __getattr__(self, name):
+        func = getattr(self.cx, name)
+        def queue(*args, **kwargs):
+            if self.immediate:
+                return func(*args, **kwargs)
+            self.commands.append((func, args, kwargs))
+            return self
+        return queue
+
+    def watch(self, *keys):
+        self.watched = dict([ (key, self.cx.versions.get(key, 0)) for key in keys ])
+        self.immediate = True
+
+    def multi(self):
+        self.immediate = False
+
+    def reset(self):
+        self.commands = []
+        self.watched = None
+        self.immediate = False
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        watched, self.watched = self.watched, None
+        for key, version in (watched or {}).iteritems():
+            if self.cx.versions.get(key, 0) != version:
+                raise redis.exceptions.WatchError("Watched variable changed.")
+        return [ func(*args, **kwargs) for func, args, kwargs in commands ]
+
+
+class FakeRedisCache(ResourceCache):
+    def __init__(self, *args, **kwargs):
+        ResourceCache.__init__(self, *args, **kwargs)
+        self.cx = FakeRedis()
+
+    def get_cx(self):
+        return self.cx
+
+
+def write_file(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    fd = open(path, 'wb')
+    fd.write(data)
+    fd.close()
+
+
+def read_file(path):
+    fd = open(path, 'rb')
+    try:
+        return fd.read()
+    finally:
+        fd.close()
+
+
+def make_sox(path, code=0):
+    """Fake sox copying its input to its output, or failing with code
+    """
+    if code:
+        script = '#!/bin/sh\nexit %d\n' % code
+    else:
+        script = '#!/bin/sh\neval last=\\${$#}\ncp "$4" "$last"\n'
+    write_file(path, script)
+    os.chmod(path, stat.S_IRWXU)
+    return path
+
+
+class TestResourceCacheVariants(TestCase):
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmp_path, 'cache')
+        self.shared_path = os.path.join(self.tmp_path, 'shared')
+        self.sox = make_sox(os.path.join(self.tmp_path, 'sox'))
+        self.cache = FakeRedisCache(cache_path=self.cache_path,
+                                    variants=('8k', '16k'), sox=self.sox,
+                                    shared_path=self.shared_path)
+        self.digest = 'abcdef'
+        write_file(self.cache.get_blob_path(self.digest), 'RIFF')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def test_default_variants(self):
+        cache = ResourceCache(cache_path=self.cache_path)
+        self.assertEquals(cache.variants, [])
+        self.assertEquals(cache.transcode(self.digest, 'wav'), [])
+
+    def test_transcode(self):
+        self.assertEquals(self.cache.transcode(self.digest, 'wav'), ['8k', '16k'])
+        for variant in ('8k', '16k'):
+            path = self.cache.get_variant_path(self.digest, variant)
+            self.assertEquals(read_file(path), 'RIFF')
+        self.assertEquals(self.cache.cx.hget('blob_sizes', self.digest), '8')
+
+    def test_transcode_mp3(self):
+        self.assertEquals(self.cache.transcode(self.digest, 'mp3'), [])
+        self.cache.transcode_mp3 = True
+        self.assertEquals(self.cache.transcode(self.digest, 'mp3'), ['8k', '16k'])
+
+    def test_transcode_failure(self):
+        self.cache.sox = make_sox(os.path.join(self.tmp_path, 'badsox'), 2)
+        self.assertEquals(self.cache.transcode(self.digest, 'wav'), [])
+        # no variant nor tmp file left
+        self.assertEquals(os.listdir(os.path.dirname(self.cache.get_blob_path(self.digest))),
+                          [os.path.basename(self.cache.get_blob_path(self.digest))])
+        self.assertEquals(self.cache.cx.hget('blob_sizes', self.digest), None)
+
+    def test_materialize(self):
+        variants = self.cache.transcode(self.digest, 'wav')
+        self.cache.materialize(self.digest, 'wav', variants)
+        for suffix in ('.wav', '.8k.wav', '.16k.wav'):
+            path = self.cache.get_shared_file_path(self.digest, suffix)
+            self.assertEquals(read_file(path), 'RIFF')
+        # published files are kept
+        self.cache.materialize(self.digest, 'wav', variants)
+        self.assertEquals(len(os.listdir(os.path.dirname(
+                    self.cache.get_shared_file_path(self.digest, '.wav')))), 3)
+
+    def test_publish(self):
+        self.cache.publish('key1', 'wav', self.digest)
+        self.assertEquals(self.cache.cx.hgetall('resource_key:key1'),
+                          {'variants': '8k,16k', 'shared': '1'})
+        self.assertEquals(self.cache.cx.hget('blob:%s' % self.digest, 'published'), '1')
+        # same blob is not transcoded again
+        os.remove(self.sox)
+        self.cache.publish('key2', 'wav', self.digest)
+        self.assertEquals(self.cache.cx.hgetall('resource_key:key2'),
+                          {'variants': '8k,16k', 'shared': '1'})
+
+
+class FakeResponse(object):
+    def __init__(self, data, content_type='audio/x-wav'):
+        self.headers = {'Content-Type': content_type}
+        self.fd = StringIO(data)
+
+    def read(self, size):
+        return self.fd.read(size)
+
+
+class RacingRedis(FakeRedis):
+    """Adds a blob reference while release_blob reads the blob
+    resource type, as a concurrent store_resource would
+    """
+    race = None
+
+    def hget(self, key, field):
+        if self.race and key.startswith('blob:'):
+            digest, resource_key = self.race
+            self.race = None
+            self.sadd("blob_refs:%s" % digest, resource_key)
+        return FakeRedis.hget(self, key, field)
+
+
+class TestBlobRefs(TestCase):
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+        self.cache = FakeRedisCache(cache_path=self.cache_path)
+        self.cache.cx = RacingRedis()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+
+    def store(self, url, data):
+        stream, resource_type, digest = \
+                self.cache.store_resource(url, FakeResponse(data))
+        return digest
+
+    def test_dedup(self):
+        digest = self.store('http://127.0.0.1/a.wav', 'RIFF')
+        self.assertEquals(self.store('http://127.0.0.1/b.wav', 'RIFF'), digest)
+        self.assertEquals(self.cache.stats.counters['dedup_hits'], 1)
+        self.assertEquals(self.cache.cx.scard("blob_refs:%s" % digest), 2)
+        self.assertEquals(read_file(self.cache.get_blob_path(digest)), 'RIFF')
+        # no tmp file left
+        self.assertEquals(os.listdir(self.cache_path), ['blobs'])
+        self.assertEquals(self.cache.get_usage(), (2, 4, 0))
+
+    def test_referenced_blob_kept(self):
+        digest = self.store('http://127.0.0.1/a.wav', 'RIFF')
+        self.assertFalse(self.cache.release_blob(digest))
+        self.assertTrue(os.path.isfile(self.cache.get_blob_path(digest)))
+
+    def test_release(self):
+        digest = self.store('http://127.0.0.1/a.wav', 'RIFF')
+        self.store('http://127.0.0.1/b.wav', 'RIFF')
+        variant_path = self.cache.get_variant_path(digest, '8k')
+        write_file(variant_path, 'RIFF8k')
+        self.cache.cx.hmset("blob:%s" % digest, {'resource_type': 'wav'})
+        self.cache.delete_resource(self.cache.get_resource_key('http://127.0.0.1/a.wav'))
+        self.assertTrue(os.path.isfile(self.cache.get_blob_path(digest)))
+        self.cache.delete_resource(self.cache.get_resource_key('http://127.0.0.1/b.wav'))
+        self.assertFalse(os.path.exists(self.cache.get_blob_path(digest)))
+        self.assertFalse(os.path.exists(variant_path))
+        self.assertEquals(os.listdir(os.path.dirname(variant_path)), [])
+        for key in ("blob:%s" % digest, "blob_refs:%s" % digest):
+            self.assertFalse(key in self.cache.cx.data)
+        self.assertEquals(self.cache.get_usage(), (0, 0, 0))
+
+    def test_content_changed(self):
+        old_digest = self.store('http://127.0.0.1/a.wav', 'RIFF')
+        digest = self.store('http://127.0.0.1/a.wav', 'RIFF2')
+        self.assertNotEquals(digest, old_digest)
+        self.assertFalse(os.path.exists(self.cache.get_blob_path(old_digest)))
+        self.assertTrue(os.path.isfile(self.cache.get_blob_path(digest)))
+        self.assertEquals(self.cache.get_usage(), (1, 5, 0))
+
+    def test_release_race(self):
+        digest = self.store('http://127.0.0.1/a.wav', 'RIFF')
+        resource_key = self.cache.get_resource_key('http://127.0.0.1/a.wav')
+        self.cache.cx.srem("blob_refs:%s" % digest, resource_key)
+        # reference added between refs check and blob deletion
+        self.cache.cx.race = (digest, 'key2')
+        self.assertFalse(self.cache.release_blob(digest))
+        self.assertEquals(read_file(self.cache.get_blob_path(digest)), 'RIFF')
+        self.assertEquals(os.listdir(os.path.dirname(self.cache.get_blob_path(digest))),
+                          [digest])
+        self.assertEquals(self.cache.cx.smembers("blob_refs:%s" % digest), set(['key2']))
+        self.assertEquals(self.cache.cx.hget("blob_sizes", digest), '4')
+
+
+class EvictionCache(FakeRedisCache):
+    """Records urls invalidated in plivo rest servers
+    """
+    def __init__(self, *args, **kwargs):
+        FakeRedisCache.__init__(self, *args, **kwargs)
+        self.invalidated = []
+
+    def invalidate_many(self, urls):
+        self.invalidated += urls
+
+
+class TestEviction(TestCase):
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+        self.cache = EvictionCache(cache_path=self.cache_path)
+        self.batch = cacheapi.EVICTION_BATCH
+
+    def tearDown(self):
+        cacheapi.EVICTION_BATCH = self.batch
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+
+    def store(self, i, data=None):
+        """Cache url i with 4 bytes, accessed at time i
+        """
+        url = 'http://127.0.0.1/%d.wav' % i
+        self.cache.store_resource(url, FakeResponse(data or 'da%02d' % i))
+        resource_key = self.cache.get_resource_key(url)
+        self.cache.cx.execute_command('ZADD', 'resource_atime', i, resource_key)
+        return url
+
+    def cached(self, urls):
+        return [ url for url in urls \
+                 if self.cache.get_resource_infos(self.cache.get_resource_key(url)) ]
+
+    def test_not_full(self):
+        self.cache.max_entries = 3
+        urls = [ self.store(i) for i in range(3) ]
+        self.assertEquals(self.cache.evict(), 0)
+        self.assertEquals(self.cached(urls), urls)
+
+    def test_lru_order(self):
+        self.cache.max_entries = 3
+        urls = [ self.store(i) for i in (3, 0, 4, 1, 2) ]
+        self.assertEquals(self.cache.evict(), 2)
+        self.assertEquals(self.cached(urls), [urls[0], urls[2], urls[4]])
+        self.assertEquals(sorted(self.cache.invalidated), sorted([urls[1], urls[3]]))
+        self.assertEquals(self.cache.get_usage(), (3, 12, 0))
+
+    def test_access_order(self):
+        self.cache.max_entries = 2
+        urls = [ self.store(i) for i in range(3) ]
+        self.cache.record_access(self.cache.get_resource_key(urls[0]))
+        self.assertEquals(self.cache.evict(), 1)
+        self.assertEquals(self.cached(urls), [urls[0], urls[2]])
+
+    def test_size_target(self):
+        self.cache.max_size = 10
+        urls = [ self.store(i) for i in range(4) ]
+        # same content as url 3, its blob is shared
+        urls.append(self.store(4, 'da03'))
+        self.assertEquals(self.cache.get_usage(), (5, 16, 0))
+        self.assertEquals(self.cache.evict(), 2)
+        self.assertEquals(self.cached(urls), urls[2:])
+        self.assertEquals(self.cache.get_usage(), (3, 8, 0))
+        self.assertEquals(self.cache.evicted_size, 8)
+
+    def test_shared_blob_size(self):
+        self.cache.max_size = 6
+        urls = [ self.store(0), self.store(1, 'da00'), self.store(2) ]
+        # evicting url 0 frees nothing as url 1 shares its blob
+        self.assertEquals(self.cache.evict(), 2)
+        self.assertEquals(self.cached(urls), [urls[2]])
+
+    def test_pinned(self):
+        self.cache.max_entries = 2
+        urls = [ self.store(i) for i in range(4) ]
+        self.cache.pin(self.cache.get_resource_key(urls[0]))
+        self.assertEquals(self.cache.evict(), 2)
+        self.assertEquals(self.cached(urls), [urls[0], urls[3]])
+        self.assertEquals(self.cache.get_usage(), (2, 8, 1))
+
+    def test_active_download(self):
+        self.cache.max_entries = 1
+        urls = [ self.store(i) for i in range(2) ]
+        self.cache._active_downloads[self.cache.get_resource_key(urls[0])] = None
+        self.assertEquals(self.cache.evict(), 1)
+        self.assertEquals(self.cached(urls), [urls[0]])
+
+    def test_batches(self):
+        cacheapi.EVICTION_BATCH = 2
+        self.cache.max_entries = 3
+        urls = [ self.store(i) for i in range(9) ]
+        for i in (0, 3, 4):
+            self.cache.pin(self.cache.get_resource_key(urls[i]))
+        self.assertEquals(self.cache.evict(), 6)
+        self.assertEquals(self.cached(urls), [urls[0], urls[3], urls[4]])
+        self.assertEquals(len(self.cache.invalidated), 6)
+
+    def test_batches_all_pinned(self):
+        cacheapi.EVICTION_BATCH = 2
+        self.cache.max_entries = 1
+        urls = [ self.store(i) for i in range(5) ]
+        for url in urls:
+            self.cache.pin(self.cache.get_resource_key(url))
+        self.assertEquals(self.cache.evict(), 0)
+        self.assertEquals(self.cached(urls), urls)
+
+
+class TestCacheFile(TestCase):
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+        self.app = flask.Flask(__name__)
+        self.api = PlivoCacheApi()
+        self.api.log = DummyLogger()
+        self.api.cache = FakeRedisCache(cache_path=self.cache_path)
+        self.api.cache.cx.hmset('resource_key:key1', {'digest': 'abcdef'})
+        write_file(self.api.cache.get_variant_path('abcdef', '8k'), 'RIFF8k')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+
+    def get(self, filename, headers=None):
+        with self.app.test_request_context('/CacheFile/%s' % filename,
+                                           headers=headers):
+            return self.api.do_cache_file(filename)
+
+    def test_cache_file(self):
+        response = self.get('key1.8k.wav')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.mimetype, 'audio/wav')
+        self.assertEquals(response.content_length, 6)
+        self.assertEquals(self.api.cache._accesses, {'key1': 1})
+
+    def test_cache_file_range(self):
+        response = self.get('key1.8k.wav', {'Range': 'bytes=4-'})
+        self.assertEquals(response.status_code, 206)
+        self.assertEquals(''.join(response.response), '8k')
+
+    def test_not_found(self):
+        # invalid name, unknown variant, not cached, variant not created
+        for filename in ('key1.wav', 'key1.22k.wav', '../key1.8k.wav',
+                         'key2.8k.wav', 'key1.16k.wav'):
+            self.assertEquals(self.get(filename), ("NO FILE", 404))
+        self.assertEquals(self.api.cache._accesses, {})
+
+
+class TestRange(TestCase):
+    def test_parse_range(self):
+        self.assertEquals(parse_range(None, 100), None)
+        self.assertEquals(parse_range('items=0-1', 100), None)
+        self.assertEquals(parse_range('bytes=0-9', 100), (0, 9))
+        self.assertEquals(parse_range('bytes=90-', 100), (90, 99))
+        self.assertEquals(parse_range('bytes=90-200', 100), (90, 99))
+        self.assertEquals(parse_range('bytes=-10', 100), (90, 99))
+        self.assertEquals(parse_range('bytes=100-', 100), False)
+        self.assertEquals(parse_range('bytes=a-b', 100), None)
+
+    def test_iter_file(self):
+        fd = tempfile.NamedTemporaryFile()
+        fd.write('0123456789')
+        fd.flush()
+        self.assertEquals(''.join(iter_file(fd.name)), '0123456789')
+        self.assertEquals(''.join(iter_file(fd.name, 2, 3)), '234')
+        self.assertEquals(''.join(iter_file(fd.name, 8, 5)), '89')
+        fd.close()
+
+
+class FakeDownload(object):
+    def __init__(self, cache, url):
+        self.done = gevent.event.AsyncResult()
+        self.published = gevent.event.Event()
+        gevent.spawn(self.run, cache, url)
+
+    def run(self, cache, url):
+        cache.active += 1
+        cache.max_active = max(cache.active, cache.max_active)
+        gevent.sleep(0.05)
+        cache.active -= 1
+        if url.endswith('.bad'):
+            self.done.set_exception(IOError("download failed"))
+        else:
+            self.done.set((None, 'wav'))
+        self.published.set()
+
+
+class FakeCache(object):
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+
+    def get_resource_key(self, url):
+        return url
+
+    def get_resource_infos(self, resource_key):
+        return {}
+
+    def start_download(self, url):
+        return FakeDownload(self, url)
+
+
+class TestWarmUp(TestCase):
+    def test_read_manifest(self):
+        fd = tempfile.NamedTemporaryFile()
+        fd.write('# prompts\nhttp://127.0.0.1/a.wav\n\n  http://127.0.0.1/b.mp3  \n')
+        fd.flush()
+        self.assertEquals(read_manifest(fd.name),
+                          ['http://127.0.0.1/a.wav', 'http://127.0.0.1/b.mp3'])
+        fd.close()
+
+    def test_warmup(self):
+        cache = FakeCache()
+        urls = [ 'http://127.0.0.1/%d.wav' % i for i in range(6) ]
+        urls += [ urls[0], 'http://127.0.0.1/6.bad', '/tmp/local.wav' ]
+        warmup = WarmUp('id', cache, urls, 2, DummyLogger())
+        warmup.run()
+        self.assertEquals(cache.max_active, 2)
+        status = warmup.get_status()
+        self.assertEquals(status['Total'], 8)
+        self.assertEquals(status['Done'], 8)
+        self.assertEquals(status['Downloaded'], 6)
+        # local files fail at once, failed downloads once done
+        self.assertEquals(sorted(status['Failed']), ['/tmp/local.wav', 'http://127.0.0.1/6.bad'])
+        self.assertTrue(status['Finished'])
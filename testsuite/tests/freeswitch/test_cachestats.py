@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from unittest import TestCase
+
+from plivo.rest.freeswitch.cachestats import Histogram, CacheStats
+
+
+class TestHistogram(TestCase):
+    def test_observe(self):
+        histogram = Histogram()
+        self.assertEquals(histogram.quantile(0.5), 0.0)
+        for value in (0.002, 0.003, 0.004, 0.2, 40.0):
+            histogram.observe(value)
+        self.assertEquals(histogram.count, 5)
+        self.assertEquals(histogram.max, 40.0)
+        self.assertEquals(histogram.quantile(0.5), 0.005)
+        self.assertEquals(histogram.quantile(0.8), 0.25)
+        self.assertEquals(histogram.quantile(0.99), 40.0)
+        buckets = histogram.get_buckets()
+        self.assertEquals(buckets[0], (0.001, 0))
+        self.assertEquals(buckets[1], (0.005, 3))
+        self.assertEquals(buckets[-1], ('+Inf', 5))
+
+
+class TestCacheStats(TestCase):
+    def test_counters(self):
+        stats = CacheStats()
+        stats.incr('hits')
+        stats.incr('hits')
+        stats.incr('bytes_served', 100)
+        stats.observe('lookup', 0.01)
+        stats.observe_origin('http://127.0.0.1/a.wav', 0.5, 10)
+        stats.observe_origin('http://127.0.0.1/b.wav', 1.0, error=True)
+        result = stats.to_dict({'entries': 3})
+        self.assertEquals(result['counters'],
+                          {'hits': 2, 'bytes_served': 100, 'entries': 3})
+        self.assertEquals(result['latency']['lookup']['count'], 1)
+        origin = result['origins']['127.0.0.1']
+        self.assertEquals((origin['downloads'], origin['errors'], origin['bytes']),
+                          (1, 1, 10))
+
+    def test_text(self):
+        stats = CacheStats()
+        stats.incr('hits')
+        stats.observe('lookup', 0.01)
+        lines = stats.to_text().splitlines()
+        self.assertTrue('hits 1' in lines)
+        self.assertTrue('lookup_seconds_bucket{le="0.01"} 1' in lines)
+        self.assertTrue('lookup_seconds_bucket{le="+Inf"} 1' in lines)
+        self.assertTrue('lookup_seconds_count 1' in lines)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from unittest import TestCase
+
+import ujson as json
+
+from plivo.rest.freeswitch.callregistry import CallRegistry, parse_channel_uuids
+from plivo.rest.freeswitch.inboundsocket import RESTInboundSocket
+from plivo.utils.logger import DummyLogger
+
+
+class FakeEvent(dict):
+    def __getitem__(self, key):
+        return self.get(key)
+
+
+class FakeResponse(object):
+    def __init__(self, body):
+        self.body = body
+
+    def get_response(self):
+        return self.body
+
+
+def dump(call_uuid, plivo_app='true', **headers):
+    headers.update({'Unique-ID': call_uuid, 'variable_plivo_app': plivo_app})
+    return json.dumps(headers)
+
+
+class TestCallRegistry(TestCase):
+    def setUp(self):
+        self.registry = CallRegistry()
+
+    def test_lifecycle(self):
+        self.registry.update(FakeEvent({'Unique-ID': 'c1', 'Call-Direction': 'outbound',
+                                        'Channel-Call-State': 'DOWN',
+                                        'Caller-Channel-Created-Time': '1300000000000000',
+                                        'Caller-Destination-Number': '+1000'}))
+        call = self.registry.update(FakeEvent({'Unique-ID': 'c1',
+                                               'Channel-Call-State': 'RINGING',
+                                               'variable_plivo_request_uuid': 'r1',
+                                               'variable_plivo_accountsid': 'AC1'}))
+        self.assertEquals(call.state, 'RINGING')
+        self.assertEquals(call.direction, 'outbound')
+        self.assertEquals(call.called_num, '1000')
+        self.assertEquals(call.start_time, 1300000000.0)
+        self.assertEquals(self.registry.find(request_uuid='r1'), [call])
+        self.assertEquals(self.registry.find(accountsid='AC1'), [call])
+        self.registry.set_bridge('c1', 'c2')
+        self.assertEquals(self.registry.get('c1').to_dict()['BridgedTo'], 'c2')
+        self.registry.remove('c1')
+        self.assertEquals(len(self.registry), 0)
+        self.assertEquals(self.registry.find(request_uuid='r1'), [])
+        self.assertEquals(self.registry._by_account, {})
+
+    def test_find(self):
+        for call_uuid, accountsid, direction in (('c1', 'AC1', 'inbound'),
+                                                 ('c2', 'AC1', 'outbound'),
+                                                 ('c3', 'AC2', 'outbound')):
+            self.registry.update(FakeEvent({'Unique-ID': call_uuid,
+                                            'Call-Direction': direction,
+                                            'variable_plivo_accountsid': accountsid}))
+        uuids = lambda calls: sorted([ call.call_uuid for call in calls ])
+        self.assertEquals(uuids(self.registry.find()), ['c1', 'c2', 'c3'])
+        self.assertEquals(uuids(self.registry.find(direction='outbound')), ['c2', 'c3'])
+        self.assertEquals(uuids(self.registry.find(accountsid='AC1', direction='outbound')), ['c2'])
+        self.assertEquals(uuids(self.registry.find(accountsid='AC3')), [])
+
+    def test_parse_channel_uuids(self):
+        self.assertEquals(parse_channel_uuids('{"row_count": 0}'), [])
+        self.assertEquals(parse_channel_uuids(
+                '{"row_count": 2, "rows": [{"uuid": "c1", "direction": "inbound"},'
+                ' {"uuid": "c2", "direction": "outbound"}]}'), ['c1', 'c2'])
+
+    def test_seed(self):
+        self.assertTrue(self.registry.begin_sync())
+        self.assertFalse(self.registry.begin_sync())
+        call = self.registry.seed(dump('c1', **{'Call-Direction': 'outbound',
+                                                'Channel-Call-State': 'ACTIVE',
+                                                'variable_plivo_request_uuid': 'r1'}))
+        self.assertEquals(call.state, 'ACTIVE')
+        self.assertEquals(self.registry.find(request_uuid='r1'), [call])
+        # not a plivo call
+        self.assertEquals(self.registry.seed(dump('c2', plivo_app='')), None)
+        # events received while seeding are newer
+        self.registry.update(FakeEvent({'Unique-ID': 'c3', 'Channel-Call-State': 'RINGING'}))
+        self.registry.seed(dump('c3', **{'Channel-Call-State': 'ACTIVE'}))
+        self.assertEquals(self.registry.get('c3').state, 'RINGING')
+        self.registry.remove('c4')
+        self.assertEquals(self.registry.seed(dump('c4')), None)
+        self.registry.end_sync()
+        self.assertEquals(sorted(self.registry._calls), ['c1', 'c3'])
+
+    def test_seed_active_calls(self):
+        socket = RESTInboundSocket.__new__(RESTInboundSocket)
+        socket.log = DummyLogger()
+        socket.active_calls = self.registry
+        responses = {
+            'show channels as json': '{"row_count": 3, "rows": [{"uuid": "c1"},'
+                                     ' {"uuid": "c2"}, {"uuid": "c3"}]}',
+            'uuid_dump c1 json': dump('c1', **{'variable_plivo_accountsid': 'AC1'}),
+            'uuid_dump c2 json': dump('c2', plivo_app='false'),
+            'uuid_dump c3 json': '-ERR No such channel!'}
+        socket.api = lambda cmd: FakeResponse(responses[cmd])
+        socket.seed_active_calls()
+        self.assertEquals([ call.call_uuid for call in self.registry.find(accountsid='AC1') ],
+                          ['c1'])
+        self.assertEquals(len(self.registry), 1)
+        # sync is over
+        self.assertTrue(self.registry.begin_sync())
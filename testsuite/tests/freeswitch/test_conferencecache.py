@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from unittest import TestCase
+
+from plivo.rest.freeswitch.conferencecache import ConferenceCache
+
+
+XML_LIST = """<conferences>
+  <conference name="room1" member-count="2" uuid="u1" run_time="30">
+    <members>
+      <member type="caller">
+        <id>1</id>
+        <flags><can_hear>true</can_hear><can_speak>false</can_speak><has_floor>true</has_floor></flags>
+        <uuid>c1</uuid>
+        <caller_id_name>Alice</caller_id_name>
+        <caller_id_number>1000</caller_id_number>
+        <join_time>20</join_time>
+      </member>
+      <member type="caller">
+        <id>2</id>
+        <flags><can_hear>false</can_hear><can_speak>true</can_speak><has_floor>false</has_floor></flags>
+        <uuid>c2</uuid>
+        <caller_id_name>Bob</caller_id_name>
+        <caller_id_number>1001</caller_id_number>
+        <join_time>10</join_time>
+      </member>
+    </members>
+  </conference>
+</conferences>"""
+
+
+class FakeEvent(dict):
+    def __getitem__(self, key):
+        return self.get(key)
+
+
+def member_event(action, member_id, call_uuid='', room='room1', **headers):
+    headers.update({'Action': action, 'Conference-Name': room,
+                    'Member-ID': member_id, 'Unique-ID': call_uuid})
+    return FakeEvent(headers)
+
+
+class TestConferenceCache(TestCase):
+    def setUp(self):
+        self.cache = ConferenceCache()
+
+    def test_load_xml(self):
+        self.assertFalse(self.cache.synced)
+        self.cache.load_xml(XML_LIST)
+        self.assertTrue(self.cache.synced)
+        room = self.cache.get_list()['room1']
+        self.assertEquals(room['ConferenceUUID'], 'u1')
+        self.assertEquals(room['ConferenceMemberCount'], '2')
+        self.assertEquals(room['ConferenceRunTime'], '30')
+        self.assertEquals([ m['MemberID'] for m in room['Members'] ], ['1', '2'])
+        alice, bob = room['Members']
+        self.assertEquals((alice['Muted'], alice['Deaf'], alice['Floor']), (True, False, True))
+        self.assertEquals((bob['Muted'], bob['Deaf'], bob['Floor']), (False, True, False))
+        self.assertEquals(alice['JoinTime'], '20')
+        self.cache.load_xml('No active conferences.')
+        self.assertEquals(self.cache.get_list(), {})
+
+    def test_filters(self):
+        self.cache.load_xml(XML_LIST)
+        members = lambda **kw: [ m['MemberID'] for m in \
+                                    self.cache.get_list('room1', **kw)['room1']['Members'] ]
+        self.assertEquals(members(mute_filter=True), ['1'])
+        self.assertEquals(members(deaf_filter=True), ['2'])
+        self.assertEquals(members(uuid_filter='c2'), ['2'])
+        self.assertEquals(members(member_filter='1', deaf_filter=True), ['1', '2'])
+        self.assertEquals(self.cache.get_list('room2'), {})
+
+    def test_events(self):
+        self.cache.on_event(FakeEvent({'Action': 'conference-create',
+                                       'Conference-Name': 'room2',
+                                       'Conference-Unique-ID': 'u2'}))
+        self.cache.on_event(member_event('add-member', '5', 'c5', room='room2',
+                                         Speak='true', Hear='true'))
+        self.cache.on_event(member_event('mute-member', '5', 'c5', room='room2',
+                                         Speak='false', Hear='true'))
+        self.cache.on_event(FakeEvent({'Action': 'floor-change', 'Conference-Name': 'room2',
+                                       'Old-ID': 'none', 'New-ID': '5'}))
+        member = self.cache.get_list('room2')['room2']['Members'][0]
+        self.assertEquals((member['Muted'], member['Floor']), (True, True))
+        self.cache.on_event(member_event('del-member', '5', 'c5', room='room2'))
+        self.assertEquals(self.cache.get_list('room2')['room2']['Members'], [])
+        self.cache.on_event(FakeEvent({'Action': 'conference-destroy',
+                                       'Conference-Name': 'room2'}))
+        self.assertFalse(self.cache.has_room('room2'))
+
+    def test_events_during_sync(self):
+        self.cache.load_xml(XML_LIST)
+        self.assertTrue(self.cache.begin_sync())
+        self.assertFalse(self.cache.begin_sync())
+        # member 2 leaves while the xml_list job is running
+        self.cache.on_event(member_event('del-member', '2', 'c2'))
+        self.cache.load_xml(XML_LIST)
+        members = self.cache.get_list()['room1']['Members']
+        self.assertEquals([ m['MemberID'] for m in members ], ['1'])
+        # untouched rooms follow xml_list
+        self.assertTrue(self.cache.begin_sync())
+        self.cache.load_xml('<conferences></conferences>')
+        self.assertEquals(self.cache.get_list(), {})
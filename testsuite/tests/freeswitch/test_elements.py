@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from unittest import TestCase
+
+try:
+    import xml.etree.cElementTree as etree
+except ImportError:
+    from xml.etree.elementtree import ElementTree as etree
+
+from plivo.rest.freeswitch import elements
+from plivo.rest.freeswitch.exceptions import RESTFormatException
+
+
+class TestElementRegistry(TestCase):
+    def test_registry(self):
+        for name in elements.ELEMENTS_DEFAULT_PARAMS:
+            schema = elements.ELEMENTS_REGISTRY[name]
+            self.assertEquals(schema.klass.__name__, name)
+        self.assertTrue('Number' in elements.ELEMENTS_REGISTRY['Dial'].nestables)
+        self.assertTrue('callerId' in elements.ELEMENTS_REGISTRY['Dial'].allowed)
+        self.assertFalse(elements.ELEMENTS_REGISTRY['Wait'].nestables)
+
+    def test_slots(self):
+        element = elements.Wait()
+        self.assertEquals(element.name, 'Wait')
+        self.assertRaises(AttributeError, setattr, element, 'foo', 1)
+
+    def test_attributes(self):
+        element = elements.Wait()
+        element.parse_element(etree.fromstring('<Wait length="3" foo="bar"/>'))
+        self.assertEquals(element.length, 3)
+        self.assertEquals(element.attributes, {'length': '3'})
+        element = elements.Wait()
+        element.parse_element(etree.fromstring('<Wait/>'))
+        self.assertEquals(element.length, 1)
+        self.assertEquals(element.attributes, {})
+
+    def test_no_attributes(self):
+        element = elements.PreAnswer()
+        self.assertRaises(RESTFormatException, element.parse_element,
+                          etree.fromstring('<PreAnswer foo="bar"/>'))
+
+    def test_grammar_path(self):
+        element = elements.GetSpeech()
+        element.parse_element(etree.fromstring('<GetSpeech grammar="yesno"/>'))
+        # grammar path of the grammar store
+        self.assertEquals(element.grammarPath, None)
+        element = elements.GetSpeech()
+        element.parse_element(etree.fromstring(
+                    '<GetSpeech grammar="yesno" grammarPath="/tmp/grammar/"/>'))
+        self.assertEquals(element.grammarPath, '/tmp/grammar')
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+import time
+from unittest import TestCase
+
+from plivo.rest.freeswitch.gatewayhealth import GatewayMonitor
+from plivo.utils.logger import DummyLogger
+
+
+class FakeGateway(object):
+    def __init__(self, gw):
+        self.gw = gw
+
+
+class TestGatewayMonitor(TestCase):
+    def setUp(self):
+        self.monitor = GatewayMonitor(DummyLogger(), ordering='health',
+                                      breaker_failures=3, cooldown=30)
+        self.gateways = [ FakeGateway(gw) for gw in ('gw1/', 'gw2/', 'gw3/') ]
+
+    def attempt(self, request_uuid, gw, cause=None):
+        self.monitor.start(request_uuid, gw)
+        if cause is None:
+            self.monitor.reached(request_uuid)
+        else:
+            self.monitor.failed(request_uuid, cause)
+
+    def get_order(self):
+        return [ gateway.gw for gateway in self.monitor.order(self.gateways) ]
+
+    def test_user_causes(self):
+        for i in range(10):
+            self.attempt(str(i), 'gw1/', 'USER_BUSY')
+        status = self.monitor.get_status()['Gateways']['gw1/']
+        self.assertEquals(status['Successes'], 10)
+        self.assertEquals(status['Breaker'], 'closed')
+
+    def test_breaker(self):
+        for i in range(3):
+            self.attempt(str(i), 'gw1/', 'GATEWAY_DOWN')
+        status = self.monitor.get_status()['Gateways']['gw1/']
+        self.assertEquals(status['Breaker'], 'open')
+        self.assertEquals(status['HangupCauses'], {'GATEWAY_DOWN': 3})
+        self.assertEquals(self.get_order(), ['gw2/', 'gw3/'])
+        # cooldown done, one probe goes through
+        self.monitor._gateways['gw1/'].open_until = time.time() - 1
+        self.assertEquals(self.get_order(), ['gw1/', 'gw2/', 'gw3/'])
+        self.monitor.start('probe', 'gw1/')
+        self.assertEquals(self.get_order(), ['gw2/', 'gw3/'])
+        # failed probe reopens the circuit
+        self.monitor.failed('probe', 'GATEWAY_DOWN')
+        self.assertEquals(self.get_order(), ['gw2/', 'gw3/'])
+        self.assertEquals(self.monitor.get_status()['Gateways']['gw1/']['Trips'], 2)
+        # successful probe closes it
+        self.monitor._gateways['gw1/'].open_until = time.time() - 1
+        self.attempt('probe', 'gw1/')
+        self.assertEquals(self.monitor.get_status()['Gateways']['gw1/']['Breaker'], 'closed')
+
+    def test_all_open(self):
+        for gateway in self.gateways:
+            for i in range(3):
+                self.attempt(str(i), gateway.gw, 'RECOVERY_ON_TIMER_EXPIRE')
+        self.assertEquals(self.get_order(), ['gw1/', 'gw2/', 'gw3/'])
+
+    def test_degraded_last(self):
+        for i in range(10):
+            self.attempt('a', 'gw1/', 'NORMAL_TEMPORARY_FAILURE')
+            self.attempt('b', 'gw1/', 'NORMAL_TEMPORARY_FAILURE')
+            self.attempt('c', 'gw1/')
+        self.assertTrue(self.monitor.get_status()['Gateways']['gw1/']['Score'] < 0.5)
+        self.assertEquals(self.get_order(), ['gw2/', 'gw3/', 'gw1/'])
+
+    def test_latency(self):
+        self.monitor.configure(ordering='latency')
+        self.monitor.get_gateway('gw1/').success(3.0)
+        self.monitor.get_gateway('gw2/').success(0.5)
+        self.monitor.get_gateway('gw3/').success(1.0)
+        self.assertEquals(self.get_order(), ['gw2/', 'gw3/', 'gw1/'])
+
+    def test_off(self):
+        self.monitor.configure(ordering='off')
+        for i in range(3):
+            self.attempt(str(i), 'gw1/', 'GATEWAY_DOWN')
+        self.assertEquals(self.get_order(), ['gw1/', 'gw2/', 'gw3/'])
+        self.assertRaises(ValueError, self.monitor.configure, ordering='random')
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+import os
+import os.path
+import shutil
+import tempfile
+from unittest import TestCase
+
+from plivo.rest.freeswitch.grammars import GrammarStore
+from plivo.utils.logger import DummyLogger
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.log = DummyLogger()
+        self.cache = {}
+
+
+class TestGrammarStore(TestCase):
+    def setUp(self):
+        self.grammar_path = tempfile.mkdtemp()
+        self.socket = FakeSocket()
+
+    def tearDown(self):
+        shutil.rmtree(self.grammar_path, ignore_errors=True)
+
+    def test_same_content(self):
+        store = GrammarStore(DummyLogger(), self.grammar_path)
+        name = store.get_file(self.socket, 'raw:#JSGF V1.0; grammar yes;')
+        self.assertTrue(os.path.isfile(os.path.join(self.grammar_path, name)))
+        self.assertEquals(store.get_file(self.socket, 'raw:#JSGF V1.0; grammar yes;'), name)
+        other = store.get_file(self.socket, 'raw:#JSGF V1.0; grammar no;')
+        self.assertNotEquals(other, name)
+        self.assertEquals(len(os.listdir(self.grammar_path)), 2)
+
+    def test_not_stored(self):
+        store = GrammarStore(DummyLogger(), self.grammar_path)
+        self.assertEquals(store.get_file(self.socket, 'builtin:grammar/boolean'), None)
+        self.assertEquals(store.get_file(self.socket, '/tmp/menu.gram'), None)
+        self.assertEquals(os.listdir(self.grammar_path), [])
+
+    def test_max_files(self):
+        store = GrammarStore(DummyLogger(), self.grammar_path, max_files=2)
+        first = store.get_file(self.socket, 'raw:a')
+        store.get_file(self.socket, 'raw:b')
+        store.get_file(self.socket, 'raw:c')
+        self.assertEquals(len(os.listdir(self.grammar_path)), 2)
+        self.assertFalse(os.path.isfile(os.path.join(self.grammar_path, first)))
+
+    def test_held_files(self):
+        store = GrammarStore(DummyLogger(), self.grammar_path, max_files=2)
+        first = store.get_file(self.socket, 'raw:a')
+        # grammar of a GetSpeech in progress, held twice
+        store.hold(self.grammar_path, first)
+        store.hold(self.grammar_path, first)
+        second = store.get_file(self.socket, 'raw:b')
+        third = store.get_file(self.socket, 'raw:c')
+        self.assertTrue(os.path.isfile(os.path.join(self.grammar_path, first)))
+        self.assertFalse(os.path.isfile(os.path.join(self.grammar_path, second)))
+        self.assertEquals(len(os.listdir(self.grammar_path)), 2)
+        store.release(self.grammar_path, first)
+        store.get_file(self.socket, 'raw:d')
+        self.assertTrue(os.path.isfile(os.path.join(self.grammar_path, first)))
+        self.assertFalse(os.path.isfile(os.path.join(self.grammar_path, third)))
+        # least recently used again once released by all
+        store.release(self.grammar_path, first)
+        store.get_file(self.socket, 'raw:e')
+        self.assertFalse(os.path.isfile(os.path.join(self.grammar_path, first)))
+        self.assertEquals(len(os.listdir(self.grammar_path)), 2)
+
+    def test_release_evicts(self):
+        store = GrammarStore(DummyLogger(), self.grammar_path, max_files=1)
+        first = store.get_file(self.socket, 'raw:a')
+        store.hold(self.grammar_path, first)
+        second = store.get_file(self.socket, 'raw:b')
+        store.hold(self.grammar_path, second)
+        # both held, max_files exceeded until release
+        self.assertEquals(len(os.listdir(self.grammar_path)), 2)
+        store.release(self.grammar_path, first)
+        self.assertEquals(os.listdir(self.grammar_path), [second])
+
+    def test_index_files(self):
+        for n, name in enumerate(('plivo_a.gram', 'plivo_b.gram', 'other.gram')):
+            path = os.path.join(self.grammar_path, name)
+            open(path, 'w').close()
+            os.utime(path, (n, n))
+        store = GrammarStore(DummyLogger(), self.grammar_path, max_files=2)
+        self.assertEquals(len(store._files), 2)
+        # oldest stored file goes first
+        name = store.get_file(self.socket, 'raw:a')
+        self.assertEquals(sorted(os.listdir(self.grammar_path)),
+                          sorted(['other.gram', 'plivo_b.gram', name]))
+
+    def test_configure(self):
+        store = GrammarStore(DummyLogger(), self.grammar_path, max_files=2)
+        first = store.get_file(self.socket, 'raw:a')
+        store.hold(self.grammar_path, first)
+        store.get_file(self.socket, 'raw:b')
+        # reload keeps stored and held files
+        store.configure(DummyLogger(), self.grammar_path + os.sep, max_files=1)
+        self.assertEquals(store.grammar_path, self.grammar_path)
+        self.assertEquals(os.listdir(self.grammar_path), [first])
+        store.release(self.grammar_path, first)
+        store.get_file(self.socket, 'raw:c')
+        self.assertEquals(len(os.listdir(self.grammar_path)), 1)
+        self.assertFalse(os.path.isfile(os.path.join(self.grammar_path, first)))
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+import httplib
+import socket
+import time
+import urllib
+from unittest import TestCase
+
+import gevent
+
+from plivo.rest.freeswitch.helpers import ResourceMemo, CacheRing, \
+                                            get_resource_key, iterparse_stream, \
+                                            get_cache_stream
+from plivo.utils.logger import DummyLogger
+
+
+class TestResourceMemo(TestCase):
+    def test_get_set(self):
+        memo = ResourceMemo(max_size=2, ttl=60)
+        self.assertEquals(memo.get('a'), None)
+        memo.set('a', ('wav', 'stream_a'))
+        self.assertEquals(memo.get('a'), ('wav', 'stream_a'))
+
+    def test_lru(self):
+        memo = ResourceMemo(max_size=2, ttl=60)
+        memo.set('a', 1)
+        memo.set('b', 2)
+        # 'a' is now most recently used
+        memo.get('a')
+        memo.set('c', 3)
+        self.assertEquals(memo.get('b'), None)
+        self.assertEquals(memo.get('a'), 1)
+        self.assertEquals(memo.get('c'), 3)
+
+    def test_ttl(self):
+        memo = ResourceMemo(max_size=2, ttl=1)
+        memo.set('a', 1)
+        time.sleep(1.1)
+        self.assertEquals(memo.get('a'), None)
+        memo = ResourceMemo(max_size=2, ttl=0)
+        memo.set('a', 1)
+        self.assertEquals(memo.get('a'), None)
+
+    def test_invalidate(self):
+        memo = ResourceMemo()
+        memo.set('a', 1)
+        memo.set('b', 2)
+        memo.invalidate('a')
+        self.assertEquals(memo.get('a'), None)
+        self.assertEquals(memo.get('b'), 2)
+        memo.invalidate()
+        self.assertEquals(memo.get('b'), None)
+
+
+class TestCacheRing(TestCase):
+    urls = ['http://10.0.0.1:8089', 'http://10.0.0.2:8089/', 'http://10.0.0.3:8089']
+
+    def test_single(self):
+        ring = CacheRing(['http://127.0.0.1:8089/'])
+        self.assertEquals(ring.get_urls('key'), ['http://127.0.0.1:8089'])
+
+    def test_sharding(self):
+        ring = CacheRing(self.urls)
+        keys = [ get_resource_key('http://127.0.0.1/%d.wav' % i) for i in range(300) ]
+        owners = {}
+        for key in keys:
+            urls = ring.get_urls(key)
+            self.assertEquals(sorted(urls), sorted(ring.urls))
+            owners.setdefault(urls[0], []).append(key)
+        # all servers get keys
+        self.assertEquals(len(owners), 3)
+        for url_keys in owners.values():
+            self.assertTrue(len(url_keys) > 50)
+
+    def test_consistent(self):
+        ring = CacheRing(self.urls)
+        smaller = CacheRing(self.urls[:2])
+        for i in range(100):
+            key = get_resource_key('http://127.0.0.1/%d.wav' % i)
+            url = ring.get_urls(key)[0]
+            # only keys of removed server move
+            if url != 'http://10.0.0.3:8089':
+                self.assertEquals(smaller.get_urls(key)[0], url)
+
+    def test_failover(self):
+        ring = CacheRing(self.urls, retry=60)
+        key = get_resource_key('http://127.0.0.1/prompt.wav')
+        urls = ring.get_urls(key)
+        ring.mark_down(urls[0])
+        self.assertEquals(ring.get_urls(key), urls[1:] + urls[:1])
+        ring.mark_up(urls[0])
+        self.assertEquals(ring.get_urls(key), urls)
+
+
+class FakeSocket(object):
+    def __init__(self, variant='', shared_path=''):
+        self.log = DummyLogger()
+        self.cache = {'script': '/usr/bin/wavstream.sh',
+                      'variant': variant,
+                      'shared_path': shared_path}
+
+
+class TestGetCacheStream(TestCase):
+    cache_url = 'http://127.0.0.1:8089'
+    url = 'http://127.0.0.1/a.wav'
+    result = {'CacheType': 'wav', 'Variants': ['8k'],
+              'ResourceKey': 'key1', 'Digest': 'abcdef'}
+
+    def get(self, socket, **kwargs):
+        result = dict(self.result, **kwargs)
+        return get_cache_stream(socket, self.cache_url, self.url, result)
+
+    def test_script_fallback(self):
+        socket = FakeSocket()
+        self.assertEquals(self.get(socket),
+            'shell_stream:///usr/bin/wavstream.sh http://127.0.0.1:8089/Cache/?url=http%3A%2F%2F127.0.0.1%2Fa.wav')
+        self.assertEquals(self.get(socket, CacheType='mp3'),
+            'shout://127.0.0.1:8089/Cache/?url=http%3A%2F%2F127.0.0.1%2Fa.wav')
+        self.assertEquals(self.get(socket, CacheType='ogg'), None)
+
+    def test_variant(self):
+        socket = FakeSocket(variant='8k')
+        self.assertEquals(self.get(socket),
+            'http_cache://http://127.0.0.1:8089/CacheFile/key1.8k.wav')
+        # variant not created by cache server
+        self.assertTrue(self.get(socket, Variants=['16k']).startswith('shell_stream://'))
+        self.assertTrue(self.get(socket, Variants=None).startswith('shell_stream://'))
+
+    def test_shared_path(self):
+        socket = FakeSocket(shared_path='/shared')
+        self.assertEquals(self.get(socket), '/shared/ab/abcdef.wav')
+        self.assertEquals(self.get(socket, CacheType='mp3'), '/shared/ab/abcdef.mp3')
+        # not published by cache server
+        self.assertTrue(self.get(socket, Digest='').startswith('shell_stream://'))
+
+    def test_shared_path_variant(self):
+        socket = FakeSocket(variant='8k', shared_path='/shared')
+        self.assertEquals(self.get(socket), '/shared/ab/abcdef.8k.wav')
+        self.assertEquals(self.get(socket, Variants=[]), '/shared/ab/abcdef.wav')
+
+
+class SlowStream(object):
+    """Body received in parts, read() returns at most the rest
+    of the current part and records how much was sent
+    """
+    def __init__(self, parts):
+        self.data = ''.join(parts)
+        self.ends = []
+        end = 0
+        for part in parts:
+            end += len(part)
+            self.ends.append(end)
+        self.pos = 0
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        end = len(self.data)
+        for part_end in self.ends:
+            if part_end > self.pos:
+                end = part_end
+                break
+        if size >= 0:
+            end = min(end, self.pos + size)
+        chunk = self.data[self.pos:end]
+        self.pos = end
+        return chunk
+
+
+def make_response(sock):
+    """urllib2 response reading an HTTP response from sock
+    """
+    response = httplib.HTTPResponse(sock, buffering=True)
+    response.begin()
+    response.recv = response.read
+    return urllib.addinfourl(socket._fileobject(response, close=True),
+                             response.msg, 'http://127.0.0.1/')
+
+
+class TestIterparseStream(TestCase):
+    def test_element_before_end(self):
+        parts = ['<Response><Speak>Hello</Speak>', '<Wait length="60"/>',
+                 '<Hangup/></Response>']
+        body = ''.join(parts)
+        stream = SlowStream(parts)
+        ends = []
+        for event, element in iterparse_stream(stream):
+            if event == 'end':
+                ends.append((element.tag, stream.pos))
+        self.assertEquals([ tag for tag, pos in ends ],
+                          ['Speak', 'Wait', 'Hangup', 'Response'])
+        # Speak is complete as soon as the part with its end tag is read
+        self.assertEquals(ends[0][1], len(parts[0]))
+        self.assertEquals(ends[1][1], body.index('<Hangup/>'))
+
+    def test_chunks(self):
+        body = '<Response>%s</Response>' % ('<Wait length="1"/>' * 1000)
+        stream = SlowStream([body])
+        tags = [ element.tag for event, element in iterparse_stream(stream, 4096)
+                 if event == 'end' ]
+        self.assertEquals(len(tags), 1001)
+        # bounded reads, last one gets the end of the body
+        self.assertEquals(stream.reads, len(body) // 4096 + 2)
+
+    def test_http_response(self):
+        server, client = socket.socketpair()
+        parts = ['<Response><Speak>Hello</Speak>', '<Hangup/></Response>']
+        server.sendall('HTTP/1.0 200 OK\r\nContent-Type: text/xml\r\n'
+                       'Content-Length: %d\r\n\r\n%s' \
+                       % (len(''.join(parts)), parts[0]))
+        try:
+            fd = make_response(client)
+            tags = []
+            # Speak is handed out before the rest of the body is sent,
+            # a blocking read would wait for it forever
+            with gevent.Timeout(2):
+                for event, element in iterparse_stream(fd):
+                    if event == 'end':
+                        tags.append(element.tag)
+                        if element.tag == 'Speak':
+                            server.sendall(parts[1])
+            self.assertEquals(tags, ['Speak', 'Hangup', 'Response'])
+        finally:
+            server.close()
+            client.close()
+
+    def test_syntax_error(self):
+        stream = SlowStream(['<Response><Speak>Hello</Wait></Response>'])
+        self.assertRaises(SyntaxError, list, iterparse_stream(stream))
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+import time
+from unittest import TestCase
+
+import gevent
+
+from plivo.rest.freeswitch.originate import TokenBucket, OriginateScheduler, \
+                                            parse_gateway_limits, \
+                                            parse_account_limits
+from plivo.utils.logger import DummyLogger
+
+
+class TestTokenBucket(TestCase):
+    def test_unlimited(self):
+        bucket = TokenBucket(0)
+        self.assertEquals([ bucket.take() for i in range(100) ], [0] * 100)
+
+    def test_rate(self):
+        bucket = TokenBucket(10)
+        waits = [ bucket.take() for i in range(20) ]
+        self.assertEquals(waits[:10], [0] * 10)
+        # next tokens are reserved 0.1s apart
+        self.assertTrue(0.05 < waits[10] <= 0.1)
+        self.assertTrue(0.95 < waits[19] <= 1.0)
+
+    def test_give_back(self):
+        bucket = TokenBucket(1)
+        self.assertEquals(bucket.take(), 0)
+        self.assertTrue(bucket.take() > 0.9)
+        bucket.give_back()
+        # next token still comes 1s after the first one
+        self.assertTrue(bucket.take() <= 1.0)
+        bucket = TokenBucket(0)
+        bucket.give_back()
+        self.assertEquals(bucket.take(), 0)
+
+
+class TestOriginateScheduler(TestCase):
+    def setUp(self):
+        self.dispatched = []
+
+    def spawn(self, request_uuid):
+        self.dispatched.append(request_uuid)
+
+    def test_parse_gateway_limits(self):
+        self.assertEquals(parse_gateway_limits(''), {})
+        self.assertEquals(parse_gateway_limits('sofia/gateway/gw1/:30:5, user/:10:0.5'),
+                          {'sofia/gateway/gw1/': (30, 5.0), 'user/': (10, 0.5)})
+        self.assertRaises(ValueError, parse_gateway_limits, 'sofia/gateway/gw1/:30')
+
+    def test_parse_account_limits(self):
+        self.assertEquals(parse_account_limits('AC1:4:200, AC2:1:0'),
+                          {'AC1': (4.0, 200), 'AC2': (1.0, 0)})
+        self.assertRaises(ValueError, parse_account_limits, 'AC1:0:10')
+
+    def test_fair_queuing(self):
+        scheduler = OriginateScheduler(self.spawn, DummyLogger(),
+                                       account_limits={'AC3': (2, 0)})
+        scheduler.submit([ ('bulk%d' % i, 'AC1') for i in range(10) ])
+        scheduler.submit([('single', 'AC2')])
+        scheduler.submit([('heavy1', 'AC3'), ('heavy2', 'AC3'), ('heavy3', 'AC3')])
+        gevent.sleep(0.1)
+        # single call of AC2 isn't queued behind AC1 bulk call
+        self.assertTrue(self.dispatched.index('single') <= 2)
+        # AC3 has twice the share of AC1
+        first = self.dispatched[:7]
+        self.assertEquals(len([ r for r in first if r.startswith('heavy') ]), 3)
+        status = scheduler.get_status({})['Accounts']
+        self.assertEquals(status['AC1']['Dispatched'], 10)
+        self.assertEquals(status['AC3']['Weight'], 2)
+
+    def test_account_max_calls(self):
+        scheduler = OriginateScheduler(self.spawn, DummyLogger(),
+                                       account_max_calls=2)
+        scheduler.submit([ ('r%d' % i, 'AC1') for i in range(4) ])
+        gevent.sleep(0.1)
+        self.assertEquals(self.dispatched, ['r0', 'r1'])
+        self.assertEquals(scheduler.get_status({})['Accounts']['AC1']['Queued'], 2)
+        scheduler.finish('r0')
+        gevent.sleep(0.1)
+        self.assertEquals(self.dispatched, ['r0', 'r1', 'r2'])
+
+    def test_max_queue(self):
+        scheduler = OriginateScheduler(self.spawn, DummyLogger(), cps=10, max_queue=5)
+        self.assertTrue(scheduler.submit([('a', ''), ('b', ''), ('c', '')]))
+        self.assertTrue(scheduler.has_room(2))
+        self.assertFalse(scheduler.has_room(3))
+        self.assertFalse(scheduler.submit([('d', ''), ('e', ''), ('f', '')]))
+        self.assertEquals(scheduler.rejected, 3)
+        gevent.sleep(0.5)
+        self.assertEquals(self.dispatched, ['a', 'b', 'c'])
+
+    def test_cps(self):
+        scheduler = OriginateScheduler(self.spawn, DummyLogger(), cps=20)
+        start = time.time()
+        scheduler.submit([ (str(i), 'AC1') for i in range(30) ])
+        while len(self.dispatched) < 30:
+            gevent.sleep(0.05)
+        # 20 first at once, then 10 at 20 per second
+        self.assertTrue(time.time() - start >= 0.45)
+        self.assertEquals(scheduler.get_status({})['Queued'], 0)
+
+    def test_gateway_slots(self):
+        scheduler = OriginateScheduler(self.spawn, DummyLogger(),
+                                       gateway_limits={'gw1': (2, 0)})
+        scheduler.acquire('a', 'gw1')
+        scheduler.acquire('b', 'gw1')
+        waiter = gevent.spawn(scheduler.acquire, 'c', 'gw1')
+        gevent.sleep(0.05)
+        self.assertEquals(scheduler.waiting, 1)
+        scheduler.release('a')
+        waiter.join(1)
+        self.assertEquals(scheduler.waiting, 0)
+        status = scheduler.get_status({})
+        self.assertEquals(status['Dialing'], 2)
+        self.assertEquals(status['Gateways']['gw1']['Active'], 2)
+        # unlimited gateways are not kept once released
+        scheduler.acquire('d', 'gw2')
+        scheduler.release('d')
+        self.assertFalse('gw2' in scheduler.get_status({})['Gateways'])
+
+    def test_token_after_account(self):
+        scheduler = OriginateScheduler(self.spawn, DummyLogger(), cps=1,
+                                       account_max_calls=1)
+        scheduler.submit([('r0', 'AC1'), ('r1', 'AC1')])
+        gevent.sleep(0.1)
+        self.assertEquals(self.dispatched, ['r0'])
+        # no token reserved while AC1 has max calls
+        self.assertTrue(scheduler.bucket.tokens > -0.5)
+
+    def test_token_given_back(self):
+        scheduler = OriginateScheduler(self.spawn, DummyLogger(), cps=1,
+                                       account_max_calls=2)
+        scheduler.submit([('r0', 'AC1'), ('r1', 'AC1')])
+        gevent.sleep(0.1)
+        self.assertEquals(self.dispatched, ['r0'])
+        # AC1 is full when r1 token is available
+        scheduler.configure(cps=1, account_max_calls=1)
+        gevent.sleep(1)
+        self.assertEquals(self.dispatched, ['r0'])
+        scheduler.finish('r0')
+        # token not used for r1 is still there
+        gevent.sleep(0.2)
+        self.assertEquals(self.dispatched, ['r0', 'r1'])
+
+    def test_reconfigure_cps(self):
+        scheduler = OriginateScheduler(self.spawn, DummyLogger(), cps=5)
+        bucket = scheduler.bucket
+        scheduler.submit([ (str(i), 'AC1') for i in range(5) ])
+        gevent.sleep(0.05)
+        self.assertEquals(len(self.dispatched), 5)
+        # reload doesn't refill the bucket
+        scheduler.configure(cps=5)
+        self.assertTrue(scheduler.bucket is bucket)
+        self.assertTrue(bucket.tokens < 1)
+        scheduler.configure(cps=2)
+        self.assertEquals(bucket.rate, 2)
+
+    def test_gateway_reconfigure(self):
+        scheduler = OriginateScheduler(self.spawn, DummyLogger(),
+                                       gateway_limits={'gw1': (1, 0)})
+        scheduler.acquire('a', 'gw1')
+        waiter = gevent.spawn(scheduler.acquire, 'b', 'gw1')
+        gevent.sleep(0.05)
+        self.assertEquals(scheduler.waiting, 1)
+        limit = scheduler.get_gateway('gw1')
+        # raised limit applies to the waiting call
+        scheduler.configure(gateway_limits={'gw1': (2, 0)})
+        waiter.join(1)
+        self.assertEquals(scheduler.waiting, 0)
+        self.assertTrue(scheduler.get_gateway('gw1') is limit)
+        self.assertEquals(scheduler.get_status({})['Gateways']['gw1'],
+                          {'Active': 2, 'MaxCalls': 2, 'CPS': 0})
+        # lowered limit, calls in progress keep their slot
+        scheduler.configure(gateway_limits={'gw1': (1, 0)})
+        waiter = gevent.spawn(scheduler.acquire, 'c', 'gw1')
+        scheduler.release('a')
+        gevent.sleep(0.05)
+        self.assertEquals(scheduler.waiting, 1)
+        scheduler.release('b')
+        waiter.join(1)
+        self.assertEquals(scheduler.waiting, 0)
+        # gateway without limit anymore is dropped once released
+        scheduler.configure()
+        self.assertTrue('gw1' in scheduler.get_status({})['Gateways'])
+        scheduler.release('c')
+        self.assertFalse('gw1' in scheduler.get_status({})['Gateways'])
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+import os
+import os.path
+import shutil
+import tempfile
+from unittest import TestCase
+
+import gevent
+
+from plivo.rest.freeswitch.speakcache import SpeakCache
+from plivo.utils.logger import DummyLogger
+
+
+class TestSpeakCache(TestCase):
+    def setUp(self):
+        self.cache_path = tempfile.mkdtemp()
+        self.sound = tempfile.NamedTemporaryFile(suffix='.wav')
+        self.sound.write('RIFF0000WAVE')
+        self.sound.flush()
+
+    def tearDown(self):
+        self.sound.close()
+        shutil.rmtree(self.cache_path, ignore_errors=True)
+
+    def test_render(self):
+        cache = SpeakCache(DummyLogger(), self.cache_path,
+                           command='cp %s {file}' % self.sound.name)
+        self.assertEquals(cache.get_file('flite', 'slt', 'en', 'Please hold'), None)
+        for i in range(100):
+            path = cache.get_file('flite', 'slt', 'en', 'Please hold')
+            if path:
+                break
+            gevent.sleep(0.02)
+        self.assertTrue(path.startswith(self.cache_path))
+        self.assertEquals(open(path).read(), 'RIFF0000WAVE')
+        self.assertEquals(cache.size, 12)
+        # other voice is another phrase
+        self.assertEquals(cache.get_file('flite', 'kal', 'en', 'Please hold'), None)
+
+    def wait_file(self, cache, text):
+        for i in range(100):
+            path = cache.get_file('flite', 'slt', 'en', text)
+            if path:
+                return path
+            gevent.sleep(0.02)
+        return None
+
+    def test_text_file(self):
+        cache = SpeakCache(DummyLogger(), self.cache_path,
+                           command='cp {textfile} {file}')
+        self.assertEquals(cache.get_file('flite', 'slt', 'en', '-o /tmp/x'), None)
+        path = self.wait_file(cache, '-o /tmp/x')
+        self.assertEquals(open(path).read(), '-o /tmp/x')
+        # no tmp or text file left
+        self.assertEquals(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+
+    def test_shared_path(self):
+        cache = SpeakCache(DummyLogger(), self.cache_path,
+                           command='cp %s {file}' % self.sound.name)
+        other = SpeakCache(DummyLogger(), self.cache_path,
+                           command='false')
+        cache.get_file('flite', 'slt', 'en', 'Please hold')
+        path = self.wait_file(cache, 'Please hold')
+        # rendered by the other server, found on disk
+        self.assertEquals(other.get_file('flite', 'slt', 'en', 'Please hold'), path)
+        self.assertEquals(other.size, 12)
+        self.assertEquals(other._renders, set())
+        self.assertEquals(other.get_file('flite', 'slt', 'en', 'Please hold'), path)
+        self.assertEquals(other.size, 12)
+
+    def test_engines(self):
+        cache = SpeakCache(DummyLogger(), self.cache_path,
+                           command='cp %s {file}' % self.sound.name)
+        self.assertEquals(cache.get_file('cepstral', 'Allison', 'en', 'Hello'), None)
+        self.assertEquals(cache.get_file('flite', 'slt', 'en', ''), None)
+        self.assertEquals(cache._renders, set())
+
+    def test_evict(self):
+        cache = SpeakCache(DummyLogger(), self.cache_path, max_size=20)
+        paths = []
+        for text in ('one', 'two', 'three'):
+            path = cache.get_file_path(cache.get_key('flite', 'slt', 'en', text))
+            os.makedirs(os.path.dirname(path))
+            fd = open(path, 'w')
+            fd.write('0123456789')
+            fd.close()
+            os.utime(path, (len(paths), len(paths)))
+            paths.append(path)
+        cache = SpeakCache(DummyLogger(), self.cache_path, max_size=20)
+        self.assertEquals(cache.size, 20)
+        self.assertFalse(os.path.isfile(paths[0]))
+        self.assertEquals(cache.get_file('flite', 'slt', 'en', 'three'), paths[2])
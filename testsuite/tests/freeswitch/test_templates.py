@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+import os.path
+import shutil
+import tempfile
+from unittest import TestCase
+
+from plivo.rest.freeswitch.exceptions import RESTFormatException, \
+                                    UnrecognizedElementException
+from plivo.rest.freeswitch.templates import RESTXMLTemplate, TemplateStore, \
+                                            parse_template_url
+from plivo.utils.logger import DummyLogger
+
+
+STATIC = '<Response><Speak loop="2">Welcome</Speak>' \
+         '<GetDigits action="http://localhost/digits/"><Speak>Press 1</Speak></GetDigits>' \
+         '</Response>'
+
+DYNAMIC = '<Response><Speak>Hello {{ Name }}</Speak>' \
+          '<Redirect>http://localhost/{{CallUUID}}/</Redirect></Response>'
+
+
+class TestRESTXMLTemplate(TestCase):
+    def test_parse_template_url(self):
+        self.assertEquals(parse_template_url('template://welcome?lang=fr&x=1'),
+                          ('welcome', {'lang': 'fr', 'x': '1'}))
+        self.assertEquals(parse_template_url('template://welcome'), ('welcome', {}))
+
+    def test_static_plan(self):
+        template = RESTXMLTemplate('welcome', STATIC)
+        self.assertFalse(template.dynamic)
+        rendered = template.render({})
+        self.assertEquals([ element.name for element in rendered ], ['Speak', 'GetDigits'])
+        self.assertEquals(rendered[0].text, 'Welcome')
+        self.assertEquals(rendered[1].children[0].text, 'Press 1')
+        # each call gets its own instances
+        self.assertFalse(rendered[0] is template.plan[0])
+        self.assertFalse(rendered[0] is template.render({})[0])
+
+    def test_substitution(self):
+        template = RESTXMLTemplate('hello', DYNAMIC)
+        self.assertTrue(template.dynamic)
+        rendered = template.render({'Name': 'Bob', 'CallUUID': 'abc'})
+        self.assertEquals(rendered[0].text, 'Hello Bob')
+        self.assertEquals(rendered[1].text, 'http://localhost/abc/')
+        self.assertEquals(template.render({})[0].text, 'Hello')
+
+    def test_validation_at_load(self):
+        self.assertRaises(RESTFormatException, RESTXMLTemplate, 'x',
+                          '<Speak>Hello</Speak>')
+        self.assertRaises(UnrecognizedElementException, RESTXMLTemplate, 'x',
+                          '<Response><Foo/></Response>')
+        # nested elements are checked too, also in dynamic templates
+        self.assertRaises(RESTFormatException, RESTXMLTemplate, 'x',
+                          '<Response><GetDigits action="http://localhost/">'
+                          '<Hangup/></GetDigits></Response>')
+        self.assertRaises(RESTFormatException, RESTXMLTemplate, 'x',
+                          '<Response><Speak>{{Text}}<Play>a.wav</Play></Speak></Response>')
+
+
+class TestTemplateStore(TestCase):
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+
+    def write(self, filename, xml_str):
+        fd = open(os.path.join(self.template_dir, filename), 'w')
+        fd.write(xml_str)
+        fd.close()
+
+    def test_load_and_reload(self):
+        self.write('welcome.xml', STATIC)
+        self.write('welcome.fr.xml', DYNAMIC)
+        self.write('broken.xml', '<Response><Foo/></Response>')
+        self.write('notes.txt', 'not a template')
+        store = TemplateStore(self.template_dir, DummyLogger())
+        store.load()
+        self.assertEquals(sorted(store.templates), ['welcome', 'welcome.fr'])
+        self.assertTrue(store.get('welcome', 'fr').dynamic)
+        self.assertFalse(store.get('welcome', 'de').dynamic)
+        self.assertEquals(store.get('missing'), None)
+        os.remove(os.path.join(self.template_dir, 'welcome.fr.xml'))
+        store.load()
+        self.assertFalse(store.get('welcome', 'fr').dynamic)
+
+    def test_missing_dir(self):
+        store = TemplateStore(os.path.join(self.template_dir, 'missing'), DummyLogger())
+        store.load()
+        self.assertEquals(store.templates, {})
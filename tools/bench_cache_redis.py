@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+"""
+Micro benchmark of plivo cache server redis access
+
+Compare the former access pattern (new redis client per call,
+sismember + hget per field) with ResourceCache pooled and pipelined access.
+
+Needs a local redis-server, usage :
+    python bench_cache_redis.py [ITERATIONS] [REDIS_HOST] [REDIS_PORT] [REDIS_DB]
+"""
+
+import sys
+import tempfile
+import time
+
+import redis
+
+from plivo.rest.freeswitch.cacheapi import ResourceCache
+
+
+URLS = [ 'http://127.0.0.1/bench/sound%d.wav' % i for i in range(10) ]
+
+
+def legacy_get_params(host, port, db, resource_key):
+    cx = redis.Redis(host=host, port=port, db=db, socket_timeout=5.0)
+    if cx.sismember("resource_key", resource_key):
+        cx.hget("resource_key:%s" % resource_key, "resource_type")
+        cx.hget("resource_key:%s" % resource_key, "etag")
+        cx.hget("resource_key:%s" % resource_key, "last_modified")
+
+
+def legacy_update_params(host, port, db, resource_key):
+    cx = redis.Redis(host=host, port=port, db=db, socket_timeout=5.0)
+    if not cx.sismember("resource_key", resource_key):
+        cx.sadd("resource_key", resource_key)
+    cx.hset("resource_key:%s" % resource_key, "resource_type", "wav")
+    cx.hset("resource_key:%s" % resource_key, "etag", "etag")
+    cx.hset("resource_key:%s" % resource_key, "last_modified", "")
+    cx.hset("resource_key:%s" % resource_key, "last_update_time", "0")
+
+
+def bench(name, func, iterations):
+    start = time.time()
+    for i in xrange(iterations):
+        func()
+    elapsed = time.time() - start
+    print "%-28s %8d ops %8.3f s %10.1f us/op" \
+            % (name, iterations, elapsed, elapsed * 1000000 / iterations)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    host = sys.argv[2] if len(sys.argv) > 2 else 'localhost'
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 6379
+    db = int(sys.argv[4]) if len(sys.argv) > 4 else 15
+
+    cache = ResourceCache(host, port, db, cache_path=tempfile.mkdtemp())
+    keys = [ cache.get_resource_key(url) for url in URLS ]
+    rk = keys[0]
+
+    bench('legacy update params', lambda: legacy_update_params(host, port, db, rk), iterations)
+    bench('pipelined update params',
+          lambda: cache.update_resource_params(rk, 'wav', 'etag', '', 0), iterations)
+    bench('legacy get params', lambda: legacy_get_params(host, port, db, rk), iterations)
+    bench('pooled get params', lambda: cache.get_resource_params(URLS[0]), iterations)
+    bench('legacy get params x10',
+          lambda: [ legacy_get_params(host, port, db, k) for k in keys ], max(1, iterations / 10))
+    bench('batch get params x10',
+          lambda: cache.get_resources_params(URLS), max(1, iterations / 10))
+
+    cache.delete_resources(keys)
+
+
+if __name__ == '__main__':
+    main()